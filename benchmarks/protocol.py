@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+"""Measures the address codec and the per frame cost of the detector
+protocol handlers, without any sockets.
+
+Run from the root directory with `python benchmarks/protocol.py`.
+"""
+import binascii
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sikorka.accounts import Account
+from sikorka.detector import (
+    OP_ETH_ADDRESS,
+    OP_SIGNED_MESSAGE,
+    detector_process,
+    detector_process_binary,
+)
+from sikorka.utils import address_decoder, address_encoder
+
+USER_ADDRESS = '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+USER_ADDRESS_BIN = binascii.unhexlify(USER_ADDRESS[2:])
+
+
+def benchmark_protocol(iterations=500, codec_iterations=100000):
+    account = Account.from_private_key(os.urandom(32))
+    text_address = b'ETH_ADDRESS'
+    text_sign = b'SIGNED_MESSAGE::' + USER_ADDRESS.encode('utf-8')
+    binary_address = memoryview(bytes([OP_ETH_ADDRESS]))
+    binary_sign = memoryview(bytes([OP_SIGNED_MESSAGE]) + USER_ADDRESS_BIN)
+    cases = (
+        ('address_decoder', codec_iterations, lambda: address_decoder(USER_ADDRESS)),
+        ('address_encoder', codec_iterations, lambda: address_encoder(USER_ADDRESS_BIN)),
+        ('text ETH_ADDRESS', iterations, lambda: detector_process(text_address, account)),
+        ('text SIGNED_MESSAGE', iterations, lambda: detector_process(text_sign, account)),
+        ('binary ETH_ADDRESS', iterations, lambda: detector_process_binary(
+            binary_address, account,
+        )),
+        ('binary SIGNED_MESSAGE', iterations, lambda: detector_process_binary(
+            binary_sign, account,
+        )),
+    )
+    results = []
+    for name, number, func in cases:
+        seconds = timeit.timeit(func, number=number)
+        results.append(dict(name=name, us=seconds * 10 ** 6 / number))
+    return results
+
+
+if __name__ == '__main__':
+    print('{:<25}{:>10}'.format('function', 'us'))
+    for result in benchmark_protocol():
+        print('{name:<25}{us:>10.2f}'.format(**result))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+"""Compares render time and symbol size of the QR renderers and payload
+encodings for a type 03 signed timestamp payload.
+
+Run from the root directory with `python benchmarks/qrcodes.py`.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sikorka.qrcodes import (
+    QR_PAYLOAD_ENCODINGS,
+    QR_RENDERERS,
+    encode_payload,
+    make_qr_code,
+    render_qr_code,
+)
+
+# Type 03 payload: the type byte, an 8 byte timestamp and a 65 byte signature
+PAYLOAD = bytearray.fromhex('03') + bytearray(os.urandom(73))
+
+
+def benchmark_qrcodes(iterations=20):
+    results = []
+    for encoding in QR_PAYLOAD_ENCODINGS:
+        qr = make_qr_code(encode_payload(PAYLOAD, encoding))
+        for renderer in sorted(QR_RENDERERS):
+            try:
+                data, _ = render_qr_code(PAYLOAD, renderer, encoding)
+            except ImportError as e:
+                print('Skipping {}: {}'.format(renderer, e))
+                continue
+            seconds = timeit.timeit(
+                lambda: render_qr_code(PAYLOAD, renderer, encoding),
+                number=iterations,
+            )
+            results.append(dict(
+                encoding=encoding,
+                renderer=renderer,
+                version=qr.version,
+                modules=len(qr.modules),
+                output_bytes=len(data),
+                render_ms=seconds * 1000 / iterations,
+            ))
+    return results
+
+
+if __name__ == '__main__':
+    print('{:<13}{:<14}{:>8}{:>9}{:>14}{:>12}'.format(
+        'encoding', 'renderer', 'version', 'modules', 'output bytes', 'render ms'
+    ))
+    for result in benchmark_qrcodes():
+        print('{encoding:<13}{renderer:<14}{version:>8}{modules:>9}'
+              '{output_bytes:>14}{render_ms:>12.2f}'.format(**result))
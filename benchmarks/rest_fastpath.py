@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+"""Compares the per request cost of the hot Rest API routes when served by
+flask and by the WSGI fast path in front of it.
+
+The apps are called directly with a prepared WSGI environ, so the numbers
+are the framework overhead plus the actual work without any networking.
+
+Run from the root directory with `python benchmarks/rest_fastpath.py`.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from werkzeug.test import EnvironBuilder
+
+from sikorka.accounts import Account
+from sikorka.api.api import RestAPI
+from sikorka.api.rest import APIServer
+from sikorka.service import Sikorka
+
+ROUTES = (
+    '/api/1/address',
+    '/api/1/detector_sign/0x8bed7fd11ef2efa1899f751a8d422c1fd028610c',
+)
+
+
+def call(app, environ):
+    body = b''.join(app(environ.copy(), lambda status, headers: None))
+    assert body.startswith(b'{')
+
+
+def benchmark_rest_fastpath(iterations=2000):
+    account = Account.from_private_key(os.urandom(32))
+    api_server = APIServer(RestAPI(Sikorka(None, account)))
+    results = []
+    for path in ROUTES:
+        route = path.replace('0x8bed7fd11ef2efa1899f751a8d422c1fd028610c', '<address>')
+        environ = EnvironBuilder(path=path).get_environ()
+        timings = {}
+        for name, app in (('flask', api_server.flask_app), ('fast', api_server.wsgi_app)):
+            seconds = timeit.timeit(lambda: call(app, environ), number=iterations)
+            timings[name] = seconds * 10 ** 6 / iterations
+        results.append(dict(
+            route=route,
+            flask_us=timings['flask'],
+            fast_us=timings['fast'],
+            speedup=timings['flask'] / timings['fast'],
+        ))
+    return results
+
+
+if __name__ == '__main__':
+    print('{:<35}{:>12}{:>12}{:>10}'.format('route', 'flask us', 'fast us', 'speedup'))
+    for result in benchmark_rest_fastpath():
+        print('{route:<35}{flask_us:>12.1f}{fast_us:>12.1f}{speedup:>9.1f}x'.format(**result))
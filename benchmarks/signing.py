@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+"""Measures the cost of making the signatures the detector hands out, for a
+single message, a type 01 signed message and a QR code timestamp.
+
+The account has no signature cache, so every call signs.
+
+Run from the root directory with `python benchmarks/signing.py`.
+"""
+import itertools
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from sikorka.accounts import Account
+
+USER_ADDRESS = '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+
+
+def benchmark_signing(iterations=500):
+    account = Account.from_private_key(os.urandom(32))
+    timestamps = itertools.count(1500000000)
+    message = os.urandom(28)
+    cases = (
+        ('sign', lambda: account.sign(message)),
+        ('create_signed_message', lambda: account.create_signed_message(
+            USER_ADDRESS, next(timestamps),
+        )),
+        ('create_qr_sign', lambda: account.create_qr_sign(next(timestamps))),
+    )
+    results = []
+    for name, func in cases:
+        seconds = timeit.timeit(func, number=iterations)
+        results.append(dict(name=name, us=seconds * 10 ** 6 / iterations))
+    return results
+
+
+if __name__ == '__main__':
+    print('{:<25}{:>10}'.format('function', 'us'))
+    for result in benchmark_signing():
+        print('{name:<25}{us:>10.1f}'.format(**result))
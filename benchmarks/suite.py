@@ -0,0 +1,213 @@
+#!/usr/bin/env python
+"""Runs all benchmarks, saves their results as a JSON baseline and compares
+two of them to flag regressions.
+
+Every result is the time in microseconds one call takes, so lower is better.
+Numbers are only comparable between runs on the same machine, which is why
+baselines are kept out of the repository.
+
+Run from the root directory:
+
+    python benchmarks/suite.py run --output baseline.json
+    # ... change something ...
+    python benchmarks/suite.py run --compare baseline.json
+    python benchmarks/suite.py compare baseline.json current.json
+"""
+import datetime
+import json
+import os
+import platform
+import sys
+from collections import OrderedDict
+
+import click
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from protocol import benchmark_protocol
+from qrcodes import benchmark_qrcodes
+from rest_fastpath import benchmark_rest_fastpath
+from signing import benchmark_signing
+
+
+def run_signing():
+    return [('signing/' + r['name'], r['us']) for r in benchmark_signing()]
+
+
+def run_protocol():
+    return [('protocol/' + r['name'], r['us']) for r in benchmark_protocol()]
+
+
+def run_wsgi():
+    results = []
+    for r in benchmark_rest_fastpath():
+        results.append(('wsgi/flask ' + r['route'], r['flask_us']))
+        results.append(('wsgi/fast ' + r['route'], r['fast_us']))
+    return results
+
+
+def run_qrcodes():
+    return [
+        ('qrcodes/{encoding} {renderer}'.format(**r), r['render_ms'] * 1000)
+        for r in benchmark_qrcodes()
+    ]
+
+
+SUITES = OrderedDict([
+    ('signing', run_signing),
+    ('protocol', run_protocol),
+    ('wsgi', run_wsgi),
+    ('qrcodes', run_qrcodes),
+])
+
+
+def run_suites(names, repeat):
+    """Runs the named suites `repeat` times, keeping the fastest time of
+    every benchmark since the slower ones are noise from the rest of the
+    machine"""
+    results = OrderedDict()
+    for name in names:
+        for _ in range(repeat):
+            for benchmark, us in SUITES[name]():
+                results[benchmark] = min(us, results.get(benchmark, us))
+    return results
+
+
+def compare_results(baseline, current, threshold):
+    """Compares the results of two runs
+
+    :param float threshold: The fraction a benchmark may get slower by
+                            before it counts as a regression
+    :return tuple: A (benchmark, baseline us, current us, change) row for
+                   every benchmark in either run, with None for a missing
+                   value, and the names of the regressed benchmarks
+    """
+    rows = []
+    regressions = []
+    for benchmark in list(baseline) + [b for b in current if b not in baseline]:
+        before = baseline.get(benchmark)
+        after = current.get(benchmark)
+        change = None
+        if before and after is not None:
+            change = after / before - 1
+            if change > threshold:
+                regressions.append(benchmark)
+        rows.append((benchmark, before, after, change))
+    return rows, regressions
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def save_results(path, results, repeat):
+    data = OrderedDict([
+        ('created', datetime.datetime.utcnow().replace(microsecond=0).isoformat() + 'Z'),
+        ('host', platform.node()),
+        ('platform', platform.platform()),
+        ('python', platform.python_version()),
+        ('repeat', repeat),
+        ('unit', 'us'),
+        ('results', results),
+    ])
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+
+
+def _format_us(us):
+    return '-' if us is None else '{:.2f}'.format(us)
+
+
+def print_results(results):
+    click.echo('{:<60}{:>12}'.format('benchmark', 'us'))
+    for benchmark, us in results.items():
+        click.echo('{:<60}{:>12}'.format(benchmark, _format_us(us)))
+
+
+def print_comparison(baseline, current, threshold):
+    """Prints the comparison of two runs and returns if any regressed"""
+    rows, regressions = compare_results(baseline, current, threshold)
+    click.echo('{:<60}{:>12}{:>12}{:>9}'.format('benchmark', 'baseline', 'current', 'change'))
+    for benchmark, before, after, change in rows:
+        click.echo('{:<60}{:>12}{:>12}{:>9}{}'.format(
+            benchmark,
+            _format_us(before),
+            _format_us(after),
+            '-' if change is None else '{:+.1%}'.format(change),
+            '  REGRESSION' if benchmark in regressions else '',
+        ))
+    if regressions:
+        click.echo('\n{} of {} benchmarks regressed by more than {:.0%}'.format(
+            len(regressions), len(rows), threshold,
+        ))
+    return bool(regressions)
+
+
+THRESHOLD_OPTION = click.option(
+    '--threshold',
+    help='Percentage a benchmark may get slower by before it is flagged.',
+    default=10.0,
+    type=click.FloatRange(min=0),
+    show_default=True,
+)
+
+
+@click.group()
+def main():
+    pass
+
+
+@main.command()
+@click.option(
+    '--suite',
+    'suites',
+    help='Only run this suite, can be given several times.',
+    multiple=True,
+    type=click.Choice(list(SUITES)),
+)
+@click.option(
+    '--repeat',
+    help='Times every suite is run, the fastest time of each benchmark is kept.',
+    default=3,
+    type=click.IntRange(min=1),
+    show_default=True,
+)
+@click.option(
+    '--output',
+    help='Save the results as JSON to this file, e.g. to use as a baseline.',
+    default=None,
+    type=click.Path(dir_okay=False),
+)
+@click.option(
+    '--compare',
+    'baseline',
+    help='Compare the results to this baseline and fail on regressions.',
+    default=None,
+    type=click.Path(exists=True, dir_okay=False),
+)
+@THRESHOLD_OPTION
+def run(suites, repeat, output, baseline, threshold):
+    """Runs the benchmarks"""
+    results = run_suites(suites or list(SUITES), repeat)
+    if output:
+        save_results(output, results, repeat)
+    if baseline:
+        if print_comparison(load_results(baseline), results, threshold / 100):
+            sys.exit(1)
+    else:
+        print_results(results)
+
+
+@main.command()
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False))
+@click.argument('current', type=click.Path(exists=True, dir_okay=False))
+@THRESHOLD_OPTION
+def compare(baseline, current, threshold):
+    """Compares two saved runs"""
+    if print_comparison(load_results(baseline), load_results(current), threshold / 100):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
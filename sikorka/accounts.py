@@ -2,15 +2,23 @@
 
 # -*- coding: utf-8 -*-
 import getpass
+import hashlib
 import json
 import os
+import re
 import sys
 import binascii
+import heapq
 import struct
+import time
+from collections import OrderedDict, namedtuple
+from gevent.threadpool import ThreadPool
 from ethereum.keys import decode_keystore_json
 from coincurve import PrivateKey
 from sha3 import keccak_256
 
+from sikorka import metrics, tracing
+
 
 def sha3(data):
     """
@@ -33,36 +41,228 @@ def address_decoder(addr):
     return addr
 
 
+class SignatureCache(object):
+    """A bounded LRU cache of signatures keyed on the exact signed message bytes
+
+    All messages signed by an account end with the big endian 8 byte timestamp
+    they were signed for. An entry is evicted as soon as that timestamp is more
+    than `seconds_allowed` seconds in the past, since the contract would reject
+    such a proof anyway, or when the cache grows beyond `size` entries in which
+    case the least recently used entry goes first.
+    """
+
+    def __init__(self, size=1024, seconds_allowed=60, clock=time.time):
+        if size <= 0:
+            raise ValueError('Signature cache size must be positive')
+        self.size = size
+        self.seconds_allowed = seconds_allowed
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        # min-heap of (timestamp, message) so that expired entries can be
+        # dropped without scanning the whole cache
+        self._expiry = []
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _expire(self):
+        oldest_allowed = self.clock() - self.seconds_allowed
+        while self._expiry and self._expiry[0][0] < oldest_allowed:
+            _, message = heapq.heappop(self._expiry)
+            self._entries.pop(message, None)
+
+    def get(self, message):
+        """Returns the cached signature for the message or None"""
+        self._expire()
+        message = bytes(message)
+        signature = self._entries.get(message)
+        if signature is None:
+            self.misses += 1
+            return None
+
+        self._entries.move_to_end(message)
+        self.hits += 1
+        return signature
+
+    def put(self, message, signature):
+        message = bytes(message)
+        timestamp = struct.unpack('>Q', message[-8:])[0]
+        if timestamp < self.clock() - self.seconds_allowed:
+            # Already outside the allowed window, no point in keeping it
+            return
+
+        if message not in self._entries:
+            heapq.heappush(self._expiry, (timestamp, message))
+        self._entries[message] = bytes(signature)
+        self._entries.move_to_end(message)
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+        # Keep the expiry heap from growing unbounded with entries that the
+        # LRU policy has already evicted
+        if len(self._expiry) > 2 * self.size:
+            self._expiry = [
+                entry for entry in self._expiry if entry[1] in self._entries
+            ]
+            heapq.heapify(self._expiry)
+
+    def stats(self):
+        return dict(size=len(self._entries), hits=self.hits, misses=self.misses)
+
+
+def decode_keyfile(keyfile, passfile_or_password):
+    """Decrypts the private key of a keystore file
+
+    This runs the key derivation function of the keystore, which is made to
+    take a long time. Use `unlock_accounts()` to run it without blocking.
+    """
+    with open(keyfile) as data_file:
+        data = json.load(data_file)
+
+    if os.path.isfile(passfile_or_password):
+        with open(passfile_or_password) as f:
+            password = f.read().strip('\n')
+    else:
+        password = passfile_or_password
+
+    return decode_keystore_json(data, password)
+
+
+SIGNATURE_SIZE = 65
+# Address and timestamp followed by the signature
+SIGNED_DATA_SIZE = 20 + 8 + SIGNATURE_SIZE
+
+SIGNATURES = metrics.counter(
+    'sikorka_signatures',
+    'Messages signed with the account key',
+)
+SIGNATURE_CACHE_HITS = metrics.counter(
+    'sikorka_signature_cache_hits',
+    'Messages whose signature was found in the signature cache',
+)
+SIGNING_SECONDS = metrics.histogram(
+    'sikorka_signing_seconds',
+    'Seconds taken to sign the messages of a call missing from the cache',
+)
+KEYSTORE_UNLOCK_SECONDS = metrics.histogram(
+    'sikorka_keystore_unlock_seconds',
+    'Seconds taken to decrypt a keystore file',
+)
+
+
 class Account(object):
 
-    def __init__(self, keyfile, passfile_or_password):
-        with open(keyfile) as data_file:
-            data = json.load(data_file)
+    def __init__(self, keyfile, passfile_or_password, signature_cache=None):
+        self._setup(decode_keyfile(keyfile, passfile_or_password), signature_cache)
 
-        if os.path.isfile(passfile_or_password):
-            with open(passfile_or_password) as f:
-                password = f.read().strip('\n')
-        else:
-            password = passfile_or_password
+    @classmethod
+    def from_private_key(cls, privkey_bin, signature_cache=None):
+        account = cls.__new__(cls)
+        account._setup(privkey_bin, signature_cache)
+        return account
 
-        privkey_bin = decode_keystore_json(data, password)
+    def _setup(self, privkey_bin, signature_cache):
         self.private_key = PrivateKey(privkey_bin)
-
-    def address(self):
-        return binascii.hexlify(bytearray(
+        self._address = binascii.hexlify(bytearray(
             sha3(self.private_key.public_key.format(
                 compressed=False)[1:])[-20:]
         )).decode('utf-8')
+        # Optional SignatureCache shared by everything signing with this account
+        self.signature_cache = signature_cache
+        # Optional Signer to make the signatures off the gevent hub
+        self.signer = None
+
+    def address(self):
+        return self._address
+
+    def _sign_jobs(self, view, jobs):
+        """Signs the message of every (offset, messagedata) job and writes its
+        65 byte signature to view[offset:offset + 65]
+
+        The signature cache is consulted here on the calling greenlet, only
+        the messages missing from it are handed to the signer.
+        """
+        misses = []
+        for offset, messagedata in jobs:
+            signature = None
+            if self.signature_cache is not None:
+                signature = self.signature_cache.get(messagedata)
+            if signature is None:
+                misses.append((offset, messagedata))
+            else:
+                view[offset:offset + SIGNATURE_SIZE] = signature
+
+        SIGNATURE_CACHE_HITS.inc(len(jobs) - len(misses))
+        if not misses:
+            return
+        trace = tracing.current()
+        start = time.perf_counter()
+        if self.signer is not None:
+            self.signer.run(self._sign_uncached, len(misses), view, misses, trace)
+        else:
+            self._sign_uncached(view, misses, trace)
+        end = time.perf_counter()
+        SIGNING_SECONDS.observe(end - start)
+        if trace is not None:
+            trace.add('sign', start, end, dict(signatures=len(misses)))
+        SIGNATURES.inc(len(misses))
+
+        if self.signature_cache is not None:
+            for offset, messagedata in misses:
+                self.signature_cache.put(
+                    messagedata,
+                    view[offset:offset + SIGNATURE_SIZE],
+                )
+
+    def _sign_uncached(self, view, jobs, trace=None):
+        # Runs in a thread of the signer if there is one, so it must not
+        # touch anything but its arguments and the private key
+        if trace is not None:
+            return self._sign_uncached_traced(view, jobs, trace)
+        for offset, messagedata in jobs:
+            # Hash here and sign the digest, instead of having coincurve
+            # call back into python for the hash
+            view[offset:offset + SIGNATURE_SIZE] = self.private_key.sign_recoverable(
+                keccak_256(messagedata).digest(),
+                hasher=None,
+            )
+            view[offset + SIGNATURE_SIZE - 1] += 27
+
+    def _sign_uncached_traced(self, view, jobs, trace):
+        for offset, messagedata in jobs:
+            start = time.perf_counter()
+            digest = keccak_256(messagedata).digest()
+            hashed = time.perf_counter()
+            view[offset:offset + SIGNATURE_SIZE] = self.private_key.sign_recoverable(
+                digest,
+                hasher=None,
+            )
+            view[offset + SIGNATURE_SIZE - 1] += 27
+            trace.add('keccak', start, hashed)
+            trace.add('secp256k1', hashed, time.perf_counter())
 
     def sign(self, messagedata):
-        signature = self.private_key.sign_recoverable(
-            messagedata,
-            hasher=sha3
-        )
-        if len(signature) != 65:
-            raise ValueError('invalid signature')
+        signature = bytearray(SIGNATURE_SIZE)
+        self._sign_jobs(memoryview(signature), [(0, messagedata)])
+        return bytes(signature)
 
-        return signature[:-1] + bytearray(chr(signature[-1] + 27), 'utf-8')
+    def sign_many(self, messages):
+        """Signs several messages at once
+
+        :return list: The 65 byte signature of every message as a memoryview
+                      into a single buffer holding all of them
+        """
+        signatures = memoryview(bytearray(SIGNATURE_SIZE * len(messages)))
+        self._sign_jobs(signatures, [
+            (idx * SIGNATURE_SIZE, messagedata)
+            for idx, messagedata in enumerate(messages)
+        ])
+        return [
+            signatures[offset:offset + SIGNATURE_SIZE]
+            for offset in range(0, len(signatures), SIGNATURE_SIZE)
+        ]
 
     def create_signed_message(self, user_address_hex, timestamp):
         message_data = (
@@ -73,6 +273,35 @@ class Account(object):
         message_data = message_data + bytearray(sig)
         return message_data
 
+    def create_signed_messages(self, user_addresses_bin, timestamp, prefix=b''):
+        """Creates the signed message of every user for the same timestamp
+
+        Each message is laid out as `prefix`, the 20 byte address, the 8 byte
+        timestamp and the signature, all of them in one buffer.
+
+        :param user_addresses_bin: 20 byte binary addresses
+        :param bytes prefix: Prepended to every message, e.g. a message type
+        :return list: The messages as memoryviews into that buffer
+        """
+        message_size = len(prefix) + SIGNED_DATA_SIZE
+        buffer = bytearray(message_size * len(user_addresses_bin))
+        view = memoryview(buffer)
+        timestamp_bytes = struct.pack(">Q", timestamp)
+        messages = []
+        jobs = []
+        for idx, user_address_bin in enumerate(user_addresses_bin):
+            if len(user_address_bin) != 20:
+                raise ValueError('Addresses must be 20 bytes long')
+            start = idx * message_size
+            data_start = start + len(prefix)
+            view[start:data_start] = prefix
+            view[data_start:data_start + 20] = user_address_bin
+            view[data_start + 20:data_start + 28] = timestamp_bytes
+            jobs.append((data_start + 28, view[data_start:data_start + 28]))
+            messages.append(view[start:start + message_size])
+        self._sign_jobs(view, jobs)
+        return messages
+
     def create_qr_sign(self, timestamp):
         message_data = (bytearray(struct.pack(">Q", timestamp)))
         sig = self.sign(message_data)
@@ -80,6 +309,64 @@ class Account(object):
         return message_data
 
 
+UnlockResult = namedtuple('UnlockResult', ['keyfile', 'account', 'seconds', 'error'])
+
+
+def _timed_decode_keyfile(keyfile, passfile_or_password):
+    start = time.perf_counter()
+    try:
+        privkey_bin = decode_keyfile(keyfile, passfile_or_password)
+    except Exception as ex:
+        return None, time.perf_counter() - start, ex
+    return privkey_bin, time.perf_counter() - start, None
+
+
+def unlock_accounts(keys, threads=None):
+    """Unlocks several keystore files at once
+
+    The key derivation runs in native threads, so only the calling greenlet
+    waits for it and the keys are decrypted in parallel as far as the KDF
+    implementation releases the GIL.
+
+    :param keys: (keyfile, passfile_or_password) pairs
+    :param int threads: How many keys to decrypt at the same time. Defaults
+                        to one per key up to the number of CPUs.
+    :return list: An UnlockResult per key, in the given order, with the
+                  Account or the error unlocking it raised and the seconds
+                  spent decrypting it
+    """
+    keys = list(keys)
+    if not keys:
+        return []
+    pool = ThreadPool(threads or min(len(keys), os.cpu_count() or 1))
+    try:
+        pending = [
+            pool.spawn(_timed_decode_keyfile, keyfile, passfile_or_password)
+            for keyfile, passfile_or_password in keys
+        ]
+        results = []
+        for (keyfile, _), async_result in zip(keys, pending):
+            privkey_bin, seconds, error = async_result.get()
+            if error is None:
+                KEYSTORE_UNLOCK_SECONDS.observe(seconds)
+            account = Account.from_private_key(privkey_bin) if error is None else None
+            results.append(UnlockResult(keyfile, account, seconds, error))
+        return results
+    finally:
+        pool.kill()
+
+
+def unlock_account(keyfile, passfile_or_password):
+    """Unlocks one keystore file without blocking other greenlets
+
+    :return tuple: The Account and the seconds spent decrypting it
+    """
+    result, = unlock_accounts([(keyfile, passfile_or_password)])
+    if result.error is not None:
+        raise result.error
+    return result.account, result.seconds
+
+
 def find_datadir():
     home = os.path.expanduser('~')
     if home == '~':  # Could not expand user path
@@ -113,32 +400,183 @@ def find_keystoredir():
     return keystore_path
 
 
+def find_cachedir():
+    """The directory sikorka keeps files in that it can recreate, or None"""
+    home = os.path.expanduser('~')
+    if home == '~':  # Could not expand user path
+        return None
+
+    if sys.platform == 'darwin':
+        cachedir = os.path.join(home, 'Library', 'Caches')
+    elif sys.platform == 'win32' or sys.platform == 'cygwin':
+        cachedir = os.environ.get('LOCALAPPDATA') or os.path.join(home, 'AppData', 'Local')
+    else:
+        cachedir = os.environ.get('XDG_CACHE_HOME') or os.path.join(home, '.cache')
+    return os.path.join(cachedir, 'sikorka')
+
+
+def keystore_manifest_path(keystore_path):
+    """Where the manifest of a keystore directory is kept
+
+    Not in the keystore itself, which belongs to the ethereum client and may
+    be read only or shared, but in the sikorka cache directory under a name
+    derived from the keystore path.
+    """
+    cachedir = find_cachedir()
+    if cachedir is None:
+        return None
+    key = hashlib.sha256(os.path.realpath(keystore_path).encode('utf-8')).hexdigest()
+    return os.path.join(cachedir, 'keystore-{}.json'.format(key[:16]))
+
+
+# geth and most other clients name keystore files UTC--<timestamp>--<address>
+KEYSTORE_FILENAME = re.compile(r'^UTC--.+--([0-9a-fA-F]{40})(?:\.json)?$')
+# Version of the manifest remembering the addresses of keystore files whose
+# names do not contain one
+MANIFEST_VERSION = 1
+# Below this many files to parse a thread pool is not worth starting. Above
+# it the files are handed to the pool in chunks, which keeps the overhead per
+# file low enough to be no slower than a serial scan of a warm page cache and
+# hides the latency of cold or network storage.
+PARALLEL_PARSE_THRESHOLD = 256
+PARSE_CHUNK_SIZE = 128
+PARSE_THREADS = 4
+
+
+def read_keystore_address(path):
+    """Returns the lowercase address of a keystore file or None if it is not one
+
+    Raises IOError if the file can not be read.
+    """
+    with open(path) as data_file:
+        try:
+            address = str(json.load(data_file)['address']).lower()
+        except (ValueError, KeyError, TypeError):
+            return None
+    return address[2:] if address.startswith('0x') else address
+
+
 class AccountManager(object):
 
-    def __init__(self, keystore_path=None):
+    def __init__(self, keystore_path=None, manifest_path=None):
         self.keystore_path = keystore_path
         self.accounts = {}
+        self.manifest_path = None
+        # Whether every file was opened by the last scan, instead of trusting
+        # the addresses in the file names
+        self.scanned_contents = False
         if self.keystore_path is None:
             self.keystore_path = find_keystoredir()
         if self.keystore_path is not None:
+            self.manifest_path = manifest_path or keystore_manifest_path(self.keystore_path)
+            self._scan_keystore()
+
+    def _load_manifest(self):
+        if self.manifest_path is None:
+            return {}
+        try:
+            with open(self.manifest_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            if (manifest.get('version') == MANIFEST_VERSION and
+                    manifest.get('keystore') == os.path.realpath(self.keystore_path)):
+                return manifest['files']
+        except (ValueError, KeyError, TypeError, AttributeError, IOError, OSError):
+            pass
+        return {}
+
+    def _save_manifest(self, files):
+        if self.manifest_path is None:
+            return
+        temporary_path = self.manifest_path + '.tmp'
+        try:
+            os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+            with open(temporary_path, 'w') as manifest_file:
+                json.dump(dict(
+                    version=MANIFEST_VERSION,
+                    keystore=os.path.realpath(self.keystore_path),
+                    files=files,
+                ), manifest_file)
+            os.replace(temporary_path, self.manifest_path)
+        except (IOError, OSError):
+            # No writable cache, the next start just parses the files again
+            pass
+
+    def _parse_keystore_file(self, name, fullpath):
+        try:
+            return read_keystore_address(fullpath)
+        except IOError as ex:
+            if name.startswith("UTC--"):
+                # Should be a valid account file - warn user
+                raise ValueError(
+                    "Can not read account file {} {}".format(fullpath, ex)
+                )
+            return None
+
+    def _parse_keystore_files(self, files):
+        return [self._parse_keystore_file(name, path) for name, path, _ in files]
+
+    def _scan_keystore(self, trust_filenames=True):
+        """Finds the address of every keystore file
+
+        The address is taken from the file name when it follows the
+        UTC--<timestamp>--<address> convention, unless `trust_filenames` is
+        False. Other files are parsed once and their address is remembered in
+        a manifest along with the mtime and size of the file, so they are only
+        parsed again once they change.
+        """
+        manifest = self._load_manifest()
+        self.accounts = {}
+        self.scanned_contents = not trust_filenames
+        files = {}
+        to_parse = []
+        for entry in os.scandir(self.keystore_path):
+            if not entry.is_file():
+                continue
+
+            match = KEYSTORE_FILENAME.match(entry.name) if trust_filenames else None
+            if match:
+                if not os.access(entry.path, os.R_OK):
+                    raise ValueError(
+                        "Can not read account file {}".format(entry.path)
+                    )
+                self.accounts[match.group(1).lower()] = str(entry.path)
+                continue
+
+            stat = entry.stat()
+            signature = [stat.st_mtime_ns, stat.st_size]
+            cached = manifest.get(entry.name)
+            if cached is not None and cached[:2] == signature:
+                files[entry.name] = cached
+            else:
+                to_parse.append((entry.name, entry.path, signature))
+
+        if len(to_parse) >= PARALLEL_PARSE_THRESHOLD:
+            chunks = [
+                to_parse[i:i + PARSE_CHUNK_SIZE]
+                for i in range(0, len(to_parse), PARSE_CHUNK_SIZE)
+            ]
+            # Native threads, even when gevent monkey patched the threading module
+            pool = ThreadPool(PARSE_THREADS)
+            try:
+                addresses = [
+                    address
+                    for chunk_addresses in pool.map(self._parse_keystore_files, chunks)
+                    for address in chunk_addresses
+                ]
+            finally:
+                pool.kill()
+        else:
+            addresses = self._parse_keystore_files(to_parse)
+
+        for (name, _, signature), address in zip(to_parse, addresses):
+            files[name] = signature + [address]
 
-            for f in os.listdir(self.keystore_path):
-                fullpath = os.path.join(self.keystore_path, f)
-                if os.path.isfile(fullpath):
-                    try:
-                        with open(fullpath) as data_file:
-                            data = json.load(data_file)
-                            self.accounts[str(data['address']).lower()] = str(fullpath)
-                    except (ValueError, KeyError, IOError) as ex:
-                        # Invalid file - skip
-                        if f.startswith("UTC--"):
-                            # Should be a valid account file - warn user
-                            msg = "Invalid account file"
-                            if isinstance(ex, IOError):
-                                msg = "Can not read account file"
-                                raise ValueError(
-                                    "{} {} {}".format(msg, fullpath, ex)
-                                )
+        for name, (_, _, address) in files.items():
+            if address is not None:
+                self.accounts[address] = os.path.join(self.keystore_path, name)
+
+        if to_parse or len(files) != len(manifest):
+            self._save_manifest(files)
 
     def address_in_keystore(self, address):
         if address is None:
@@ -146,8 +584,34 @@ class AccountManager(object):
 
         if address.startswith('0x'):
             address = address[2:]
+        address = address.lower()
 
-        return address.lower() in self.accounts
+        if address not in self.accounts and not self.scanned_contents:
+            # The file may be named after another address than it holds
+            self._scan_keystore(trust_filenames=False)
+        return address in self.accounts
+
+    def _keyfile(self, address):
+        """Returns the keystore file of a lowercase address without 0x
+
+        A file found by its name is checked to actually hold the address. If
+        it does not, every file is opened to find the right one.
+
+        :raises ValueError: If no file holds the address
+        """
+        if self.address_in_keystore(address):
+            path = self.accounts[address]
+            if self.scanned_contents:
+                return path
+            try:
+                if read_keystore_address(path) == address:
+                    return path
+            except IOError:
+                pass
+            self._scan_keystore(trust_filenames=False)
+            if address in self.accounts:
+                return self.accounts[address]
+        raise ValueError("Keystore file not found for %s" % address)
 
     def get_privkey(self, address, password=None):
         """Find the keystore file for an account, unlock it and get the private key
@@ -163,15 +627,23 @@ class AccountManager(object):
             address = address[2:]
 
         address = address.lower()
-
-        if not self.address_in_keystore(address):
-            raise ValueError("Keystore file not found for %s" % address)
-
-        with open(self.accounts[address]) as data_file:
-            data = json.load(data_file)
+        keyfile = self._keyfile(address)
 
         # Since file was found prompt for a password if not already given
         if password is None:
             password = getpass.getpass("Enter the password to unlock %s: " % address)
-        acc = Account(data, password, self.accounts[address])
+        acc, _ = unlock_account(keyfile, password)
         return acc
+
+    def get_privkeys(self, passwords, threads=None):
+        """Unlocks several accounts of the keystore at once
+
+        :param dict passwords: Passwords by address
+        :return list: An UnlockResult per address, see `unlock_accounts()`
+        """
+        keys = []
+        for address, password in passwords.items():
+            if address.startswith('0x'):
+                address = address[2:]
+            keys.append((self._keyfile(address.lower()), password))
+        return unlock_accounts(keys, threads)
@@ -1,31 +1,325 @@
 import json
+import time
+import struct
 import http.client
 from binascii import hexlify
-from flask import make_response
+from flask import Response, make_response, request
+from gevent.lock import BoundedSemaphore
+from werkzeug.wsgi import ClosingIterator
+
+from sikorka.api.encoding import decode_hex_address
+from sikorka import metrics, tracing
+from sikorka.qrcodes import stream_qrcodes
+from sikorka.ratelimit import RateLimited
+from sikorka.signer import SignerBusy
+from sikorka.utils import address_encoder
+
+# Maximum number of addresses that can be signed for in a single batch request
+MAX_BATCH_SIZE = 100
+# Maximum number of contracts returned by a nearby contracts search
+MAX_NEARBY_CONTRACTS = 100
+# Default maximum of QR code streams open at once per API process. Each one
+# holds a connection of the pool that also serves the signing requests.
+MAX_QRCODE_STREAMS = 128
+# Seconds a client should wait before asking again while the signer is busy
+SIGNER_BUSY_RETRY_AFTER = 1
+
+JSON_MIMETYPE = 'application/json'
+BINARY_MIMETYPE = 'application/octet-stream'
+# Compact batch replies start with the timestamp all messages were signed
+# for and the number of signatures that follow
+BATCH_HEADER = struct.Struct('>QH')
+# Signature given in a compact batch reply for an address that was not signed
+EMPTY_SIGNATURE = bytes(65)
 
 
 def api_response(result, status_code=http.client.OK):
+    with tracing.span('json encode'):
+        body = json.dumps(result)
     response = make_response((
-        json.dumps(result),
+        body,
         status_code,
         {'mimetype': 'application/json', 'Content-Type': 'application/json'}
     ))
     return response
 
 
+def api_error(errors, status_code):
+    return api_response(result=dict(errors=errors), status_code=status_code)
+
+
+def binary_response(data, status_code=http.client.OK):
+    response = make_response((
+        bytes(data),
+        status_code,
+        {'Content-Type': BINARY_MIMETYPE}
+    ))
+    return response
+
+
+def batch_too_large_error():
+    return api_error(
+        'Can not sign for more than {} addresses at once'.format(MAX_BATCH_SIZE),
+        http.client.BAD_REQUEST,
+    )
+
+
+def signer_busy_error(error):
+    response = api_error(str(error), http.client.SERVICE_UNAVAILABLE)
+    response.headers['Retry-After'] = str(SIGNER_BUSY_RETRY_AFTER)
+    return response
+
+
+def rate_limited_error(error):
+    response = api_error(str(error), http.client.TOO_MANY_REQUESTS)
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response
+
+
 class RestAPI(object):
 
-    def __init__(self, sikorka):
+    def __init__(
+            self,
+            sikorka,
+            qrcode_store=None,
+            rate_limiter=None,
+            max_qrcode_streams=MAX_QRCODE_STREAMS):
         self.api_version = 1
         self.sikorka = sikorka
+        self.qrcode_store = qrcode_store
+        self.rate_limiter = rate_limiter
+        self.qrcode_streams = BoundedSemaphore(max_qrcode_streams)
 
     def get_our_address(self):
         return api_response(
             result=dict(address=self.sikorka.address())
         )
 
-    def detector_sign(self, user_address_bin):
-        """Returns the required signed message as hexstring in a dict reply"""
-        signed_bytes = self.sikorka.sign_message_as_detector(user_address_bin)
+    def detector_sign(self, user_address_bin, binary=False, peer=None):
+        """Returns the required signed message as hexstring in a dict reply
+
+        With `binary` the reply is the signed message as raw bytes instead.
+        `peer` is the client asking for it, for the rate limiter.
+        """
+        try:
+            if self.rate_limiter is not None:
+                self.rate_limiter.admit(user_address_bin, peer)
+            signed_bytes = self.sikorka.sign_message_as_detector(user_address_bin)
+        except RateLimited as e:
+            return rate_limited_error(e)
+        except SignerBusy as e:
+            return signer_busy_error(e)
+        if binary:
+            return binary_response(signed_bytes)
         signed_hex = hexlify(signed_bytes).decode('utf-8')
         return api_response(result=dict(message=signed_hex))
+
+    def detector_sign_batch(self, user_addresses, timestamp=None, binary=False, peer=None):
+        """Returns the signed messages for a list of hex encoded user addresses
+
+        The reply contains one entry per given address in the same order. Each
+        entry is either a dict with the signed message as a hexstring or a dict
+        with an error explaining why that particular address was not signed.
+        With `binary` the reply is in the compact batch format instead, see
+        `_sign_batch()`.
+        """
+        if not isinstance(user_addresses, list):
+            return api_error(
+                'Expected a list of hex encoded addresses',
+                http.client.BAD_REQUEST,
+            )
+        if len(user_addresses) > MAX_BATCH_SIZE:
+            return batch_too_large_error()
+        if timestamp is not None and (
+                not isinstance(timestamp, int) or
+                isinstance(timestamp, bool) or
+                not 0 <= timestamp < 2 ** 64):
+            return api_error(
+                'Timestamp must be an unsigned 64 bit integer',
+                http.client.BAD_REQUEST,
+            )
+
+        addresses = []
+        for user_address in user_addresses:
+            try:
+                addresses.append(decode_hex_address(user_address))
+            except ValueError as e:
+                addresses.append(e)
+        return self._sign_batch(addresses, timestamp, binary, peer)
+
+    def detector_sign_batch_packed(self, data, binary=False, peer=None):
+        """Returns the signed messages for a batch request sent as raw bytes
+
+        `data` is the 8 byte big endian timestamp to sign for, 0 meaning the
+        current time, followed by the 20 byte user addresses.
+        """
+        if len(data) < 8 or (len(data) - 8) % 20 != 0:
+            return api_error(
+                'Expected an 8 byte timestamp followed by 20 byte addresses',
+                http.client.BAD_REQUEST,
+            )
+        if (len(data) - 8) // 20 > MAX_BATCH_SIZE:
+            return batch_too_large_error()
+        timestamp, = struct.unpack_from('>Q', data)
+        addresses = [bytes(data[i:i + 20]) for i in range(8, len(data), 20)]
+        return self._sign_batch(addresses, timestamp or None, binary, peer)
+
+    def _sign_batch(self, addresses, timestamp, binary, peer=None):
+        """Signs for the binary addresses of a batch, skipping the exceptions
+
+        The callers have already checked the batch against MAX_BATCH_SIZE.
+
+        The compact batch format used for a `binary` reply is the BATCH_HEADER
+        followed by the 65 byte signature of every address, in order. The
+        rest of each signed message is the type byte, the address and the
+        timestamp, which the client already knows. Addresses that were not
+        signed get an EMPTY_SIGNATURE, which can not be valid since its v is 0.
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+
+        if self.rate_limiter is not None:
+            valid = [address for address in addresses if isinstance(address, bytes)]
+            try:
+                admitted = iter(self.rate_limiter.admit_batch(valid, peer))
+            except RateLimited as e:
+                return rate_limited_error(e)
+            addresses = [
+                address if not isinstance(address, bytes) or next(admitted)
+                else ValueError('Rate limit exceeded')
+                for address in addresses
+            ]
+
+        try:
+            signed_messages = iter(self.sikorka.sign_messages_as_detector(
+                [address for address in addresses if isinstance(address, bytes)],
+                timestamp,
+            ))
+        except SignerBusy as e:
+            return signer_busy_error(e)
+
+        if binary:
+            parts = [BATCH_HEADER.pack(timestamp, len(addresses))]
+            for address in addresses:
+                if isinstance(address, bytes):
+                    parts.append(next(signed_messages)[29:])
+                else:
+                    parts.append(EMPTY_SIGNATURE)
+            return binary_response(b''.join(parts))
+
+        results = []
+        for address in addresses:
+            if isinstance(address, bytes):
+                signed_hex = hexlify(next(signed_messages)).decode('utf-8')
+                results.append(dict(message=signed_hex))
+            else:
+                results.append(dict(error=str(address)))
+        return api_response(result=dict(timestamp=timestamp, messages=results))
+
+    def get_qrcode(self):
+        """Returns the currently displayed signed QR code image
+
+        Caching headers follow the rotation period so that pollers get a
+        304 Not Modified until the code rotates.
+        """
+        qrcode = self.qrcode_store.current if self.qrcode_store else None
+        if qrcode is None:
+            return api_error('No QR code available', http.client.NOT_FOUND)
+
+        response = make_response(qrcode.data)
+        response.mimetype = qrcode.mimetype
+        response.set_etag(qrcode.etag)
+        response.last_modified = qrcode.timestamp
+        expires_in = qrcode.timestamp + self.qrcode_store.period - int(time.time())
+        response.cache_control.max_age = max(expires_in, 0)
+        return response.make_conditional(request)
+
+    def get_qrcode_stream(self, with_image=False, last_event_id=None):
+        """Returns a server-sent event stream of the signed QR codes
+
+        Every code is pushed the moment it goes on display, `with_image`
+        including the rendered image. Beyond `max_qrcode_streams` open
+        streams new ones are turned away, so that they can not take every
+        connection of the pool.
+        """
+        if self.qrcode_store is None:
+            return api_error('No QR codes generated', http.client.NOT_FOUND)
+        if not self.qrcode_streams.acquire(blocking=False):
+            response = api_error('Too many QR code streams', http.client.SERVICE_UNAVAILABLE)
+            response.headers['Retry-After'] = str(self.qrcode_store.period)
+            return response
+
+        try:
+            last_event_id = int(last_event_id)
+        except (TypeError, ValueError):
+            last_event_id = None
+        response = Response(
+            # Passed through to the server as is, which closes it once the
+            # client is gone
+            ClosingIterator(
+                stream_qrcodes(self.qrcode_store, with_image, last_event_id),
+                self.qrcode_streams.release,
+            ),
+            mimetype='text/event-stream',
+            direct_passthrough=True,
+        )
+        response.cache_control.no_cache = True
+        # Keep reverse proxies from buffering the events
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response
+
+    def get_qrcode_schedule(self):
+        """Returns how far ahead the QR codes are pre-rendered and how much
+        their rotation jitters"""
+        stats = self.qrcode_store.schedule_stats if self.qrcode_store else None
+        if stats is None:
+            return api_error('No QR code schedule running', http.client.NOT_FOUND)
+        return api_response(result=stats)
+
+    def nearby_contracts(self, latitude, longitude, radius=None, limit=None):
+        """Returns the registry contracts closest to the given coordinates
+
+        With a radius all contracts within that many meters are returned,
+        without one the `limit` nearest contracts. Either way they are sorted
+        by distance and at most MAX_NEARBY_CONTRACTS are returned.
+        """
+        registry = self.sikorka.registry
+        if registry is None:
+            return api_error('No registry is loaded', http.client.NOT_FOUND)
+        if latitude is None or longitude is None:
+            return api_error(
+                'Numeric lat and lon arguments are required',
+                http.client.BAD_REQUEST,
+            )
+        if not -90 <= latitude <= 90 or not -180 <= longitude <= 180:
+            return api_error('Coordinates out of range', http.client.BAD_REQUEST)
+        if (radius is not None and radius < 0) or (limit is not None and limit < 1):
+            return api_error(
+                'radius can not be negative and limit must be positive',
+                http.client.BAD_REQUEST,
+            )
+
+        limit = min(limit or MAX_NEARBY_CONTRACTS, MAX_NEARBY_CONTRACTS)
+        if radius is None:
+            found = registry.nearest(latitude, longitude, limit)
+        else:
+            found = registry.within(latitude, longitude, radius)[:limit]
+
+        contracts = [
+            dict(
+                address=address_encoder(address),
+                latitude=contract_lat,
+                longitude=contract_lon,
+                distance=distance,
+            )
+            for distance, address, contract_lat, contract_lon in found
+        ]
+        return api_response(result=dict(contracts=contracts))
+
+    def get_metrics(self):
+        """Returns the metrics of this process in the Prometheus text format"""
+        return make_response((
+            metrics.REGISTRY.render(),
+            http.client.OK,
+            {'Content-Type': metrics.CONTENT_TYPE},
+        ))
@@ -3,25 +3,40 @@ from werkzeug.routing import (
     ValidationError,
 )
 import binascii
+from sikorka import tracing
 from sikorka.utils import (
     address_encoder
 )
 
 
-class HexAddressConverter(BaseConverter):
-    def to_python(self, value):
-        if value[:2] != '0x':
-            raise ValidationError()
+def decode_hex_address(value):
+    """Decodes a '0x' prefixed hex encoded address into its 20 raw bytes
+
+    :param str value: The hex encoded address
+    :raises ValueError: If the value is not a valid hex encoded address
+    :return bytes: The binary address
+    """
+    if not isinstance(value, str) or value[:2] != '0x':
+        raise ValueError('Address must be a 0x prefixed hex string')
+
+    try:
+        value = binascii.unhexlify(value[2:])
+    except (TypeError, ValueError):
+        raise ValueError('Address is not valid hex')
 
-        try:
-            value = binascii.unhexlify(value[2:])
-        except TypeError:
-            raise ValidationError()
+    if len(value) != 20:
+        raise ValueError('Address must be 20 bytes long')
 
-        if len(value) != 20:
-            raise ValidationError()
+    return value
 
-        return value
+
+class HexAddressConverter(BaseConverter):
+    def to_python(self, value):
+        with tracing.span('HexAddressConverter'):
+            try:
+                return decode_hex_address(value)
+            except ValueError:
+                raise ValidationError()
 
     def to_url(self, value):
         return address_encoder(value)
@@ -0,0 +1,112 @@
+import json
+from binascii import hexlify
+
+from sikorka.api.api import BINARY_MIMETYPE, JSON_MIMETYPE, SIGNER_BUSY_RETRY_AFTER
+from sikorka import tracing
+from sikorka.api.metrics import ROUTE_ENVIRON_KEY
+from sikorka.ratelimit import RateLimited
+from sikorka.signer import SignerBusy
+
+# Accept headers of detector_sign requests the fast path replies to with JSON,
+# anything but these and BINARY_MIMETYPE is negotiated by Flask
+JSON_ACCEPTS = frozenset([None, '*/*', JSON_MIMETYPE])
+
+
+def parse_hex_address(value):
+    """Returns the 20 raw bytes of a '0x' prefixed hex address or None"""
+    if len(value) != 42 or value[:2] != '0x':
+        return None
+    try:
+        address = bytes.fromhex(value[2:])
+    except ValueError:
+        return None
+    # fromhex skips whitespace, so the length has to be checked again
+    return address if len(address) == 20 else None
+
+
+class FastPathApp(object):
+    """Serves the hottest API routes before the request reaches Flask
+
+    GET /address and GET /detector_sign/<address> are answered straight from
+    the WSGI environ, with the address reply rendered once up front. The
+    replies are byte for byte what the Flask resources produce, the signed
+    message is returned as raw bytes when that is all the client accepts.
+    Rate limited clients are turned away right here, that has to be cheap,
+    and so are requests the busy signer rejects once they were admitted,
+    since the wrapped app would admit them again. Anything else, including
+    invalid addresses, CORS requests and Accept headers that need actual
+    negotiation, is passed on to the wrapped app so the error handling lives
+    in one place.
+    """
+
+    def __init__(self, app, sikorka, prefix='/api/1', rate_limiter=None):
+        self.app = app
+        self.sikorka = sikorka
+        self.rate_limiter = rate_limiter
+        self.address_path = prefix + '/address'
+        self.sign_path = prefix + '/detector_sign/'
+        # The routes of the Flask resources, to count the requests on
+        self.sign_route = self.sign_path + '<hexaddress:user_address>'
+        self.address_reply = json.dumps(
+            dict(address=sikorka.address())
+        ).encode('utf-8')
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'GET' and 'HTTP_ORIGIN' not in environ:
+            path = environ.get('PATH_INFO', '')
+            if path == self.address_path:
+                environ[ROUTE_ENVIRON_KEY] = self.address_path
+                return self._reply(start_response, self.address_reply)
+
+            accept = environ.get('HTTP_ACCEPT')
+            binary = accept == BINARY_MIMETYPE
+            if path.startswith(self.sign_path) and (binary or accept in JSON_ACCEPTS):
+                user_address = parse_hex_address(path[len(self.sign_path):])
+                if user_address is not None:
+                    environ[ROUTE_ENVIRON_KEY] = self.sign_route
+                    try:
+                        if self.rate_limiter is not None:
+                            self.rate_limiter.admit(user_address, environ.get('REMOTE_ADDR'))
+                        signed, = self.sikorka.sign_messages_as_detector([user_address])
+                    except RateLimited as e:
+                        return self._reply_error(
+                            start_response, e, '429 Too Many Requests', e.retry_after,
+                        )
+                    except SignerBusy as e:
+                        return self._reply_error(
+                            start_response, e, '503 Service Unavailable',
+                            SIGNER_BUSY_RETRY_AFTER,
+                        )
+                    if binary:
+                        return self._reply(start_response, bytes(signed), BINARY_MIMETYPE)
+                    with tracing.span('json encode'):
+                        body = b'{"message": "' + hexlify(signed) + b'"}'
+                    return self._reply(start_response, body)
+
+        return self._fall_through(environ, start_response)
+
+    def _fall_through(self, environ, start_response):
+        with tracing.span('flask'):
+            return self.app(environ, start_response)
+
+    def _reply_error(self, start_response, error, status, retry_after):
+        """Replies like api_error with a Retry-After header"""
+        return self._reply(
+            start_response,
+            json.dumps(dict(errors=str(error))).encode('utf-8'),
+            status=status,
+            headers=[('Retry-After', str(retry_after))],
+        )
+
+    def _reply(
+            self,
+            start_response,
+            body,
+            content_type=JSON_MIMETYPE,
+            status='200 OK',
+            headers=()):
+        start_response(status, [
+            ('Content-Type', content_type),
+            ('Content-Length', str(len(body))),
+        ] + list(headers))
+        return [body]
@@ -0,0 +1,91 @@
+import time
+
+from sikorka import metrics
+from sikorka.api.workers import NoDelayWSGIServer
+
+from ethereum import slogging
+log = slogging.get_logger(__name__)
+
+# Set by whatever answers a request to the route pattern it matched, so that
+# requests are counted per resource and not per address asked for
+ROUTE_ENVIRON_KEY = 'sikorka.route'
+UNMATCHED_ROUTE = 'unmatched'
+# Methods counted as they are, anything else clients send counts as 'OTHER'
+HTTP_METHODS = frozenset(['GET', 'HEAD', 'POST', 'PUT', 'PATCH', 'DELETE', 'OPTIONS'])
+
+API_REQUESTS = metrics.counter(
+    'sikorka_api_requests',
+    'Rest API requests answered',
+    ['method', 'route', 'status'],
+)
+API_REQUEST_SECONDS = metrics.histogram(
+    'sikorka_api_request_seconds',
+    'Seconds taken to answer a Rest API request',
+    ['method', 'route'],
+)
+
+
+class MetricsApp(object):
+    """Counts and times the requests served by a WSGI app
+
+    The time is until the app returns its response, streamed bodies are
+    sent after that. A request that fails with an exception counts as 500.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        # (method, route, status) -> (histogram, counter) to record on
+        self._recorders = {}
+
+    def __call__(self, environ, start_response):
+        start = time.perf_counter()
+        status = ['500']
+
+        def start_response_recorded(status_line, headers, *exc_info):
+            status[0] = status_line[:3]
+            return start_response(status_line, headers, *exc_info)
+
+        try:
+            return self.app(environ, start_response_recorded)
+        finally:
+            method = environ['REQUEST_METHOD']
+            if method not in HTTP_METHODS:
+                method = 'OTHER'
+            key = (method, environ.get(ROUTE_ENVIRON_KEY) or UNMATCHED_ROUTE, status[0])
+            recorders = self._recorders.get(key)
+            if recorders is None:
+                recorders = self._recorders[key] = self._new_recorders(*key)
+            recorders[0].observe(time.perf_counter() - start)
+            recorders[1].inc()
+
+    @staticmethod
+    def _new_recorders(method, route, status):
+        return (
+            API_REQUEST_SECONDS.labels(method, route),
+            API_REQUESTS.labels(method, route, status),
+        )
+
+
+def metrics_app(environ, start_response):
+    """A WSGI app serving the metrics of this process at /metrics"""
+    if environ.get('PATH_INFO') != '/metrics':
+        start_response('404 Not Found', [('Content-Type', 'text/plain')])
+        return [b'Not Found\n']
+    body = metrics.REGISTRY.render()
+    start_response('200 OK', [
+        ('Content-Type', metrics.CONTENT_TYPE),
+        ('Content-Length', str(len(body))),
+    ])
+    return [body]
+
+
+def start_metrics_server(host, port):
+    """Serves the metrics of this process on their own port
+
+    With several API workers the API only reports the metrics of the worker
+    that answered, this is how the ones of the main process, such as those of
+    the detector server, are scraped.
+    """
+    server = NoDelayWSGIServer((host, port), metrics_app, log=log, error_log=log)
+    server.start()
+    return server
@@ -1,6 +1,9 @@
-from flask import Blueprint
+import http.client
+from flask import Blueprint, request
 from flask_restful import Resource
 
+from sikorka.api.api import BINARY_MIMETYPE, JSON_MIMETYPE, api_error
+
 
 def create_blueprint():
     # Take a look at this SO question on hints how to organize versioned
@@ -9,6 +12,15 @@ def create_blueprint():
     return Blueprint('v1_resources', __name__)
 
 
+def accepts_binary():
+    """Whether the client of the current request prefers raw bytes over JSON"""
+    best = request.accept_mimetypes.best_match(
+        [JSON_MIMETYPE, BINARY_MIMETYPE],
+        default=JSON_MIMETYPE,
+    )
+    return best == BINARY_MIMETYPE
+
+
 class BaseResource(Resource):
     def __init__(self, rest_api_object, **kwargs):
         super(BaseResource, self).__init__(**kwargs)
@@ -24,4 +36,69 @@ class AddressResource(BaseResource):
 class DetectorSignResource(BaseResource):
 
     def get(self, user_address):
-        return self.rest_api.detector_sign(user_address)
+        return self.rest_api.detector_sign(
+            user_address,
+            binary=accepts_binary(),
+            peer=request.remote_addr,
+        )
+
+
+class DetectorSignBatchResource(BaseResource):
+
+    def post(self):
+        if request.mimetype == BINARY_MIMETYPE:
+            return self.rest_api.detector_sign_batch_packed(
+                request.get_data(),
+                binary=accepts_binary(),
+                peer=request.remote_addr,
+            )
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return api_error(
+                'Expected a JSON object with a list of addresses',
+                http.client.BAD_REQUEST,
+            )
+        return self.rest_api.detector_sign_batch(
+            data.get('addresses'),
+            data.get('timestamp'),
+            binary=accepts_binary(),
+            peer=request.remote_addr,
+        )
+
+
+class QRCodeResource(BaseResource):
+
+    def get(self):
+        return self.rest_api.get_qrcode()
+
+
+class QRCodeStreamResource(BaseResource):
+
+    def get(self):
+        return self.rest_api.get_qrcode_stream(
+            request.args.get('image', 'false').lower() in ('1', 'true', 'yes'),
+            request.headers.get('Last-Event-ID'),
+        )
+
+
+class QRCodeScheduleResource(BaseResource):
+
+    def get(self):
+        return self.rest_api.get_qrcode_schedule()
+
+
+class NearbyContractsResource(BaseResource):
+
+    def get(self):
+        return self.rest_api.nearby_contracts(
+            request.args.get('lat', type=float),
+            request.args.get('lon', type=float),
+            request.args.get('radius', type=float),
+            request.args.get('limit', type=int),
+        )
+
+
+class MetricsResource(BaseResource):
+
+    def get(self):
+        return self.rest_api.get_metrics()
@@ -1,15 +1,24 @@
 import os
 from sikorka.api.encoding import HexAddressConverter
+from sikorka.api.fastpath import FastPathApp
+from sikorka.api.metrics import MetricsApp, ROUTE_ENVIRON_KEY
+from sikorka.api.tracing import TracingApp
+from sikorka.api.workers import APIWorkers, NoDelayWSGIServer
 from sikorka.api.resources import (
     create_blueprint,
     AddressResource,
-    DetectorSignResource
+    DetectorSignResource,
+    DetectorSignBatchResource,
+    QRCodeResource,
+    QRCodeScheduleResource,
+    QRCodeStreamResource,
+    NearbyContractsResource,
+    MetricsResource,
 )
 from werkzeug.exceptions import NotFound
-from flask import Flask, send_from_directory
+from flask import Flask, request, send_from_directory
 from flask_restful import Api
 from flask_cors import CORS
-from gevent.wsgi import WSGIServer
 
 from ethereum import slogging
 log = slogging.get_logger(__name__)
@@ -51,6 +60,14 @@ class APIServer(object):
         self._add_default_resources()
         self._register_type_converters()
         self.flask_app.register_blueprint(self.blueprint)
+        self.flask_app.before_request(self._record_route)
+        # What the servers run, the hot routes bypass flask
+        self.wsgi_app = MetricsApp(TracingApp(FastPathApp(
+            self.flask_app,
+            rest_api.sikorka,
+            self._api_prefix,
+            rest_api.rate_limiter,
+        )))
         self.flask_app.config['WEBUI_PATH'] = os.path.join(rootpath, 'ui')
 
         if webui:
@@ -68,6 +85,12 @@ class APIServer(object):
             DetectorSignResource,
             '/detector_sign/<hexaddress:user_address>'
         )
+        self.add_resource(DetectorSignBatchResource, '/detector_sign/batch')
+        self.add_resource(QRCodeResource, '/qrcode')
+        self.add_resource(QRCodeScheduleResource, '/qrcode/schedule')
+        self.add_resource(QRCodeStreamResource, '/qrcode/stream')
+        self.add_resource(NearbyContractsResource, '/contracts/nearby')
+        self.add_resource(MetricsResource, '/metrics')
 
     def _register_type_converters(self, additional_mapping=None):
         # an additional mapping concats to class-mapping and will overwrite existing keys
@@ -86,6 +109,11 @@ class APIServer(object):
             resource_class_kwargs={'rest_api_object': self.rest_api}
         )
 
+    @staticmethod
+    def _record_route():
+        if request.url_rule is not None:
+            request.environ[ROUTE_ENVIRON_KEY] = request.url_rule.rule
+
     def _serve_webui(self, file='index.html'):
         try:
             assert file
@@ -97,11 +125,46 @@ class APIServer(object):
     def run(self, host='127.0.0.1', port=5011, **kwargs):
         self.flask_app.run(host=host, port=port, **kwargs)
 
-    def start(self, host='127.0.0.1', port=5011):
-        self.wsgiserver = WSGIServer((host, port), self.flask_app, log=log, error_log=log)
+    def start(self, host='127.0.0.1', port=5011, pool_size=None):
+        """Serves the API from this process
+
+        :param int pool_size: Maximum number of connections served at the
+                              same time. Unbounded if not given.
+        """
+        self.wsgiserver = NoDelayWSGIServer(
+            (host, port),
+            self.wsgi_app,
+            spawn=pool_size or 'default',
+            log=log,
+            error_log=log,
+        )
         self.wsgiserver.start()
 
+    def start_workers(
+            self,
+            workers,
+            host='127.0.0.1',
+            port=5011,
+            pool_size=None,
+            worker_init=None):
+        """Serves the API from `workers` forked processes, see APIWorkers
+
+        Must be called before any other greenlet is spawned.
+        """
+        self.workers = APIWorkers(
+            self.wsgi_app,
+            workers,
+            host,
+            port,
+            pool_size,
+            worker_init,
+        )
+        self.workers.start()
+
     def stop(self, timeout=5):
         if getattr(self, 'wsgiserver', None):
             self.wsgiserver.stop(timeout)
             self.wsgiserver = None
+        if getattr(self, 'workers', None):
+            self.workers.stop()
+            self.workers = None
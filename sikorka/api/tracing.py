@@ -0,0 +1,27 @@
+from sikorka import tracing
+
+TRACE_ID_HEADER = 'X-Trace-Id'
+
+
+class TracingApp(object):
+    """Traces the requests served by a WSGI app, see sikorka.tracing
+
+    The replies to sampled requests carry the id of their trace in the
+    X-Trace-Id header, to find them in the trace file.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    def __call__(self, environ, start_response):
+        if not tracing.enabled():
+            return self.app(environ, start_response)
+        name = '{} {}'.format(environ['REQUEST_METHOD'], environ.get('PATH_INFO', ''))
+        with tracing.trace(name) as span:
+            if span.trace is None:
+                return self.app(environ, start_response)
+
+            def start_response_traced(status_line, headers, *exc_info):
+                headers.append((TRACE_ID_HEADER, span.trace.trace_id))
+                return start_response(status_line, headers, *exc_info)
+            return self.app(environ, start_response_traced)
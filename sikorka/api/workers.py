@@ -0,0 +1,230 @@
+import os
+import signal
+import time
+import gevent
+from gevent import socket
+from gevent.event import Event
+from gevent.monkey import get_original
+from gevent.wsgi import WSGIServer
+
+from ethereum import slogging
+log = slogging.get_logger(__name__)
+
+# The supervisor process never runs the gevent hub, it uses the blocking
+# originals even when gevent monkey patched them
+_fork = get_original('os', 'fork')
+_waitpid = get_original('os', 'waitpid')
+_sleep = get_original('time', 'sleep')
+_signal = get_original('signal', 'signal')
+
+# How often the supervisor and the workers check on each other
+POLL_INTERVAL = 0.2
+# A worker that dies sooner than this after being started is restarted only
+# after this many seconds, so a broken worker does not fork in a tight loop
+MIN_WORKER_LIFETIME = 1
+
+
+def _reap(pid=-1):
+    """Returns the (pid, status) of an exited child or (0, 0) if there is none"""
+    try:
+        return _waitpid(pid, os.WNOHANG)
+    except ChildProcessError:
+        # Already reaped, or no children at all
+        return pid if pid > 0 else 0, 0
+
+
+class NoDelayWSGIServer(WSGIServer):
+    """A WSGIServer that turns off Nagle's algorithm for its connections
+
+    gevent sends the headers and the body of a response with separate
+    writes. With Nagle's algorithm the body then waits until the client
+    acknowledges the headers, which a client that delays its ACKs does
+    only after some 40ms, on every request of a keep-alive connection
+    after the first.
+    """
+
+    def handle(self, sock, address):
+        if sock.family in (socket.AF_INET, socket.AF_INET6):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        super(NoDelayWSGIServer, self).handle(sock, address)
+
+
+def create_listener(host, port, backlog=1024):
+    """Creates the listening socket all workers accept connections from"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class APIWorkers(object):
+    """Serves a WSGI app from several pre-forked worker processes
+
+    The listening socket is created up front and inherited by every worker,
+    which lets the kernel spread the incoming connections among them. Each
+    worker serves at most `pool_size` connections at a time.
+
+    Forking a process that runs greenlets gives the child a copy of all of
+    them, so `start()` must be called before any other greenlet is spawned.
+    It forks a supervisor process which does nothing but fork the workers,
+    restart the ones that die and shut them down once it is stopped or the
+    process that started it goes away.
+
+    `worker_init(end_event)` is called in every worker right after it was
+    forked, to set up what has to be per process. `end_event` is set when
+    the worker should shut down.
+    """
+
+    def __init__(self, app, workers, host, port, pool_size=None, worker_init=None):
+        if workers < 1:
+            raise ValueError('Need at least one API worker')
+        self.app = app
+        self.workers = workers
+        self.pool_size = pool_size
+        self.worker_init = worker_init
+        self.listener = create_listener(host, port)
+        self.supervisor_pid = None
+        self._stopping = False
+        self._watcher = None
+
+    @property
+    def address(self):
+        return self.listener.getsockname()
+
+    def start(self):
+        self.supervisor_pid = _fork()
+        if self.supervisor_pid == 0:
+            self._run_supervisor()
+        self._watcher = gevent.spawn(self._watch_supervisor)
+
+    def _watch_supervisor(self):
+        while not _reap(self.supervisor_pid)[0]:
+            gevent.sleep(POLL_INTERVAL)
+        log.error('API supervisor exited unexpectedly', pid=self.supervisor_pid)
+        self.supervisor_pid = None
+
+    def _on_stop_signal(self, signum, frame):
+        self._stopping = True
+
+    def _run_supervisor(self):
+        """The body of the supervisor process, never returns"""
+        exit_code = 0
+        try:
+            _signal(signal.SIGINT, signal.SIG_IGN)
+            # Not meant for the supervisor, e.g. a profiler toggle sent to all
+            _signal(signal.SIGUSR1, signal.SIG_IGN)
+            _signal(signal.SIGTERM, self._on_stop_signal)
+            _signal(signal.SIGQUIT, self._on_stop_signal)
+            _signal(signal.SIGCHLD, signal.SIG_DFL)
+            parent_pid = os.getppid()
+            # pid -> time the worker was started
+            workers = {}
+            # times at which restarts of crashed workers are allowed
+            restarts = []
+
+            while not self._stopping and os.getppid() == parent_pid:
+                now = time.time()
+                restarts = [when for when in restarts if when > now]
+                while len(workers) + len(restarts) < self.workers:
+                    pid = _fork()
+                    if pid == 0:
+                        self._run_worker()
+                    workers[pid] = now
+
+                pid, status = _reap()
+                if pid in workers:
+                    started = workers.pop(pid)
+                    if not self._stopping:
+                        log.warning('API worker died, restarting it', pid=pid, status=status)
+                        restarts.append(started + MIN_WORKER_LIFETIME)
+                    continue
+                _sleep(POLL_INTERVAL)
+
+            self._stop_workers(workers)
+        except BaseException:
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def _stop_workers(self, workers, timeout=5):
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+        deadline = time.time() + timeout
+        while workers and time.time() < deadline:
+            pid, _ = _reap()
+            if pid:
+                workers.pop(pid, None)
+            else:
+                _sleep(POLL_INTERVAL / 4)
+
+        for pid in workers:
+            try:
+                os.kill(pid, signal.SIGKILL)
+                _waitpid(pid, 0)
+            except OSError:
+                pass
+
+    def _run_worker(self):
+        """The body of a worker process, never returns"""
+        exit_code = 0
+        try:
+            gevent.reinit()
+            # Undo the handlers of the supervisor, SIGINT stays ignored so that
+            # a Ctrl-C in the terminal leaves the shutdown to the supervisor
+            _signal(signal.SIGTERM, signal.SIG_DFL)
+            _signal(signal.SIGQUIT, signal.SIG_DFL)
+            supervisor_pid = os.getppid()
+            end_event = Event()
+            gevent.signal(signal.SIGTERM, end_event.set)
+            gevent.signal(signal.SIGQUIT, end_event.set)
+
+            if self.worker_init is not None:
+                self.worker_init(end_event)
+
+            server = NoDelayWSGIServer(
+                self.listener,
+                self.app,
+                spawn=self.pool_size or 'default',
+                log=log,
+                error_log=log,
+            )
+            server.start()
+            while not end_event.wait(timeout=POLL_INTERVAL):
+                if os.getppid() != supervisor_pid:
+                    break
+            end_event.set()
+            server.stop(timeout=5)
+        except BaseException:
+            log.exception('API worker failed')
+            exit_code = 1
+        finally:
+            os._exit(exit_code)
+
+    def stop(self, timeout=10):
+        """Stops the supervisor, which stops the workers"""
+        if self._watcher is not None:
+            self._watcher.kill()
+            self._watcher = None
+        if self.supervisor_pid:
+            try:
+                os.kill(self.supervisor_pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+            deadline = time.time() + timeout
+            while time.time() < deadline:
+                if _reap(self.supervisor_pid)[0]:
+                    break
+                gevent.sleep(POLL_INTERVAL / 4)
+            else:
+                # The workers notice it is gone and exit on their own
+                os.kill(self.supervisor_pid, signal.SIGKILL)
+                _waitpid(self.supervisor_pid, 0)
+            self.supervisor_pid = None
+        self.listener.close()
@@ -1,17 +1,30 @@
 import gevent
 import gevent.monkey
 gevent.monkey.patch_all()
+import json
+import os
 import sys
 import click
 import signal
 
+from sikorka import metrics, tracing
 from sikorka.utils import address_decoder, address_encoder
-from sikorka.accounts import AccountManager, Account
+from sikorka.accounts import AccountManager, SignatureCache, unlock_account
+from sikorka.loadtest import API_ROUTES, DETECTOR_FRAMINGS, run_loadtest
+from sikorka.profiler import Profiler
+from sikorka.ratelimit import RateLimiter
+from sikorka.signer import Signer
 from sikorka.service import Sikorka
 from sikorka.api.rest import APIServer
 from sikorka.api.api import RestAPI
-from sikorka.btserver import run_bt_server
-from sikorka.qrcodes import generate_qr_codes
+from sikorka.api.metrics import start_metrics_server
+from sikorka.detector import run_detector_server, parse_tcp_address, DETECTOR_TRANSPORTS
+from sikorka.qrcodes import (
+    generate_qr_codes,
+    QRCodeStore,
+    QR_RENDERERS,
+    QR_PAYLOAD_ENCODINGS,
+)
 
 
 SIKORKA_VERSION = '0.0.1'
@@ -69,6 +82,33 @@ OPTIONS = [
         default=5011,
         type=int,
     ),
+    click.option(
+        '--api-workers',
+        help=(
+            'Number of processes serving the Rest API. More than one forks '
+            'workers that share the API port, so signing can use several '
+            'cores.'),
+        default=1,
+        type=click.IntRange(min=1),
+    ),
+    click.option(
+        '--api-pool-size',
+        help=(
+            'Maximum number of connections each Rest API process serves at the '
+            'same time. 0 means no limit.'),
+        default=256,
+        type=click.IntRange(min=0),
+    ),
+    click.option(
+        '--metrics-port',
+        help=(
+            'Port to serve the metrics of the main process on, at /metrics. '
+            'With several API workers the API only reports those of the '
+            'worker that answered, the detector server metrics are only '
+            'served here.'),
+        default=None,
+        type=int,
+    ),
     click.option(
         '--rpc/--no-rpc',
         default=True,
@@ -79,16 +119,242 @@ OPTIONS = [
         default=False,
         help='Turn the Bluetooth server API on/off'
     ),
+    click.option(
+        '--detector-transport',
+        default='rfcomm',
+        help=(
+            'Transport over which the bluetooth server API is served. Use tcp '
+            'or unix to serve the same protocol without a bluetooth adapter.'),
+        type=click.Choice(DETECTOR_TRANSPORTS),
+    ),
+    click.option(
+        '--detector-address',
+        default='127.0.0.1:5012',
+        help=(
+            '"host:port" to listen on for the tcp detector transport or the '
+            'socket path for the unix one. Ignored for rfcomm.'),
+        type=str,
+    ),
     click.option(
         '--qrcodes/--no-qrcodes',
         default=False,
         help='Run a simple webserver generating signed timed QR codes'
     ),
+    click.option(
+        '--qrcode-period',
+        default=10,
+        help='Seconds after which the signed QR code is replaced with a new one',
+        type=int,
+    ),
+    click.option(
+        '--qrcode-format',
+        default='png',
+        help='Output format of the served QR code',
+        type=click.Choice(sorted(QR_RENDERERS)),
+    ),
+    click.option(
+        '--qrcode-encoding',
+        default='hex',
+        help=(
+            'How the signed message is stored in the QR code. alphanumeric '
+            'and bytes result in smaller codes but need a client that '
+            'understands them.'),
+        type=click.Choice(QR_PAYLOAD_ENCODINGS),
+    ),
+    click.option(
+        '--qrcode-lookahead',
+        default=3,
+        help='Number of upcoming QR codes to sign and render in advance',
+        type=int,
+    ),
+    click.option(
+        '--qrcode-max-streams',
+        default=128,
+        help=(
+            'Maximum number of QR code event streams each API process keeps '
+            'open. Every stream holds one of the --api-pool-size connections, '
+            'so keep it below that to leave room for signing requests.'),
+        type=click.IntRange(min=1),
+    ),
     click.option(
         '--bluetooth-device-name',
         default='Mock Detector',
         help='Device name for bluetooth server'
-    )
+    ),
+    click.option(
+        '--bluetooth-max-clients',
+        default=8,
+        help='Maximum number of bluetooth clients served at the same time',
+        type=int,
+    ),
+    click.option(
+        '--bluetooth-idle-timeout',
+        default=30,
+        help='Seconds of silence after which a bluetooth client is disconnected',
+        type=int,
+    ),
+    click.option(
+        '--registry-address',
+        help=(
+            'Address of a SikorkaRegistry contract. If given its contracts are '
+            'indexed locally and can be searched by location via the API.'),
+        default=None,
+        type=ADDRESS_TYPE,
+    ),
+    click.option(
+        '--registry-coordinate-scale',
+        help=(
+            'The registry stores coordinates as integers. This is what a '
+            'coordinate in degrees is multiplied with to get them.'),
+        default=10 ** 6,
+        type=int,
+    ),
+    click.option(
+        '--registry-poll-interval',
+        help='Seconds between checks for new registry events',
+        default=15,
+        type=int,
+    ),
+    click.option(
+        '--registry-snapshot',
+        help=(
+            'File to keep the registry index in. It is memory mapped on start '
+            'so a restart does not need to read the whole registry again.'),
+        default=None,
+        type=click.Path(dir_okay=False, writable=True),
+    ),
+    click.option(
+        '--registry-confirmations',
+        help=(
+            'Number of blocks for which registry changes can be rolled back '
+            'in case of a chain reorganization'),
+        default=12,
+        type=int,
+    ),
+    click.option(
+        '--signature-cache-size',
+        help=(
+            'Maximum number of signatures to remember so that repeated '
+            'requests for the same user and second are not signed again. '
+            'Use 0 to disable the cache.'),
+        default=1024,
+        type=int,
+    ),
+    click.option(
+        '--signature-cache-window',
+        help=(
+            'Number of seconds after its timestamp that a cached signature '
+            'is kept. Should match the seconds_allowed of the contract.'),
+        default=60,
+        type=int,
+    ),
+    click.option(
+        '--signer-threads',
+        help=(
+            'Number of native threads signatures are made in, so that signing '
+            'does not stall the rest of the node. 0 signs inline.'),
+        default=2,
+        type=int,
+    ),
+    click.option(
+        '--signer-max-pending',
+        help=(
+            'Maximum number of signatures waiting for the signer threads. '
+            'Requests beyond it are rejected as busy.'),
+        default=256,
+        type=int,
+    ),
+    click.option(
+        '--user-rate-limit',
+        help=(
+            'Signatures per second that can be requested for the same user '
+            'address over the API and bluetooth. 0 disables the limit.'),
+        default=2,
+        type=click.FloatRange(min=0),
+    ),
+    click.option(
+        '--user-rate-burst',
+        help='Signatures that can be requested for the same user address at once',
+        default=10,
+        type=click.IntRange(min=1),
+    ),
+    click.option(
+        '--peer-rate-limit',
+        help=(
+            'Signatures per second a single client host or bluetooth device '
+            'can request. 0 disables the limit.'),
+        default=50,
+        type=click.FloatRange(min=0),
+    ),
+    click.option(
+        '--peer-rate-burst',
+        help='Signatures a single client host or bluetooth device can request at once',
+        default=200,
+        type=click.IntRange(min=1),
+    ),
+    click.option(
+        '--rate-limit-size',
+        help=(
+            'Maximum number of users and of clients whose rate is tracked. '
+            'The least recently seen ones are forgotten first.'),
+        default=65536,
+        type=click.IntRange(min=1),
+    ),
+    click.option(
+        '--trace-file',
+        help=(
+            'File to write traces of sampled API requests and detector frames '
+            'to, in the Chrome trace event format. Tracing is off without it.'),
+        default=None,
+        type=click.Path(dir_okay=False, writable=True),
+    ),
+    click.option(
+        '--trace-sample-rate',
+        help='Share of the requests that are traced, between 0 and 1',
+        default=0.01,
+        type=click.FloatRange(0, 1),
+    ),
+    click.option(
+        '--trace-max-bytes',
+        help='Size of the trace file after which it is rotated',
+        default=tracing.DEFAULT_MAX_BYTES,
+        type=click.IntRange(min=1),
+    ),
+    click.option(
+        '--trace-backup-count',
+        help='Number of rotated trace files to keep',
+        default=tracing.DEFAULT_BACKUP_COUNT,
+        type=click.IntRange(min=0),
+    ),
+    click.option(
+        '--profile/--no-profile',
+        help=(
+            'Run the sampling profiler from the start. It can also be started '
+            'and stopped at any time by sending SIGUSR1.'),
+        default=False,
+    ),
+    click.option(
+        '--profile-output',
+        help=(
+            'Prefix of the files the profiler writes when stopped, followed by '
+            'the pid and the time it was started'),
+        default='sikorka-profile',
+        type=click.Path(dir_okay=False),
+    ),
+    click.option(
+        '--profile-interval',
+        help='Seconds between the stack samples of the profiler',
+        default=0.005,
+        type=click.FloatRange(min=0, min_open=True),
+    ),
+    click.option(
+        '--profile-block-threshold',
+        help=(
+            'Seconds a greenlet may run without switching before the profiler '
+            'reports it as blocking all others'),
+        default=0.1,
+        type=click.FloatRange(min=0),
+    ),
 ]
 
 
@@ -172,12 +438,36 @@ def prompt_account(address_hex, keystore_path, password_file):
 
 @options
 @click.command()
-def app(address, eth_rpc_endpoint, keystore_path, keyfile, passfile, **kwargs):
+def app(
+        address,
+        eth_rpc_endpoint,
+        keystore_path,
+        keyfile,
+        passfile,
+        signature_cache_size,
+        signature_cache_window,
+        signer_threads,
+        signer_max_pending,
+        trace_file,
+        trace_sample_rate,
+        trace_max_bytes,
+        trace_backup_count,
+        **kwargs):
+    if trace_file is not None:
+        tracing.configure(trace_file, trace_sample_rate, trace_max_bytes, trace_backup_count)
     address_hex = address_encoder(address) if address else None
     if keyfile is not None and passfile is not None:
-        unlocked_account = Account(keyfile, passfile)
+        unlocked_account, seconds = unlock_account(keyfile, passfile)
+        print('Unlocked {} in {:.2f}s'.format(keyfile, seconds))
     else:
         unlocked_account = prompt_account(address_hex, keystore_path, passfile)
+    if signature_cache_size > 0:
+        unlocked_account.signature_cache = SignatureCache(
+            size=signature_cache_size,
+            seconds_allowed=signature_cache_window,
+        )
+    if signer_threads > 0:
+        unlocked_account.signer = Signer(signer_threads, signer_max_pending)
     sikorka = Sikorka(eth_rpc_endpoint, unlocked_account)
     return sikorka
 
@@ -189,9 +479,103 @@ def run(ctx, rpc, bluetooth_server, qrcodes, **kwargs):
     if ctx.invoked_subcommand is None:
         print('Sikorka desktop client, version {}!'.format(SIKORKA_VERSION))
 
+        if rpc and kwargs['api_workers'] > 1 and kwargs['registry_snapshot']:
+            raise click.UsageError(
+                '--registry-snapshot can not be used with more than one API '
+                'worker, the workers would all write to the same snapshot'
+            )
+
         end_event = gevent.event.Event()
         sikorka_app = ctx.invoke(app, **kwargs)
-        sikorka_api = RestAPI(sikorka_app)
+        registry_follower = None
+        if kwargs['registry_address']:
+            registry_follower = sikorka_app.follow_registry(
+                kwargs['registry_address'],
+                kwargs['registry_coordinate_scale'],
+                kwargs['registry_confirmations'],
+                kwargs['registry_snapshot'],
+            )
+            print('Indexed {} contracts of the registry'.format(
+                len(sikorka_app.registry))
+            )
+        qrcode_store = QRCodeStore(kwargs['qrcode_period']) if qrcodes else None
+        rate_limiter = None
+        if kwargs['user_rate_limit'] > 0 or kwargs['peer_rate_limit'] > 0:
+            rate_limiter = RateLimiter(
+                kwargs['user_rate_limit'],
+                kwargs['user_rate_burst'],
+                kwargs['peer_rate_limit'],
+                kwargs['peer_rate_burst'],
+                kwargs['rate_limit_size'],
+            )
+        sikorka_api = RestAPI(
+            sikorka_app,
+            qrcode_store,
+            rate_limiter,
+            kwargs['qrcode_max_streams'],
+        )
+        api_workers = kwargs['api_workers'] if rpc else 1
+
+        def start_api_feeders(end_event):
+            """Spawns the greenlets keeping the state served by the API fresh"""
+            greenlets = []
+            if qrcodes:
+                greenlets.append(gevent.spawn(
+                    generate_qr_codes,
+                    end_event,
+                    sikorka_app.account,
+                    qrcode_store,
+                    kwargs['qrcode_format'],
+                    kwargs['qrcode_encoding'],
+                    kwargs['qrcode_lookahead'],
+                ))
+            if registry_follower:
+                greenlets.append(gevent.spawn(
+                    registry_follower.run,
+                    end_event,
+                    kwargs['registry_poll_interval'],
+                ))
+            return greenlets
+
+        def start_profiler(end_event):
+            """Sets up the profiler of this process, started and stopped by
+            SIGUSR1. A running profile is written when `end_event` is set."""
+            profiler = Profiler(
+                kwargs['profile_output'],
+                kwargs['profile_interval'],
+                kwargs['profile_block_threshold'],
+            )
+            gevent.signal(signal.SIGUSR1, profiler.toggle)
+            if kwargs['profile']:
+                profiler.start()
+
+            def stop_profiler():
+                end_event.wait()
+                if profiler.running:
+                    profiler.toggle()
+            return gevent.spawn(stop_profiler)
+
+        def init_api_worker(worker_end_event):
+            # Scrapes land on any of the workers, tells their samples apart
+            metrics.REGISTRY.set_const_labels(pid=os.getpid())
+            # The threads of the signer did not survive the fork
+            signer = sikorka_app.account.signer
+            if signer is not None:
+                sikorka_app.account.signer = Signer(signer.threads, signer.max_pending)
+            # Every worker keeps its own copy of the QR code and the registry
+            # index up to date. QR codes are signed for the same timestamps
+            # and signatures are deterministic, so all workers serve the same.
+            start_api_feeders(worker_end_event)
+            start_profiler(worker_end_event)
+            if kwargs['trace_file'] is not None:
+                # Rotating a file shared by several processes would lose traces
+                tracing.configure(
+                    '{}.{}'.format(kwargs['trace_file'], os.getpid()),
+                    kwargs['trace_sample_rate'],
+                    kwargs['trace_max_bytes'],
+                    kwargs['trace_backup_count'],
+                )
+
         if rpc:
             sikorka_rest_server = APIServer(
                 rest_api=sikorka_api,
@@ -199,22 +583,48 @@ def run(ctx, rpc, bluetooth_server, qrcodes, **kwargs):
                 eth_rpc_endpoint=kwargs['eth_rpc_endpoint'],
                 webui=qrcodes,
             )
-            sikorka_rest_server.start('localhost', kwargs['api_port'])
+            if api_workers > 1:
+                # Forks, so it has to come before any other greenlet is spawned
+                sikorka_rest_server.start_workers(
+                    api_workers,
+                    'localhost',
+                    kwargs['api_port'],
+                    kwargs['api_pool_size'],
+                    init_api_worker,
+                )
+            else:
+                sikorka_rest_server.start(
+                    'localhost',
+                    kwargs['api_port'],
+                    kwargs['api_pool_size'],
+                )
+
+        metrics_server = None
+        if kwargs['metrics_port'] is not None:
+            metrics_server = start_metrics_server('localhost', kwargs['metrics_port'])
+        elif api_workers > 1 and bluetooth_server:
+            print(
+                'The detector server metrics are not served by the API workers, '
+                'use --metrics-port to scrape them'
+            )
+
+        # Only now, the forked processes must not inherit a running profiler
+        profiler = start_profiler(end_event)
 
         if bluetooth_server:
             bt_server = gevent.spawn(
-                run_bt_server,
+                run_detector_server,
                 end_event,
+                kwargs['detector_transport'],
+                kwargs['detector_address'],
+                sikorka_app.account,
                 kwargs['bluetooth_device_name'],
-                sikorka_app.account
+                kwargs['bluetooth_max_clients'],
+                kwargs['bluetooth_idle_timeout'],
+                rate_limiter,
             )
 
-        if qrcodes:
-            qrcodes_greenlet = gevent.spawn(
-                generate_qr_codes,
-                end_event,
-                sikorka_app.account
-            )
+        feeders = start_api_feeders(end_event) if api_workers == 1 else []
 
         # wait for interrupt
         gevent.signal(signal.SIGQUIT, end_event.set)
@@ -225,8 +635,129 @@ def run(ctx, rpc, bluetooth_server, qrcodes, **kwargs):
         if bluetooth_server:
             bt_server.join()
 
-        if qrcodes:
-            qrcodes_greenlet.join()
+        gevent.joinall(feeders + [profiler])
 
         if rpc:
             sikorka_rest_server.stop()
+        if metrics_server is not None:
+            metrics_server.stop()
+
+
+def print_loadtest_report(report):
+    print('{:<24}{:>10}{:>8}{:>12}{:>10}{:>10}{:>10}{:>10}'.format(
+        'target', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'max ms',
+    ))
+    rows = list(report['targets'].items()) + [('total', report['total'])]
+    for target, summary in rows:
+        print('{:<24}{:>10}{:>8}{:>12.1f}{:>10}{:>10}{:>10}{:>10}'.format(
+            target,
+            summary['requests'],
+            summary['errors'],
+            summary['throughput'],
+            *('-' if summary[key] is None else '{:.2f}'.format(summary[key])
+              for key in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms'))
+        ))
+    for reason, count in report['total']['error_reasons'].items():
+        print('{:>8} x {}'.format(count, reason))
+
+
+@run.command()
+@click.option(
+    '--duration',
+    help='Seconds to run the load test for.',
+    default=10.0,
+    type=click.FloatRange(min=0, min_open=True),
+)
+@click.option(
+    '--rate',
+    help=(
+        'Requests per second sent by all clients together. 0 sends the next '
+        'request of a client as soon as it has the reply to the previous one.'),
+    default=0.0,
+    type=click.FloatRange(min=0),
+)
+@click.option(
+    '--api-url',
+    help='Base url of the Rest API, defaults to localhost on --api-port.',
+    default=None,
+    type=str,
+)
+@click.option(
+    '--api-clients',
+    help='Number of concurrent Rest API clients.',
+    default=4,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    '--api-route',
+    'api_routes',
+    help='Rest API route the clients request, can be given several times.',
+    default=API_ROUTES,
+    multiple=True,
+    type=click.Choice(API_ROUTES),
+)
+@click.option(
+    '--detector-clients',
+    help=(
+        'Number of concurrent detector protocol clients, connecting to '
+        '--detector-address over --detector-transport.'),
+    default=0,
+    type=click.IntRange(min=0),
+)
+@click.option(
+    '--detector-framing',
+    help='Version of the detector protocol the clients talk.',
+    default='binary',
+    type=click.Choice(DETECTOR_FRAMINGS),
+)
+@click.option(
+    '--users',
+    help=(
+        'Number of random user addresses signatures are requested for. Too '
+        'few of them run into the per user rate limit of the server.'),
+    default=10000,
+    type=click.IntRange(min=1),
+)
+@click.option(
+    '--timeout',
+    help='Seconds to wait for a reply before counting the request as failed.',
+    default=10.0,
+    type=click.FloatRange(min=0, min_open=True),
+)
+@click.option(
+    '--output',
+    help='Write the report as JSON to this file.',
+    default=None,
+    type=click.Path(dir_okay=False),
+)
+@click.pass_context
+def loadtest(ctx, api_url, api_clients, detector_clients, output, **kwargs):
+    """Load tests a running sikorka instance"""
+    instance = ctx.parent.params
+    if detector_clients and instance['detector_transport'] not in ('tcp', 'unix'):
+        raise click.UsageError(
+            'Detector clients need --detector-transport tcp or unix'
+        )
+    if detector_clients and instance['detector_transport'] == 'tcp':
+        try:
+            parse_tcp_address(instance['detector_address'])
+        except ValueError as e:
+            raise click.BadParameter(str(e), param_hint='--detector-address')
+    if api_clients + detector_clients == 0:
+        raise click.UsageError('The load test needs at least one client')
+    if api_url is None:
+        api_url = 'http://localhost:{}'.format(instance['api_port'])
+
+    report = run_loadtest(
+        api_url=api_url,
+        api_clients=api_clients,
+        detector_transport=instance['detector_transport'],
+        detector_address=instance['detector_address'],
+        detector_clients=detector_clients,
+        **kwargs
+    )
+    print_loadtest_report(report)
+    if output:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
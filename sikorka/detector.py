@@ -0,0 +1,364 @@
+import os
+import binascii
+import select
+import socket
+import stat
+import time
+from gevent.pool import Pool
+
+from sikorka.framing import (
+    FrameTooLarge,
+    LineFrameBuffer,
+    LengthPrefixedFrameBuffer,
+    length_prefixed,
+)
+from sikorka import metrics, tracing
+from sikorka.ratelimit import RateLimited
+from sikorka.signer import SignerBusy
+from sikorka.utils import address_decoder, address_encoder
+
+
+# How often blocking waits wake up to check if the server should shut down
+POLL_INTERVAL = 1
+# Largest request a client may send in a single frame
+MAX_FRAME_SIZE = 1024
+
+# Opcodes of the binary version of the protocol. The payload of every binary
+# frame starts with one of them followed by the opcode specific data.
+OP_ETH_ADDRESS = 0x01
+OP_SIGNED_MESSAGE = 0x02
+OP_AUTHORIZE_USER = 0x03
+OP_ERROR = 0xff
+
+DETECTOR_TRANSPORTS = ('rfcomm', 'tcp', 'unix')
+
+DETECTOR_CONNECTIONS = metrics.counter(
+    'sikorka_detector_connections',
+    'Clients accepted by the detector server',
+)
+DETECTOR_CLIENTS = metrics.gauge(
+    'sikorka_detector_clients',
+    'Clients currently connected to the detector server',
+)
+DETECTOR_FRAMES = metrics.counter(
+    'sikorka_detector_frames',
+    'Requests received by the detector server',
+    ['protocol'],
+)
+DETECTOR_RECEIVED_BYTES = metrics.counter(
+    'sikorka_detector_received_bytes',
+    'Bytes received from detector clients',
+)
+DETECTOR_SENT_BYTES = metrics.counter(
+    'sikorka_detector_sent_bytes',
+    'Bytes sent to detector clients',
+)
+
+
+def error_reply(message):
+    return 'ERROR::{}\r\nEND\r\n'.format(message).encode('utf-8')
+
+
+def detector_process(data, account, limiter=None, peer=None):
+    """Handles a single request of the text version of the detector protocol
+
+    :param bytes data: A request line without its line terminator. Can also
+                       be a memoryview over the receive buffer.
+    :param Account account: The account to sign with
+    :param RateLimiter limiter: Admits signing requests, if given
+    :param peer: The client the request came from, for the limiter
+    :return bytes: The reply to send back to the client or None if the
+                   request needs no reply
+    """
+    if data == b'ETH_ADDRESS':
+        return "ETH_ADDRESS::0x{}\r\nEND\r\n".format(account.address()).encode('utf-8')
+    elif data[:16] == b'SIGNED_MESSAGE::':
+        start = len(b'SIGNED_MESSAGE::')
+        try:
+            user_address_bin = address_decoder(
+                bytes(data[start:start + 42]).decode('utf-8')
+            )
+        except (ValueError, AssertionError):
+            return error_reply('Invalid user address')
+        try:
+            if limiter is not None:
+                limiter.admit(user_address_bin, peer)
+            message = account.create_signed_message(
+                address_encoder(user_address_bin),
+                int(time.time())
+            )
+        except RateLimited:
+            return error_reply('Rate limited')
+        except SignerBusy:
+            return error_reply('Busy')
+        return bytes(message)
+    elif data[:16] == b'AUTHORIZE_USER::':
+        start = len(b'AUTHORIZE_USER::')
+        user_address = data[start:start + 42]
+        # TODO Add a blockchain transaction here to authorize the user
+        return None
+
+    return error_reply('Unknown request')
+
+
+def binary_error_reply(message):
+    return length_prefixed(bytes([OP_ERROR]) + message.encode('utf-8'))
+
+
+def detector_process_binary(frame, account, limiter=None, peer=None):
+    """Handles a single request of the binary version of the detector protocol
+
+    Addresses and signed messages travel as raw bytes instead of hex text.
+    An OP_ETH_ADDRESS request has no data and is answered with the 20 byte
+    detector address. An OP_SIGNED_MESSAGE request carries the 20 byte user
+    address and is answered with the 93 byte signed message.
+
+    :param memoryview frame: The payload of a length prefixed frame
+    :param Account account: The account to sign with
+    :param RateLimiter limiter: Admits signing requests, if given
+    :param peer: The client the request came from, for the limiter
+    :return bytes: The length prefixed reply or None if the request needs
+                   no reply
+    """
+    if len(frame) == 0:
+        return binary_error_reply('Empty request')
+
+    opcode = frame[0]
+    if opcode == OP_ETH_ADDRESS:
+        return length_prefixed(
+            bytes([OP_ETH_ADDRESS]) + binascii.unhexlify(account.address())
+        )
+    elif opcode == OP_SIGNED_MESSAGE:
+        if len(frame) != 21:
+            return binary_error_reply('Invalid user address')
+        user_address_bin = bytes(frame[1:])
+        try:
+            if limiter is not None:
+                limiter.admit(user_address_bin, peer)
+            message = account.create_signed_message(
+                address_encoder(user_address_bin),
+                int(time.time())
+            )
+        except RateLimited:
+            return binary_error_reply('Rate limited')
+        except SignerBusy:
+            return binary_error_reply('Busy')
+        return length_prefixed(bytes([OP_SIGNED_MESSAGE]) + bytes(message))
+    elif opcode == OP_AUTHORIZE_USER:
+        # TODO Add a blockchain transaction here to authorize the user
+        return None
+
+    return binary_error_reply('Unknown request')
+
+
+def serve_detector(
+        end_event,
+        server_sock,
+        account,
+        max_clients=8,
+        idle_timeout=30,
+        limiter=None):
+    """Serves the detector protocol on an already listening server socket
+
+    Works with any socket object that can be given to select(), be it a
+    bluetooth RFCOMM, a TCP or a Unix domain socket. Keeps accepting clients
+    until `end_event` is set and serves each one in its own greenlet. At most
+    `max_clients` are served concurrently, the rest wait in the listen
+    backlog. A client that sends nothing for `idle_timeout` seconds is
+    disconnected. Signing requests are admitted by the `limiter`, if given.
+    """
+    clients = Pool(max_clients)
+    try:
+        while not end_event.is_set():
+            # Returns the number of free slots, 0 once the timeout passed
+            if not clients.wait_available(timeout=POLL_INTERVAL):
+                continue
+            ready = select.select([server_sock], [], [], POLL_INTERVAL)
+            if not ready[0]:
+                continue
+            client_sock, client_info = server_sock.accept()
+            clients.spawn(
+                serve_detector_client,
+                end_event,
+                client_sock,
+                client_info,
+                account,
+                idle_timeout,
+                limiter,
+            )
+    except IOError as e:
+        print("detector server error: {}".format(e))
+    finally:
+        server_sock.close()
+        # Clients notice the end_event within POLL_INTERVAL, anything still
+        # running after that is stuck and gets killed
+        clients.join(timeout=POLL_INTERVAL * 2)
+        clients.kill()
+    print("all done")
+
+
+def serve_detector_client(
+        end_event,
+        client_sock,
+        client_info,
+        account,
+        idle_timeout,
+        limiter=None):
+    """Serves a single client of the detector protocol
+
+    The framing is picked from the first byte the client sends. Text
+    requests never start with a NUL byte while the 2 byte length prefix of
+    a binary request always does, since requests are shorter than 256 bytes.
+    """
+    print("Accepted connection from ", client_info)
+    client_sock.setblocking(0)
+    # The host or bluetooth address, all Unix socket clients count as one
+    peer = client_info[0] if isinstance(client_info, tuple) else client_info
+    DETECTOR_CONNECTIONS.inc()
+    DETECTOR_CLIENTS.inc()
+
+    frames = None
+    last_activity = time.time()
+    try:
+        while not end_event.is_set():
+            ready = select.select([client_sock], [], [], POLL_INTERVAL)
+            if not ready[0]:
+                if time.time() - last_activity >= idle_timeout:
+                    break
+                continue
+
+            if frames is None:
+                data = client_sock.recv(MAX_FRAME_SIZE)
+                received = len(data)
+                if received == 0:
+                    break
+                if data[0] == 0:
+                    frames = LengthPrefixedFrameBuffer(MAX_FRAME_SIZE)
+                    process, make_error = detector_process_binary, binary_error_reply
+                    frame_counter = DETECTOR_FRAMES.labels('binary')
+                    trace_name = 'detector binary frame'
+                else:
+                    frames = LineFrameBuffer(MAX_FRAME_SIZE)
+                    process, make_error = detector_process, error_reply
+                    frame_counter = DETECTOR_FRAMES.labels('text')
+                    trace_name = 'detector text frame'
+                frames.feed(data)
+            else:
+                try:
+                    received = frames.receive(client_sock)
+                except FrameTooLarge as e:
+                    # The buffer is full without a complete frame in it
+                    client_sock.sendall(make_error(str(e)))
+                    break
+                if received == 0:
+                    break
+            DETECTOR_RECEIVED_BYTES.inc(received)
+            last_activity = time.time()
+
+            # All complete requests of this read are answered with one send.
+            # Frames are views into the receive buffer so they have to be
+            # processed before the next read. An oversized frame is answered
+            # with an error after the frames before it and ends the connection.
+            replies = []
+            too_large = None
+            try:
+                for frame in frames.frames():
+                    with tracing.trace(trace_name):
+                        replies.append(process(frame, account, limiter, peer))
+            except FrameTooLarge as e:
+                too_large = e
+            frame_counter.inc(len(replies))
+            if too_large is not None:
+                replies.append(make_error(str(too_large)))
+            replies = b''.join(reply for reply in replies if reply)
+            if replies:
+                client_sock.sendall(replies)
+                DETECTOR_SENT_BYTES.inc(len(replies))
+            if too_large is not None:
+                break
+
+    except IOError:
+        pass
+    finally:
+        DETECTOR_CLIENTS.dec()
+    print("detector client {} disconnected".format(client_info))
+
+    client_sock.close()
+
+
+def parse_tcp_address(address):
+    """Splits a "host:port" address, the host defaults to 127.0.0.1
+
+    :raises ValueError: If the port is missing or not a number
+    """
+    host, _, port = address.rpartition(':')
+    if not port.isdigit() or int(port) > 65535:
+        raise ValueError('Expected a "host:port" address, got {!r}'.format(address))
+    return host or '127.0.0.1', int(port)
+
+
+def create_tcp_server_socket(address, backlog):
+    """Creates a listening TCP socket out of a "host:port" address"""
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server_sock.bind(parse_tcp_address(address))
+    server_sock.listen(backlog)
+    return server_sock
+
+
+def create_unix_server_socket(path, backlog):
+    """Creates a listening Unix domain socket at the given path"""
+    if os.path.exists(path):
+        if not stat.S_ISSOCK(os.stat(path).st_mode):
+            raise ValueError('{} exists and is not a socket'.format(path))
+        # A stale socket left behind by a previous run
+        os.unlink(path)
+    server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server_sock.bind(path)
+    server_sock.listen(backlog)
+    return server_sock
+
+
+def run_detector_server(
+        end_event,
+        transport,
+        address,
+        account,
+        device_name,
+        max_clients=8,
+        idle_timeout=30,
+        limiter=None):
+    """Runs the detector protocol server over the chosen transport
+
+    :param str transport: One of DETECTOR_TRANSPORTS
+    :param str address: "host:port" for tcp, a filesystem path for unix.
+                        Ignored for rfcomm which always picks a free channel.
+    :param str device_name: The bluetooth service name. Only used for rfcomm.
+    """
+    if transport == 'rfcomm':
+        # Imported here so that pybluez is only needed for bluetooth
+        from sikorka.btserver import create_rfcomm_server_socket
+        server_sock = create_rfcomm_server_socket(device_name, max_clients)
+        if server_sock is None:
+            return
+    elif transport == 'tcp':
+        server_sock = create_tcp_server_socket(address, max_clients)
+        print("Waiting for connections on TCP %s:%d" % server_sock.getsockname())
+    elif transport == 'unix':
+        server_sock = create_unix_server_socket(address, max_clients)
+        print("Waiting for connections on %s" % address)
+    else:
+        raise ValueError('Unknown detector transport: {}'.format(transport))
+
+    try:
+        serve_detector(
+            end_event,
+            server_sock,
+            account,
+            max_clients,
+            idle_timeout,
+            limiter,
+        )
+    finally:
+        if transport == 'unix' and os.path.exists(address):
+            os.unlink(address)
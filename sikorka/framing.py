@@ -0,0 +1,165 @@
+import struct
+
+
+class FrameTooLarge(ValueError):
+    pass
+
+
+class FrameBuffer(object):
+    """Incrementally splits a byte stream received from a socket into frames
+
+    Data is received straight into one preallocated bytearray which is reused
+    for the lifetime of the connection. Complete frames are handed out as
+    memoryview slices of that buffer, so no bytes are copied on the way from
+    the socket to the protocol handler. A frame is only valid until the next
+    call to `receive()`, which may move the unconsumed tail to the front of
+    the buffer.
+
+    Subclasses define the framing by implementing `_next_frame()`.
+    """
+
+    def __init__(self, max_frame_size=1024):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray(max_frame_size)
+        self._view = memoryview(self._buffer)
+        # The unconsumed data lives in self._buffer[self._start:self._end]
+        self._start = 0
+        self._end = 0
+
+    def __len__(self):
+        return self._end - self._start
+
+    def _make_room(self):
+        if self._start == self._end:
+            self._on_compact(self._start)
+            self._start = self._end = 0
+            return
+
+        if self._start == 0:
+            if self._end == len(self._buffer):
+                raise FrameTooLarge(
+                    'Frame exceeds {} bytes'.format(self.max_frame_size)
+                )
+            return
+
+        # Move the unconsumed tail to the front once less than half of the
+        # buffer is left free, so reads do not shrink to a few bytes each
+        if self._end > len(self._buffer) // 2:
+            length = self._end - self._start
+            # Copy out first since source and destination may overlap
+            self._buffer[:length] = bytes(self._view[self._start:self._end])
+            self._on_compact(self._start)
+            self._start = 0
+            self._end = length
+
+    def _on_compact(self, offset):
+        pass
+
+    def receive(self, sock):
+        """Reads whatever the socket has available into the buffer
+
+        :return int: The number of bytes read. 0 means the peer disconnected.
+        """
+        self._make_room()
+        free = self._view[self._end:]
+        recv_into = getattr(sock, 'recv_into', None)
+        if recv_into is not None:
+            received = recv_into(free)
+        else:
+            data = sock.recv(len(free))
+            received = len(data)
+            free[:received] = data
+        self._end += received
+        return received
+
+    def feed(self, data):
+        """Appends already received data to the buffer"""
+        data = memoryview(data)
+        while data:
+            self._make_room()
+            free = self._view[self._end:]
+            chunk = min(len(free), len(data))
+            free[:chunk] = data[:chunk]
+            self._end += chunk
+            data = data[chunk:]
+            if data:
+                # Let the caller consume frames before more data can fit
+                raise FrameTooLarge(
+                    'Frame exceeds {} bytes'.format(self.max_frame_size)
+                )
+
+    def frames(self):
+        """Yields every complete frame currently in the buffer"""
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def _next_frame(self):
+        raise NotImplementedError()
+
+
+class LineFrameBuffer(FrameBuffer):
+    """Frames are lines terminated by '\\n' with an optional '\\r' before it.
+    The returned frames do not include the line terminator."""
+
+    def __init__(self, max_frame_size=1024):
+        super(LineFrameBuffer, self).__init__(max_frame_size)
+        # Where to resume looking for a newline so that a partial line is
+        # not scanned again every time more data arrives
+        self._scanned = 0
+
+    def _on_compact(self, offset):
+        self._scanned -= offset
+
+    def _next_frame(self):
+        search_from = max(self._start, self._scanned)
+        end = self._buffer.find(b'\n', search_from, self._end)
+        if end == -1:
+            self._scanned = self._end
+            return None
+
+        frame_end = end
+        if frame_end > self._start and self._buffer[frame_end - 1] == 13:  # '\r'
+            frame_end -= 1
+        frame = self._view[self._start:frame_end]
+        self._start = end + 1
+        self._scanned = self._start
+        return frame
+
+
+# A binary frame is a big endian unsigned short length followed by as many
+# bytes of payload
+LENGTH_PREFIX = struct.Struct('>H')
+
+
+class LengthPrefixedFrameBuffer(FrameBuffer):
+    """Frames are a 2 byte big endian length followed by the payload. The
+    returned frames are the payloads without the length prefix."""
+
+    def __init__(self, max_frame_size=1024):
+        super(LengthPrefixedFrameBuffer, self).__init__(
+            max_frame_size + LENGTH_PREFIX.size
+        )
+
+    def _next_frame(self):
+        available = self._end - self._start
+        if available < LENGTH_PREFIX.size:
+            return None
+
+        length, = LENGTH_PREFIX.unpack_from(self._buffer, self._start)
+        if length + LENGTH_PREFIX.size > len(self._buffer):
+            raise FrameTooLarge('Frame of {} bytes is too large'.format(length))
+        if available < LENGTH_PREFIX.size + length:
+            return None
+
+        payload_start = self._start + LENGTH_PREFIX.size
+        frame = self._view[payload_start:payload_start + length]
+        self._start = payload_start + length
+        return frame
+
+
+def length_prefixed(payload):
+    """Frames a payload for the length prefixed binary framing"""
+    return LENGTH_PREFIX.pack(len(payload)) + payload
@@ -0,0 +1,304 @@
+"""Load generator for a running sikorka instance
+
+Drives the Rest API and the detector protocol socket with concurrent
+clients, each one a greenlet with its own keep-alive connection, and
+records the latency of every request.
+
+With a target rate every client sends on a fixed schedule and latency is
+measured from the time a request was due, not from when it was actually
+sent. A server that falls behind thus shows up in the latency instead of
+silently lowering the rate. Without a rate every client sends its next
+request as soon as it has the reply to the previous one.
+"""
+import binascii
+import http.client
+import math
+import os
+import random
+import time
+from collections import Counter, OrderedDict
+from urllib.parse import urlsplit
+
+import gevent
+from gevent import socket
+
+from sikorka.detector import OP_ERROR, OP_SIGNED_MESSAGE, parse_tcp_address
+from sikorka.framing import LENGTH_PREFIX, length_prefixed
+
+API_ROUTES = ('address', 'detector_sign')
+DETECTOR_FRAMINGS = ('binary', 'text')
+PERCENTILES = (50, 95, 99)
+# User address, timestamp and signature
+SIGNED_MESSAGE_SIZE = 20 + 8 + 65
+TEXT_ERROR_PREFIX = b'ERROR::'
+
+
+def percentile(sorted_values, pct):
+    """The nearest rank percentile of already sorted values"""
+    if not sorted_values:
+        return None
+    rank = max(1, int(math.ceil(pct / 100 * len(sorted_values))))
+    return sorted_values[rank - 1]
+
+
+class LatencyStats(object):
+    """The latencies and errors of the requests to one target"""
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = Counter()
+
+    def record(self, seconds, error=None):
+        if error is None:
+            self.latencies.append(seconds)
+        else:
+            self.errors[error] += 1
+
+    def merge(self, other):
+        self.latencies.extend(other.latencies)
+        self.errors.update(other.errors)
+
+    def summary(self, elapsed):
+        """Throughput in successful requests per second and latency in
+        milliseconds over a run of `elapsed` seconds"""
+        latencies = sorted(self.latencies)
+        errors = sum(self.errors.values())
+        result = OrderedDict([
+            ('requests', len(latencies) + errors),
+            ('errors', errors),
+            ('throughput', len(latencies) / elapsed if elapsed > 0 else 0.0),
+        ])
+        for pct in PERCENTILES:
+            value = percentile(latencies, pct)
+            result['p{}_ms'.format(pct)] = None if value is None else value * 1000
+        result['max_ms'] = latencies[-1] * 1000 if latencies else None
+        result['error_reasons'] = OrderedDict(self.errors.most_common())
+        return result
+
+
+class APIClient(object):
+    """Sends requests to the Rest API over one keep-alive connection"""
+
+    def __init__(self, url, routes, user_addresses, timeout):
+        parts = urlsplit(url)
+        if parts.scheme != 'http':
+            raise ValueError('Only http:// API urls are supported')
+        if not routes:
+            raise ValueError('API clients need at least one route')
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 80
+        self.prefix = parts.path.rstrip('/') + '/api/1'
+        self.targets = ['api ' + route for route in routes]
+        self.user_addresses = user_addresses
+        self.timeout = timeout
+        self.connection = None
+
+    def request(self, target):
+        """Sends a request and reads the reply
+
+        :return str: The reason the request failed or None
+        """
+        if target == 'api address':
+            path = self.prefix + '/address'
+        else:
+            path = '{}/detector_sign/0x{}'.format(
+                self.prefix,
+                random.choice(self.user_addresses),
+            )
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(
+                self.host, self.port, timeout=self.timeout,
+            )
+        self.connection.request('GET', path)
+        response = self.connection.getresponse()
+        response.read()
+        if response.status != 200:
+            return 'HTTP {}'.format(response.status)
+        return None
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class DetectorClient(object):
+    """Asks the detector server for signed messages over one connection"""
+
+    def __init__(self, transport, address, framing, user_addresses, timeout):
+        if transport not in ('tcp', 'unix'):
+            raise ValueError('The load test supports the tcp and unix detector transports')
+        self.transport = transport
+        # Fails right away on an address the clients could never connect to
+        self.address = parse_tcp_address(address) if transport == 'tcp' else address
+        self.framing = framing
+        self.targets = ['detector ' + framing]
+        self.user_addresses = user_addresses
+        self.timeout = timeout
+        self.sock = None
+        self._received = b''
+
+    def _connect(self):
+        if self.transport == 'tcp':
+            sock = socket.create_connection(self.address, self.timeout)
+        else:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.address)
+        self.sock = sock
+        self._received = b''
+
+    def _receive(self, size):
+        """Reads until at least `size` bytes are buffered"""
+        while len(self._received) < size:
+            data = self.sock.recv(4096)
+            if not data:
+                raise ConnectionError('Detector server closed the connection')
+            self._received += data
+
+    def _take(self, size):
+        self._receive(size)
+        data, self._received = self._received[:size], self._received[size:]
+        return data
+
+    def request(self, target):
+        """Asks for a signed message and reads the reply
+
+        :return str: The reason the request failed or None
+        """
+        if self.sock is None:
+            self._connect()
+        user_address = random.choice(self.user_addresses)
+        if self.framing == 'binary':
+            self.sock.sendall(length_prefixed(
+                bytes([OP_SIGNED_MESSAGE]) + binascii.unhexlify(user_address)
+            ))
+            length, = LENGTH_PREFIX.unpack(self._take(LENGTH_PREFIX.size))
+            reply = self._take(length)
+            if reply[:1] == bytes([OP_ERROR]):
+                return 'detector ' + reply[1:].decode('utf-8', 'replace')
+            return None
+
+        self.sock.sendall('SIGNED_MESSAGE::0x{}\n'.format(user_address).encode('utf-8'))
+        # A signed message is sent as is and starts with the user address,
+        # errors are text ending in END and can be shorter than an address
+        self._receive(len(TEXT_ERROR_PREFIX))
+        if self._received[:len(TEXT_ERROR_PREFIX)] != TEXT_ERROR_PREFIX:
+            if self._take(SIGNED_MESSAGE_SIZE)[:20] != binascii.unhexlify(user_address):
+                return 'detector signed another address'
+            return None
+        while b'\r\nEND\r\n' not in self._received:
+            self._receive(len(self._received) + 1)
+        end = self._received.index(b'\r\nEND\r\n')
+        reply = self._take(end + len(b'\r\nEND\r\n'))
+        return 'detector ' + reply[len(TEXT_ERROR_PREFIX):end].decode('utf-8', 'replace')
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+def _drive(client, stats, start, offset, interval, deadline):
+    """Sends requests from one client until the deadline passes"""
+    due = start + offset
+    while True:
+        if interval:
+            now = time.perf_counter()
+            if due > now:
+                gevent.sleep(due - now)
+            sent_at = due
+            due += interval
+        else:
+            sent_at = time.perf_counter()
+        if sent_at >= deadline:
+            break
+
+        target = random.choice(client.targets)
+        try:
+            error = client.request(target)
+        except Exception as e:
+            # Connection errors and timeouts as well as replies the client
+            # could not make sense of, after which the connection may be out
+            # of step. Reconnects for the next request.
+            client.close()
+            error = type(e).__name__
+        stats[target].record(time.perf_counter() - sent_at, error)
+    client.close()
+
+
+def run_loadtest(
+        api_url='http://localhost:5011',
+        api_clients=4,
+        api_routes=API_ROUTES,
+        detector_transport='tcp',
+        detector_address='127.0.0.1:5012',
+        detector_clients=0,
+        detector_framing='binary',
+        rate=0,
+        duration=10,
+        users=10000,
+        timeout=10):
+    """Runs a load test against a sikorka instance
+
+    :param float rate: Requests per second of all clients together, 0
+                       for as many as they can make
+    :param int users: Number of random user addresses signatures are
+                      asked for. Mind the per user rate limit of the server.
+    :return dict: The configuration, and the throughput, latency and errors
+                  of every target and of all of them together
+    """
+    user_addresses = [
+        binascii.hexlify(os.urandom(20)).decode('utf-8') for _ in range(users)
+    ]
+    clients = [
+        APIClient(api_url, api_routes, user_addresses, timeout)
+        for _ in range(api_clients)
+    ] + [
+        DetectorClient(
+            detector_transport, detector_address, detector_framing,
+            user_addresses, timeout,
+        )
+        for _ in range(detector_clients)
+    ]
+    if not clients:
+        raise ValueError('The load test needs at least one client')
+
+    stats = OrderedDict()
+    for client in clients:
+        for target in client.targets:
+            stats.setdefault(target, LatencyStats())
+
+    # Spreads the clients evenly over the interval each of them sends at
+    interval = len(clients) / rate if rate else 0
+    start = time.perf_counter()
+    deadline = start + duration
+    gevent.joinall([
+        gevent.spawn(_drive, client, stats, start, idx / rate if rate else 0, interval, deadline)
+        for idx, client in enumerate(clients)
+    ])
+    elapsed = time.perf_counter() - start
+
+    total = LatencyStats()
+    for target_stats in stats.values():
+        total.merge(target_stats)
+    return OrderedDict([
+        ('config', OrderedDict([
+            ('api_url', api_url),
+            ('api_clients', api_clients),
+            ('api_routes', list(api_routes)),
+            ('detector_transport', detector_transport),
+            ('detector_address', detector_address),
+            ('detector_clients', detector_clients),
+            ('detector_framing', detector_framing),
+            ('rate', rate),
+            ('duration', duration),
+            ('users', users),
+        ])),
+        ('elapsed', elapsed),
+        ('targets', OrderedDict(
+            (target, target_stats.summary(elapsed))
+            for target, target_stats in stats.items()
+        )),
+        ('total', total.summary(elapsed)),
+    ])
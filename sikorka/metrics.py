@@ -0,0 +1,259 @@
+"""In-process metrics exported in the Prometheus text format
+
+Metrics are meant to be recorded from greenlets. gevent runs those one at a
+time, so recording is a plain attribute update without any locking. Code
+running in native threads should hand its measurements back to a greenlet.
+
+Every process has its own registry, with several API workers each of them
+reports its own numbers. Constant labels set on a registry, such as the pid
+of a worker, are added to all of its samples so that they can be told apart.
+"""
+import math
+import time
+from bisect import bisect_left
+
+# Upper bounds of the histogram buckets in seconds, from the time to sign a
+# message up to a slow keystore unlock
+DEFAULT_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"'))
+        for name, value in zip(names, values)
+    ) + '}'
+
+
+class CounterValue(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self, name, labels):
+        yield name + '_total' + labels, self.value
+
+
+class GaugeValue(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self, name, labels):
+        yield name + labels, self.value
+
+
+class HistogramValue(object):
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # Not cumulative, the last one counts the observations above all
+        # bucket bounds
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self):
+        """Context manager observing the seconds its block took"""
+        return _Timer(self)
+
+    def samples(self, name, labels):
+        inner = labels[1:-1] + ',' if labels else ''
+        cumulative = 0
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            yield '{}_bucket{{{}le="{}"}}'.format(name, inner, _format_value(bound)), cumulative
+        yield name + '_sum' + labels, self.sum
+        yield name + '_count' + labels, cumulative
+
+
+class _Timer(object):
+    __slots__ = ('histogram', 'start')
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class Metric(object):
+    """A named metric with a value per combination of label values
+
+    Without labels the metric itself can be recorded on, with labels the
+    value to record on is returned by `labels()`. Those should be looked up
+    once and kept where the labels are known up front.
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        if not self.labelnames:
+            self._value = self.labels()
+
+    def _new_value(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        value = self._values.get(values)
+        if value is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{} takes the labels {}'.format(self.name, self.labelnames))
+            value = self._values[values] = self._new_value()
+        return value
+
+    @property
+    def family_name(self):
+        """The name of the metric in its HELP and TYPE lines"""
+        return self.name
+
+    def render(self, const_labels=()):
+        """The lines of the metric in the text format
+
+        :param tuple const_labels: (name, value) pairs of labels to add to
+                                   every sample, before the own labels
+        """
+        lines = [
+            '# HELP {} {}'.format(self.family_name, self.documentation),
+            '# TYPE {} {}'.format(self.family_name, self.kind),
+        ]
+        const_names = tuple(name for name, _ in const_labels)
+        const_values = tuple(value for _, value in const_labels)
+        for values, value in sorted(self._values.items()):
+            labels = _format_labels(const_names + self.labelnames, const_values + values)
+            for sample, number in value.samples(self.name, labels):
+                lines.append('{} {}'.format(sample, _format_value(number)))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    @property
+    def family_name(self):
+        # Like prometheus_client, so that the HELP and TYPE lines name the
+        # samples they describe
+        return self.name + '_total'
+
+    def _new_value(self):
+        return CounterValue()
+
+    def inc(self, amount=1):
+        self._value.value += amount
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def _new_value(self):
+        return GaugeValue()
+
+    def inc(self, amount=1):
+        self._value.value += amount
+
+    def dec(self, amount=1):
+        self._value.value -= amount
+
+    def set(self, value):
+        self._value.value = value
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        super(Histogram, self).__init__(name, documentation, labelnames)
+
+    def _new_value(self):
+        return HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self._value.observe(value)
+
+    def time(self):
+        return self._value.time()
+
+
+class MetricsRegistry(object):
+    """The metrics of a process, rendered together for a scrape"""
+
+    def __init__(self):
+        self._metrics = {}
+        self.const_labels = ()
+
+    def set_const_labels(self, **labels):
+        """Sets labels added to every sample, replacing the previous ones"""
+        self.const_labels = tuple(sorted(labels.items()))
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError('Metric {} is already registered'.format(metric.name))
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """Returns all metrics in the Prometheus text exposition format"""
+        lines = []
+        for name in sorted(self._metrics):
+            lines.extend(self._metrics[name].render(self.const_labels))
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+# The registry all of sikorka records on
+REGISTRY = MetricsRegistry()
+counter = REGISTRY.counter
+gauge = REGISTRY.gauge
+histogram = REGISTRY.histogram
@@ -0,0 +1,195 @@
+import os
+import sys
+import time
+import traceback
+from collections import Counter
+
+import gevent
+import greenlet
+from gevent.monkey import get_original
+
+# The sampler is a real thread even when gevent monkey patched threading, so
+# that it keeps sampling while a greenlet hogs the hub
+_start_new_thread = get_original('_thread', 'start_new_thread')
+_get_ident = get_original('_thread', 'get_ident')
+_sleep = get_original('time', 'sleep')
+
+# Deepest stack kept per sample
+MAX_STACK_DEPTH = 64
+# Number of the longest blocking stretches whose stack is kept for the report
+MAX_BLOCKING_STACKS = 20
+
+
+def greenlet_name(glet):
+    """A name for a greenlet that is the same for all greenlets running the
+    same function, e.g. every request handler of the API"""
+    if glet is None:
+        return 'unknown'
+    if isinstance(glet, gevent.hub.Hub):
+        return 'Hub'
+    if glet.parent is None:
+        return 'main'
+    run = getattr(glet, '_run', None) or getattr(glet, 'run', None)
+    name = getattr(run, '__qualname__', None) or getattr(run, '__name__', None)
+    return '{}:{}'.format(type(glet).__name__, name) if name else type(glet).__name__
+
+
+def _frame_name(code):
+    return '{} ({}:{})'.format(
+        code.co_name,
+        os.path.basename(code.co_filename),
+        code.co_firstlineno,
+    )
+
+
+class Profiler(object):
+    """A sampling profiler for all greenlets of the process
+
+    A native thread looks at the stack the hub thread is executing every
+    `interval` seconds, which is the stack of whatever greenlet runs at the
+    time. Samples are counted per stack with the name of that greenlet as
+    the root frame and written in the collapsed stack format that
+    flamegraph.pl and speedscope read.
+
+    Every switch between greenlets is traced as well. A greenlet that ran
+    for longer than `block_threshold` seconds before switching kept all
+    others waiting, those are listed in a blocking report.
+
+    Has to be started and stopped on the thread running the hub.
+    """
+
+    def __init__(self, output, interval=0.005, block_threshold=0.1):
+        self.output = output
+        self.interval = interval
+        self.block_threshold = block_threshold
+        self.running = False
+        self._stopping = False
+        self._sampler_done = True
+        self._thread_id = None
+        self._previous_trace = None
+        self._reset()
+
+    def _reset(self):
+        self.samples = Counter()
+        self.started = None
+        self._current = None
+        self._switched_at = None
+        # greenlet name -> [times over the threshold, longest, total seconds]
+        self.blocking = {}
+        # (seconds, greenlet name, stack) of the longest stretches
+        self.blocking_stacks = []
+
+    def start(self):
+        if self.running:
+            return
+        while not self._sampler_done:
+            # The previous sampler thread has not noticed the stop yet
+            gevent.sleep(self.interval)
+        self._reset()
+        self.running = True
+        self._stopping = False
+        self._sampler_done = False
+        self.started = time.time()
+        self._thread_id = _get_ident()
+        self._current = greenlet.getcurrent()
+        self._switched_at = time.perf_counter()
+        self._previous_trace = greenlet.settrace(self._trace)
+        _start_new_thread(self._sample, ())
+
+    def stop(self):
+        """Stops profiling and writes the results
+
+        :return tuple: The paths of the collapsed stacks and of the
+                       blocking report
+        """
+        if not self.running:
+            return None
+        greenlet.settrace(self._previous_trace)
+        self._previous_trace = None
+        self._stopping = True
+        while not self._sampler_done:
+            gevent.sleep(self.interval)
+        self.running = False
+        return self.write()
+
+    def toggle(self):
+        if self.running:
+            paths = self.stop()
+            print('Profile written to {} and {}'.format(*paths))
+        else:
+            self.start()
+            print('Profiling, signal again to stop')
+
+    def _sample(self):
+        try:
+            while not self._stopping:
+                _sleep(self.interval)
+                frame = sys._current_frames().get(self._thread_id)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None and len(stack) < MAX_STACK_DEPTH:
+                    stack.append(_frame_name(frame.f_code))
+                    frame = frame.f_back
+                stack.append(greenlet_name(self._current))
+                stack.reverse()
+                self.samples[tuple(stack)] += 1
+        finally:
+            self._sampler_done = True
+
+    def _trace(self, event, args):
+        if event in ('switch', 'throw'):
+            origin, target = args
+            now = time.perf_counter()
+            ran = now - self._switched_at
+            if ran >= self.block_threshold and not isinstance(origin, gevent.hub.Hub):
+                self._record_blocking(origin, ran)
+            self._current = target
+            self._switched_at = time.perf_counter()
+        if self._previous_trace is not None:
+            self._previous_trace(event, args)
+
+    def _record_blocking(self, origin, seconds):
+        name = greenlet_name(origin)
+        stats = self.blocking.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] = max(stats[1], seconds)
+        stats[2] += seconds
+
+        if (len(self.blocking_stacks) < MAX_BLOCKING_STACKS or
+                seconds > self.blocking_stacks[-1][0]):
+            # Where the origin gave up the hub
+            frame = origin.gr_frame or sys._getframe(2)
+            stack = traceback.format_stack(frame, limit=MAX_STACK_DEPTH)
+            self.blocking_stacks.append((seconds, name, stack))
+            self.blocking_stacks.sort(key=lambda entry: entry[0], reverse=True)
+            del self.blocking_stacks[MAX_BLOCKING_STACKS:]
+
+    def write(self):
+        base = '{}-{}-{}'.format(self.output, os.getpid(), int(self.started))
+        collapsed_path = base + '.collapsed'
+        report_path = base + '.blocking.txt'
+
+        with open(collapsed_path, 'w') as f:
+            for stack, count in sorted(self.samples.items()):
+                f.write('{} {}\n'.format(';'.join(stack), count))
+
+        with open(report_path, 'w') as f:
+            f.write('Profiled {:.1f}s, {} samples, blocking threshold {:.0f}ms\n\n'.format(
+                time.time() - self.started,
+                sum(self.samples.values()),
+                self.block_threshold * 1000,
+            ))
+            if not self.blocking:
+                f.write('No greenlet held the hub longer than the threshold\n')
+            for name, (count, longest, total) in sorted(
+                    self.blocking.items(), key=lambda item: item[1][1], reverse=True):
+                f.write('{}: blocked {} times, longest {:.1f}ms, total {:.1f}ms\n'.format(
+                    name, count, longest * 1000, total * 1000,
+                ))
+            for seconds, name, stack in self.blocking_stacks:
+                f.write('\n{} held the hub for {:.1f}ms until\n{}'.format(
+                    name, seconds * 1000, ''.join(stack),
+                ))
+
+        return collapsed_path, report_path
@@ -1,24 +1,397 @@
 import gevent
+from gevent.event import Event
 import time
-import os
+import base64
 import binascii
+import json
+import struct
+import zlib
+from collections import namedtuple, deque
+from io import BytesIO
 import qrcode
+from qrcode.util import QRData, MODE_8BIT_BYTE
 from qrcode.image.pure import PymagingImage
 
+from sikorka import metrics
+from sikorka.signer import SignerBusy
 
-def generate_qr_codes(end_event, account):
 
-    while not end_event.is_set():
-        signed_bytes = account.create_qr_sign(int(time.time()))
-        signed_bytes = bytearray.fromhex('03') + signed_bytes
+QRCodeImage = namedtuple(
+    'QRCodeImage',
+    ['data', 'mimetype', 'timestamp', 'etag', 'message'],
+)
 
-        img = qrcode.make(
-            b'0x' + binascii.hexlify(signed_bytes),
-            image_factory=PymagingImage
+# Size in pixels of a single QR module and of the quiet zone around the symbol
+# in modules, same as the defaults of the qrcode library
+BOX_SIZE = 10
+BORDER = 4
+# Seconds to wait before signing an upcoming code again if the signer was busy
+SIGNER_BUSY_RETRY_INTERVAL = 0.1
+# Seconds after which an idle QR code stream gets a comment line, so that
+# proxies in between do not close it
+STREAM_KEEPALIVE_INTERVAL = 15
+
+QRCODE_RENDER_SECONDS = metrics.histogram(
+    'sikorka_qrcode_render_seconds',
+    'Seconds taken to sign and render a QR code',
+    ['format'],
+)
+QRCODE_SWAPS = metrics.counter(
+    'sikorka_qrcode_swaps',
+    'QR codes that went on display',
+)
+QRCODE_MISSED = metrics.counter(
+    'sikorka_qrcode_missed',
+    'QR codes that were ready too late to go on display',
+)
+
+
+class QRCodeStore(object):
+    """Holds the currently displayed signed QR code image in memory
+
+    The generator replaces the whole image in one assignment so readers
+    always see a complete image, never a half written one.
+
+    Streaming clients wait for `wait_for_update()`, which wakes all of them
+    at once when the generator stores the next code. The event they are
+    sent is encoded once per code and shared by all of them.
+    """
+
+    def __init__(self, period=10):
+        self.period = period
+        self.current = None
+        # Filled in by the QRCodeScheduler after every rotation
+        self.schedule_stats = None
+        self._updated = Event()
+        self._stream_events = {}
+
+    def update(self, data, mimetype, timestamp, message=None):
+        self.current = QRCodeImage(
+            data=data,
+            mimetype=mimetype,
+            timestamp=timestamp,
+            etag='qr-{}'.format(timestamp),
+            message=message,
+        )
+        self._stream_events = {}
+        updated, self._updated = self._updated, Event()
+        updated.set()
+
+    def wait_for_update(self, timeout=None):
+        """Blocks until the next code is stored, returns False on timeout"""
+        return self._updated.wait(timeout=timeout)
+
+    def stream_event(self, qrcode, with_image=False):
+        """The server-sent event announcing `qrcode`"""
+        key = (qrcode.etag, with_image)
+        event = self._stream_events.get(key)
+        if event is None:
+            event = encode_stream_event(qrcode, with_image)
+            if qrcode is self.current:
+                self._stream_events[key] = event
+        return event
+
+
+def encode_stream_event(qrcode, with_image=False):
+    """Encodes a code as a server-sent event with the timestamp as its id
+
+    The data is a JSON object with the timestamp and the hex encoded signed
+    message, plus the mimetype and the base64 encoded image `with_image`.
+    """
+    data = dict(
+        timestamp=qrcode.timestamp,
+        message=None if qrcode.message is None else '0x' + binascii.hexlify(
+            qrcode.message
+        ).decode('utf-8'),
+    )
+    if with_image:
+        data['mimetype'] = qrcode.mimetype
+        data['image'] = base64.b64encode(qrcode.data).decode('utf-8')
+    return 'id: {}\nevent: qrcode\ndata: {}\n\n'.format(
+        qrcode.timestamp,
+        json.dumps(data),
+    ).encode('utf-8')
+
+
+def stream_qrcodes(
+        store,
+        with_image=False,
+        last_event_id=None,
+        keepalive=STREAM_KEEPALIVE_INTERVAL):
+    """Yields the server-sent events of the current and all following codes
+
+    A client reconnecting with the id of the current code as `last_event_id`
+    only gets the ones that follow it.
+    """
+    last_timestamp = last_event_id
+    while True:
+        qrcode = store.current
+        if qrcode is not None and qrcode.timestamp != last_timestamp:
+            last_timestamp = qrcode.timestamp
+            yield store.stream_event(qrcode, with_image)
+            continue
+        if not store.wait_for_update(timeout=keepalive):
+            yield b': keep-alive\n\n'
+
+
+def encode_payload(signed_bytes, encoding='hex'):
+    """Encodes a signed message into the data stored in the QR code
+
+    - hex: '0x' prefixed lowercase hex, stored in byte mode. What clients
+      have always been reading.
+    - alphanumeric: '0X' prefixed uppercase hex. Every character is in the
+      QR alphanumeric set so it is stored with 5.5 instead of 8 bits each.
+    - bytes: the raw signed message stored in byte mode, the most compact.
+    """
+    if encoding == 'hex':
+        return b'0x' + binascii.hexlify(signed_bytes)
+    elif encoding == 'alphanumeric':
+        return '0X' + binascii.hexlify(signed_bytes).decode('utf-8').upper()
+    elif encoding == 'bytes':
+        return QRData(bytes(signed_bytes), mode=MODE_8BIT_BYTE)
+
+    raise ValueError('Unknown QR payload encoding: {}'.format(encoding))
+
+
+def make_qr_code(payload):
+    qr = qrcode.QRCode(box_size=BOX_SIZE, border=BORDER)
+    qr.add_data(payload)
+    qr.make(fit=True)
+    return qr
+
+
+def _png_chunk(chunk_type, data):
+    chunk = chunk_type + data
+    return (
+        struct.pack('>I', len(data)) + chunk +
+        struct.pack('>I', zlib.crc32(chunk) & 0xffffffff)
+    )
+
+
+def render_png(qr):
+    """Encodes the symbol as a 1 bit grayscale PNG
+
+    Every module row is turned into one packed scanline which is then
+    repeated BOX_SIZE times, so the work done in Python is proportional to
+    the number of modules and not the number of pixels.
+    """
+    matrix = qr.get_matrix()
+    width = len(matrix) * BOX_SIZE
+    row_bytes = (width + 7) // 8
+    raw = bytearray()
+    for row in matrix:
+        # dark modules are black which is 0 in grayscale
+        bits = ''.join('0' if module else '1' for module in row)
+        bits = ''.join(bit * BOX_SIZE for bit in bits)
+        bits = bits.ljust(row_bytes * 8, '1')
+        scanline = b'\x00' + int(bits, 2).to_bytes(row_bytes, 'big')
+        raw += scanline * BOX_SIZE
+
+    return b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, width, 1, 0, 0, 0, 0)),
+        _png_chunk(b'IDAT', zlib.compress(bytes(raw), 6)),
+        _png_chunk(b'IEND', b''),
+    ))
+
+
+def render_pymaging_png(qr):
+    """The pure python PNG encoder of the qrcode library"""
+    output = BytesIO()
+    qr.make_image(image_factory=PymagingImage).save(output)
+    return output.getvalue()
+
+
+def render_svg(qr):
+    """Encodes the symbol as an SVG with one path, one unit per module"""
+    matrix = qr.get_matrix()
+    size = len(matrix)
+    path = []
+    for y, row in enumerate(matrix):
+        x = 0
+        while x < size:
+            if not row[x]:
+                x += 1
+                continue
+            run_start = x
+            while x < size and row[x]:
+                x += 1
+            path.append('M{},{}h{}v1h-{}z'.format(run_start, y, x - run_start, x - run_start))
+
+    return (
+        '<svg xmlns="http://www.w3.org/2000/svg" viewBox="0 0 {0} {0}" '
+        'width="{1}" height="{1}" shape-rendering="crispEdges">'
+        '<rect width="{0}" height="{0}" fill="#fff"/>'
+        '<path d="{2}" fill="#000"/></svg>'
+    ).format(size, size * BOX_SIZE, ''.join(path)).encode('utf-8')
+
+
+def render_matrix_json(qr):
+    """The module matrix, quiet zone included, as one string of 0/1 per row"""
+    matrix = qr.get_matrix()
+    return json.dumps(dict(
+        size=len(matrix),
+        rows=[''.join('1' if module else '0' for module in row) for row in matrix],
+    )).encode('utf-8')
+
+
+def render_matrix_bytes(qr):
+    """The module matrix, quiet zone included, as a 2 byte big endian size
+    followed by the modules packed row major, most significant bit first"""
+    matrix = qr.get_matrix()
+    bits = ''.join('1' if module else '0' for row in matrix for module in row)
+    length = (len(bits) + 7) // 8
+    bits = bits.ljust(length * 8, '0')
+    return struct.pack('>H', len(matrix)) + int(bits, 2).to_bytes(length, 'big')
+
+
+QR_RENDERERS = {
+    'png': (render_png, 'image/png'),
+    'pymaging': (render_pymaging_png, 'image/png'),
+    'svg': (render_svg, 'image/svg+xml'),
+    'matrix-json': (render_matrix_json, 'application/json'),
+    'matrix-bytes': (render_matrix_bytes, 'application/octet-stream'),
+}
+
+QR_PAYLOAD_ENCODINGS = ('hex', 'alphanumeric', 'bytes')
+
+
+def render_qr_code(signed_bytes, renderer='png', encoding='hex'):
+    """Returns the rendered QR code of the signed message and its mimetype"""
+    render, mimetype = QR_RENDERERS[renderer]
+    qr = make_qr_code(encode_payload(signed_bytes, encoding))
+    return render(qr), mimetype
+
+
+class QRCodeScheduler(object):
+    """Pre-signs and pre-renders the QR codes of upcoming rotations
+
+    Codes are rotated on period boundaries (timestamps divisible by the
+    period) and each one is signed for the exact second it goes on display.
+    A background greenlet keeps the next `lookahead` codes signed and
+    rendered in a small ring, so that at every tick the only work left is
+    swapping the ready image into the store. How far ahead the ring is and
+    how late the swaps happen is published as `store.schedule_stats`.
+    """
+
+    def __init__(self, account, store, renderer='png', encoding='hex', lookahead=3):
+        if lookahead < 1:
+            raise ValueError('QR code lookahead must be at least 1')
+        self.account = account
+        self.store = store
+        self.renderer = renderer
+        self.encoding = encoding
+        self.lookahead = lookahead
+        self._render_seconds = QRCODE_RENDER_SECONDS.labels(renderer)
+        self.ring = deque()
+        self._space_available = Event()
+        self._code_ready = Event()
+        self._next_timestamp = None
+        self.swaps = 0
+        self.missed = 0
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self._total_jitter = 0.0
+
+    def render(self, timestamp):
+        with self._render_seconds.time():
+            signed_bytes = self.account.create_qr_sign(timestamp)
+            signed_bytes = bytearray.fromhex('03') + signed_bytes
+            data, mimetype = render_qr_code(signed_bytes, self.renderer, self.encoding)
+        return timestamp, data, mimetype, bytes(signed_bytes)
+
+    def _prerender(self, end_event):
+        while not end_event.is_set():
+            if len(self.ring) >= self.lookahead:
+                self._space_available.clear()
+                self._space_available.wait(timeout=self.store.period)
+                continue
+
+            now = time.time()
+            if self._next_timestamp <= now:
+                # Fell behind, there is no point rendering codes for ticks
+                # that have already passed
+                period = self.store.period
+                self._next_timestamp = (int(now) // period + 1) * period
+
+            try:
+                self.ring.append(self.render(self._next_timestamp))
+            except SignerBusy:
+                gevent.sleep(SIGNER_BUSY_RETRY_INTERVAL)
+                continue
+            self._next_timestamp += self.store.period
+            self._code_ready.set()
+            # Rendering is CPU bound, let other greenlets run in between
+            gevent.sleep(0)
+
+    def _swap(self, timestamp, data, mimetype, message):
+        self.store.update(data, mimetype, timestamp, message)
+        jitter = max(time.time() - timestamp, 0.0)
+        self.swaps += 1
+        QRCODE_SWAPS.inc()
+        self.last_jitter = jitter
+        self.max_jitter = max(self.max_jitter, jitter)
+        self._total_jitter += jitter
+        self.store.schedule_stats = self.stats()
+
+    def stats(self):
+        """How far ahead the schedule is and how late codes were swapped in"""
+        ready_until = self.ring[-1][0] if self.ring else None
+        return dict(
+            lookahead=self.lookahead,
+            ready=len(self.ring),
+            ready_until=ready_until,
+            seconds_ahead=max(ready_until - time.time(), 0) if ready_until else 0,
+            swaps=self.swaps,
+            missed=self.missed,
+            last_jitter_ms=self.last_jitter * 1000,
+            max_jitter_ms=self.max_jitter * 1000,
+            mean_jitter_ms=self._total_jitter * 1000 / self.swaps if self.swaps else 0,
         )
-        rootpath = os.path.dirname(os.path.abspath(__file__))
 
-        with open(os.path.join(rootpath, 'ui', 'static', 'qrcode.png'), 'wb') as f:
-            img.save(f)
+    def run(self, end_event):
+        period = self.store.period
+        # Show a code right away and start rotating on the next boundary.
+        # It is not on a tick so it does not count towards the jitter.
+        try:
+            timestamp, data, mimetype, message = self.render(int(time.time()))
+            self.store.update(data, mimetype, timestamp, message)
+        except SignerBusy:
+            # The first code just goes on display on the next boundary
+            pass
+        self.store.schedule_stats = self.stats()
+        self._next_timestamp = (int(time.time()) // period + 1) * period
+
+        prerender = gevent.spawn(self._prerender, end_event)
+        try:
+            while not end_event.is_set():
+                if not self.ring:
+                    self._code_ready.clear()
+                    self._code_ready.wait(timeout=period)
+                    continue
+
+                timestamp = self.ring[0][0]
+                delay = timestamp - time.time()
+                if delay > 0 and end_event.wait(timeout=delay):
+                    break
+
+                code = self.ring.popleft()
+                self._space_available.set()
+                if time.time() - timestamp >= period:
+                    # Its display window is already over
+                    self.missed += 1
+                    QRCODE_MISSED.inc()
+                    continue
+                self._swap(*code)
+        finally:
+            prerender.kill()
+
 
-        gevent.sleep(10)
+def generate_qr_codes(
+        end_event,
+        account,
+        store,
+        renderer='png',
+        encoding='hex',
+        lookahead=3):
+    QRCodeScheduler(account, store, renderer, encoding, lookahead).run(end_event)
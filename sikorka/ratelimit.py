@@ -0,0 +1,144 @@
+import math
+import time
+from collections import OrderedDict
+
+
+class RateLimited(Exception):
+    """Raised instead of signing for a client that is over its rate limit"""
+
+    def __init__(self, message, retry_after):
+        super(RateLimited, self).__init__(message)
+        # Seconds until the request would be admitted
+        self.retry_after = retry_after
+
+
+class TokenBuckets(object):
+    """A bounded table of token buckets, one per key
+
+    Every bucket holds up to `burst` tokens and is refilled with `rate`
+    tokens per second. Buckets are created full when a key is first seen.
+    When there are more than `size` buckets the least recently used one is
+    dropped, which at worst hands a key that comes back a full bucket again.
+    """
+
+    def __init__(self, rate, burst, size=65536, clock=time.monotonic):
+        if rate <= 0 or burst < 1:
+            raise ValueError('Token buckets need a positive rate and burst')
+        if size <= 0:
+            raise ValueError('Token bucket table size must be positive')
+        self.rate = rate
+        self.burst = burst
+        self.size = size
+        self.clock = clock
+        # key -> [tokens, time they were last refilled]
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def tokens(self, key, now=None):
+        """Returns the tokens the bucket of the key currently holds"""
+        now = self.clock() if now is None else now
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            return self.burst
+        return min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+
+    def wait_time(self, key, cost=1, now=None):
+        """Seconds until the bucket of the key holds `cost` tokens"""
+        missing = min(cost, self.burst) - self.tokens(key, now)
+        return max(missing, 0) / self.rate
+
+    def take(self, key, cost=1, now=None):
+        now = self.clock() if now is None else now
+        tokens = self.tokens(key, now) - cost
+        self._buckets[key] = [tokens, now]
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.size:
+            self._buckets.popitem(last=False)
+
+
+class RateLimiter(object):
+    """Admission control for the signing requests of the API and the detector
+
+    Every signature costs a token from the bucket of the user address it is
+    made for and one from the bucket of the peer that asked for it, which
+    is the remote host or bluetooth address of the client. Either limit is
+    disabled with a rate of 0. Rejected requests take no tokens.
+
+    A request for more signatures than the burst of a bucket still goes
+    through when the bucket is full, and empties it. The buckets are kept
+    in memory, so every API worker process limits on its own.
+    """
+
+    def __init__(
+            self,
+            user_rate=2,
+            user_burst=10,
+            peer_rate=50,
+            peer_burst=200,
+            size=65536,
+            clock=time.monotonic):
+        self.clock = clock
+        self.users = TokenBuckets(user_rate, user_burst, size, clock) if user_rate else None
+        self.peers = TokenBuckets(peer_rate, peer_burst, size, clock) if peer_rate else None
+        self.admitted = 0
+        self.rejected = 0
+
+    def _reject(self, buckets, key, cost, now):
+        self.rejected += 1
+        retry_after = max(1, math.ceil(buckets.wait_time(key, cost, now)))
+        raise RateLimited('Rate limit exceeded', retry_after)
+
+    def _take_peer(self, peer, cost, now):
+        if self.peers is None or peer is None or cost == 0:
+            return
+        if self.peers.tokens(peer, now) < min(cost, self.peers.burst):
+            self._reject(self.peers, peer, cost, now)
+        self.peers.take(peer, min(cost, self.peers.burst), now)
+
+    def admit(self, user_address, peer=None):
+        """Takes the tokens for signing for a single binary user address
+
+        :param peer: The client asking for it, None if unknown
+        :raises RateLimited: If the user or the peer is over its limit
+        """
+        now = self.clock()
+        if self.users is not None and self.users.tokens(user_address, now) < 1:
+            self._reject(self.users, user_address, 1, now)
+        self._take_peer(peer, 1, now)
+        if self.users is not None:
+            self.users.take(user_address, 1, now)
+        self.admitted += 1
+
+    def admit_batch(self, user_addresses, peer=None):
+        """Takes the tokens for signing for a batch of binary user addresses
+
+        The peer pays for the whole batch, while every user is limited on
+        its own so that one busy user does not fail the rest of the batch.
+
+        :return list: Whether each of the addresses was admitted
+        :raises RateLimited: If the peer is over its limit
+        """
+        now = self.clock()
+        self._take_peer(peer, len(user_addresses), now)
+        admitted = []
+        for user_address in user_addresses:
+            if self.users is None:
+                admitted.append(True)
+            elif self.users.tokens(user_address, now) < 1:
+                self.rejected += 1
+                admitted.append(False)
+            else:
+                self.users.take(user_address, 1, now)
+                admitted.append(True)
+        self.admitted += admitted.count(True)
+        return admitted
+
+    def stats(self):
+        return dict(
+            admitted=self.admitted,
+            rejected=self.rejected,
+            users=len(self.users) if self.users is not None else 0,
+            peers=len(self.peers) if self.peers is not None else 0,
+        )
@@ -0,0 +1,424 @@
+import heapq
+import math
+import binascii
+from collections import deque
+
+from sikorka import tracing
+from sikorka.accounts import sha3
+from sikorka.utils import address_decoder, address_encoder
+
+
+# The parts of the SikorkaRegistry contract ABI the client uses
+REGISTRY_ABI = [
+    {
+        'constant': True,
+        'inputs': [],
+        'name': 'getContractAddresses',
+        'outputs': [{'name': '', 'type': 'address[]'}],
+        'payable': False,
+        'stateMutability': 'view',
+        'type': 'function',
+    },
+    {
+        'constant': True,
+        'inputs': [],
+        'name': 'getContractCoordinates',
+        'outputs': [{'name': '', 'type': 'int256[]'}],
+        'payable': False,
+        'stateMutability': 'view',
+        'type': 'function',
+    },
+    {
+        'anonymous': False,
+        'inputs': [
+            {'indexed': False, 'name': 'contract_address', 'type': 'address'},
+            {'indexed': False, 'name': 'latitude', 'type': 'int256'},
+            {'indexed': False, 'name': 'longitude', 'type': 'int256'},
+        ],
+        'name': 'ContractAdded',
+        'type': 'event',
+    },
+    {
+        'anonymous': False,
+        'inputs': [
+            {'indexed': False, 'name': 'contract_address', 'type': 'address'},
+        ],
+        'name': 'ContractRemoved',
+        'type': 'event',
+    },
+]
+
+NULL_ADDRESS = b'\x00' * 20
+CONTRACT_ADDED_TOPIC = '0x' + binascii.hexlify(
+    sha3(b'ContractAdded(address,int256,int256)')
+).decode('utf-8')
+CONTRACT_REMOVED_TOPIC = '0x' + binascii.hexlify(
+    sha3(b'ContractRemoved(address)')
+).decode('utf-8')
+EARTH_RADIUS = 6371008.8  # mean earth radius in meters
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS / 180
+# Half the earth circumference. No two points are further apart than this.
+MAX_DISTANCE = math.pi * EARTH_RADIUS
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    """Great circle distance in meters between two points given in degrees"""
+    lat1, lon1, lat2, lon2 = map(math.radians, (lat1, lon1, lat2, lon2))
+    a = (
+        math.sin((lat2 - lat1) / 2) ** 2 +
+        math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+class RegistryIndex(object):
+    """In-memory spatial index of the contracts of a SikorkaRegistry
+
+    Contracts are bucketed in a grid of `cell_degrees` sized cells, so a
+    radius query only looks at the contracts of the cells overlapping the
+    bounding box of the search circle.
+
+    Coordinates are kept exactly as they are stored in the registry, as
+    integers which are `coordinate_scale` times the coordinate in degrees.
+    Distances are in meters.
+    """
+
+    def __init__(self, coordinate_scale=10 ** 6, cell_degrees=0.05):
+        self.coordinate_scale = coordinate_scale
+        self.cell_degrees = cell_degrees
+        self.lon_cells = int(math.ceil(360 / cell_degrees))
+        # binary address -> (latitude, longitude) as stored in the registry
+        self.contracts = {}
+        # (lat cell, lon cell) -> set of binary addresses
+        self.cells = {}
+        # (block number, block hash) up to which the index is known to be in
+        # sync with the registry, for indexes that outlive the process
+        self.synced = None
+
+    def __len__(self):
+        return len(self.contracts)
+
+    def __contains__(self, address):
+        return address in self.contracts
+
+    def get(self, address):
+        """Returns the coordinates of a contract or None if not indexed"""
+        return self.contracts.get(address)
+
+    def to_degrees(self, latitude, longitude):
+        return latitude / self.coordinate_scale, longitude / self.coordinate_scale
+
+    def _cell(self, lat_degrees, lon_degrees):
+        lat_cell = int(math.floor((lat_degrees + 90) / self.cell_degrees))
+        lon_cell = int(math.floor((lon_degrees + 180) / self.cell_degrees)) % self.lon_cells
+        return lat_cell, lon_cell
+
+    def _discard(self, address):
+        coordinates = self.contracts.pop(address, None)
+        if coordinates is None:
+            return None
+        cell = self._cell(*self.to_degrees(*coordinates))
+        bucket = self.cells[cell]
+        bucket.discard(address)
+        if not bucket:
+            del self.cells[cell]
+        return coordinates
+
+    def add(self, address, latitude, longitude):
+        """Adds or moves a contract. Coordinates as stored in the registry."""
+        self._discard(address)
+        self.contracts[address] = (latitude, longitude)
+        cell = self._cell(*self.to_degrees(latitude, longitude))
+        self.cells.setdefault(cell, set()).add(address)
+
+    def remove(self, address):
+        """Removes a contract, returns its coordinates or None if not indexed"""
+        return self._discard(address)
+
+    def clear(self):
+        self.contracts.clear()
+        self.cells.clear()
+
+    def load(self, contracts):
+        """Replaces all contracts with the given (address, lat, lon) ones"""
+        self.clear()
+        for address, latitude, longitude in contracts:
+            self.add(address, latitude, longitude)
+
+    def mark_synced(self, block_number, block_hash):
+        self.synced = (block_number, block_hash)
+
+    def _cell_box(self, lat, lon, radius):
+        """Returns the lat cells and the lon cells of the cells overlapping
+        the bounding box of the search circle"""
+        lat_span = radius / METERS_PER_DEGREE
+        min_lat = max(lat - lat_span, -90.0)
+        max_lat = min(lat + lat_span, 90.0)
+        # Longitude degrees get shorter towards the poles, so use the
+        # latitude of the box that is closest to a pole
+        cos_lat = math.cos(math.radians(max(abs(min_lat), abs(max_lat))))
+        if cos_lat <= 1e-9 or radius / (METERS_PER_DEGREE * cos_lat) >= 180:
+            lon_cells = range(self.lon_cells)
+        else:
+            lon_span = radius / (METERS_PER_DEGREE * cos_lat)
+            first = self._cell(lat, lon - lon_span)[1]
+            count = int(math.ceil(2 * lon_span / self.cell_degrees)) + 2
+            lon_cells = [
+                (first + i) % self.lon_cells for i in range(min(count, self.lon_cells))
+            ]
+
+        lat_cells = range(self._cell(min_lat, 0)[0], self._cell(max_lat, 0)[0] + 1)
+        return lat_cells, lon_cells
+
+    def _candidate_cell_keys(self, lat, lon, radius):
+        """Yields the (lat cell, lon cell) of every cell overlapping the
+        bounding box of the search circle"""
+        lat_cells, lon_cells = self._cell_box(lat, lon, radius)
+        for lat_cell in lat_cells:
+            for lon_cell in lon_cells:
+                yield lat_cell, lon_cell
+
+    def _candidate_cells(self, lat, lon, radius):
+        lat_cells, lon_cells = self._cell_box(lat, lon, radius)
+        if len(lat_cells) * len(lon_cells) > len(self.cells):
+            # A wide search over a sparse index, going through the occupied
+            # cells is cheaper than looking up every cell of the box
+            for bucket in self.cells.values():
+                if bucket:
+                    yield bucket
+            return
+
+        for key in self._candidate_cell_keys(lat, lon, radius):
+            bucket = self.cells.get(key)
+            if bucket:
+                yield bucket
+
+    def within(self, latitude, longitude, radius):
+        """Returns the contracts within `radius` meters of the given point
+
+        :param float latitude: In degrees
+        :param float longitude: In degrees
+        :return list: (distance, address, latitude, longitude) tuples sorted
+                      by distance. Coordinates as stored in the registry.
+        """
+        result = []
+        for bucket in self._candidate_cells(latitude, longitude, radius):
+            for address in bucket:
+                contract_lat, contract_lon = self.contracts[address]
+                distance = haversine(
+                    latitude,
+                    longitude,
+                    *self.to_degrees(contract_lat, contract_lon)
+                )
+                if distance <= radius:
+                    result.append((distance, address, contract_lat, contract_lon))
+        result.sort()
+        return result
+
+    def nearest(self, latitude, longitude, k, max_radius=MAX_DISTANCE):
+        """Returns the k contracts closest to the given point
+
+        Searches within a radius that doubles until at least k contracts are
+        found. Everything within the radius is found, so the k closest of
+        them are the k closest overall.
+        """
+        radius = self.cell_degrees * METERS_PER_DEGREE
+        while True:
+            radius = min(radius, max_radius)
+            found = self.within(latitude, longitude, radius)
+            if len(found) >= k or radius >= max_radius:
+                return heapq.nsmallest(k, found)
+            radius *= 2
+
+
+def registry_contract(web3, registry_address):
+    return web3.eth.contract(
+        abi=REGISTRY_ABI,
+        address=address_encoder(registry_address),
+    )
+
+
+def load_registry(contract, index):
+    """Reads all contracts of a SikorkaRegistry into a RegistryIndex
+
+    Removed contracts are left zeroed out in the registry and are skipped.
+    """
+    addresses = contract.call().getContractAddresses()
+    coordinates = contract.call().getContractCoordinates()
+    contracts = []
+    for i, address in enumerate(addresses):
+        address = address_decoder(address)
+        if address == NULL_ADDRESS:
+            continue
+        contracts.append((address, coordinates[2 * i], coordinates[2 * i + 1]))
+    index.load(contracts)
+    return index
+
+
+def _to_int(value):
+    """JSON-RPC quantities may come hex encoded or already decoded"""
+    if isinstance(value, int):
+        return value
+    return int(value, 16)
+
+
+def _to_hex(value):
+    if isinstance(value, str):
+        return value.lower()
+    return '0x' + binascii.hexlify(value).decode('utf-8')
+
+
+def _decode_words(data):
+    data = _to_hex(data)[2:]
+    return [binascii.unhexlify(data[i:i + 64]) for i in range(0, len(data), 64)]
+
+
+def _decode_int256(word):
+    return int.from_bytes(word, 'big', signed=True)
+
+
+class RegistryFollower(object):
+    """Keeps a RegistryIndex in sync with a SikorkaRegistry by following its
+    ContractAdded and ContractRemoved events
+
+    The registry is read in full once, after that only the event logs of
+    new blocks are fetched and applied. For the last `confirmations` blocks
+    every applied change is journaled along with how to undo it, and the
+    hash of every block a sync stopped at is remembered. Each sync first
+    checks those hashes against the chain and after a reorg rolls the index
+    back to the newest block that is still part of the chain. Reorgs deeper
+    than `confirmations` blocks are handled by reading the whole registry
+    again.
+    """
+
+    # Largest block range requested in a single eth_getLogs call
+    MAX_BLOCK_RANGE = 1000
+
+    def __init__(self, web3, registry_address, index, confirmations=12):
+        self.web3 = web3
+        self.registry_address = registry_address
+        self.index = index
+        self.confirmations = confirmations
+        # (block number, block hash) of the blocks previous syncs stopped at,
+        # the last one being the last processed block
+        self.sync_points = deque()
+        # (block number, [(address, coordinates before the change)]) of the
+        # processed blocks after the oldest sync point that had events
+        self.journal = deque()
+        if index.synced is not None:
+            # The index was restored from disk, continue from where it was
+            self.sync_points.append(index.synced)
+
+    @property
+    def last_block(self):
+        return self.sync_points[-1][0] if self.sync_points else None
+
+    def _block_hash(self, block_number):
+        block = self.web3.eth.getBlock(block_number)
+        # After a reorg to a shorter chain the block may not exist anymore
+        return _to_hex(block['hash']) if block else None
+
+    def _add_sync_point(self, block_number):
+        block_hash = self._block_hash(block_number)
+        self.sync_points.append((block_number, block_hash))
+        self.index.mark_synced(block_number, block_hash)
+        # Keep the newest sync point that is old enough to be final so that
+        # there is always something to roll back to within the window
+        final_block = block_number - self.confirmations
+        while len(self.sync_points) > 1 and self.sync_points[1][0] <= final_block:
+            self.sync_points.popleft()
+        while self.journal and self.journal[0][0] <= self.sync_points[0][0]:
+            self.journal.popleft()
+
+    def bootstrap(self):
+        """Reads the whole registry into the index"""
+        block_number = self.web3.eth.blockNumber
+        load_registry(registry_contract(self.web3, self.registry_address), self.index)
+        self.journal.clear()
+        self.sync_points.clear()
+        self._add_sync_point(block_number)
+
+    def _get_logs(self, from_block, to_block):
+        return self.web3.manager.request_blocking('eth_getLogs', [{
+            'fromBlock': hex(from_block),
+            'toBlock': hex(to_block),
+            'address': address_encoder(self.registry_address),
+            'topics': [[CONTRACT_ADDED_TOPIC, CONTRACT_REMOVED_TOPIC]],
+        }])
+
+    def _apply(self, log):
+        """Applies an event log to the index and returns how to undo it"""
+        words = _decode_words(log['data'])
+        address = words[0][-20:]
+        before = self.index.get(address)
+        topic = _to_hex(log['topics'][0])
+        if topic == CONTRACT_ADDED_TOPIC:
+            self.index.add(address, _decode_int256(words[1]), _decode_int256(words[2]))
+        elif topic == CONTRACT_REMOVED_TOPIC:
+            self.index.remove(address)
+        return address, before
+
+    def rollback(self, to_block):
+        """Undoes the changes of all journaled blocks after to_block"""
+        while self.journal and self.journal[-1][0] > to_block:
+            _, changes = self.journal.pop()
+            for address, before in reversed(changes):
+                if before is None:
+                    self.index.remove(address)
+                else:
+                    self.index.add(address, *before)
+        while self.sync_points and self.sync_points[-1][0] > to_block:
+            self.sync_points.pop()
+        if self.sync_points:
+            self.index.mark_synced(*self.sync_points[-1])
+
+    def _handle_reorg(self):
+        """Rolls back to the newest sync point still on the chain
+
+        :return bool: False if no sync point is left and a bootstrap is needed
+        """
+        for block_number, block_hash in reversed(self.sync_points):
+            if self._block_hash(block_number) == block_hash:
+                self.rollback(block_number)
+                return True
+        return False
+
+    def sync(self):
+        """Applies the events of all blocks mined since the last sync
+
+        :return int: The number of events applied
+        """
+        if not self.sync_points or not self._handle_reorg():
+            self.bootstrap()
+            return 0
+
+        head = self.web3.eth.blockNumber
+        applied = 0
+        last_block = self.last_block
+        while last_block < head:
+            from_block = last_block + 1
+            to_block = min(head, from_block + self.MAX_BLOCK_RANGE - 1)
+            logs = sorted(
+                self._get_logs(from_block, to_block),
+                key=lambda log: (_to_int(log['blockNumber']), _to_int(log['logIndex'])),
+            )
+            for log in logs:
+                block_number = _to_int(log['blockNumber'])
+                if not self.journal or self.journal[-1][0] != block_number:
+                    self.journal.append((block_number, []))
+                self.journal[-1][1].append(self._apply(log))
+                applied += 1
+            last_block = to_block
+
+        if last_block != self.last_block:
+            self._add_sync_point(last_block)
+        return applied
+
+    def run(self, end_event, poll_interval=15):
+        while not end_event.is_set():
+            try:
+                with tracing.trace('registry sync'):
+                    self.sync()
+            except (IOError, ValueError) as e:
+                print('Registry sync failed: {}'.format(e))
+            end_event.wait(timeout=poll_interval)
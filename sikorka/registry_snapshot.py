@@ -0,0 +1,343 @@
+import os
+import sys
+import mmap
+import struct
+from bisect import bisect_left
+
+import gevent
+
+from sikorka.registry import RegistryIndex, haversine
+
+
+# File layout, all integers in native byte order:
+#
+# - HEADER, padded to HEADER_SIZE bytes
+# - latitudes:  int64 * count    \
+# - longitudes: int64 * count     } sorted by (cell key, address)
+# - addresses:  20 bytes * count /
+# - cell keys:  int64 * cells, sorted. key = lat cell * lon cells + lon cell
+# - cell starts: int64 * (cells + 1), index of each cell's first contract
+# - address order: uint32 * count, contract indexes sorted by address
+# - log: LOG_RECORDs appended as the index changes, until the next compaction
+#
+# Every section starts at a multiple of 8 bytes.
+MAGIC = b'SKREGIX1'
+HEADER = struct.Struct('=8s8sqdqqq32s20s')
+HEADER_SIZE = 128
+LOG_RECORD = struct.Struct('=B20sqqq32s')
+LOG_ADD = 1
+LOG_REMOVE = 2
+LOG_SYNC = 3
+BYTEORDER = sys.byteorder.encode('ascii').ljust(8, b'\x00')
+
+
+def _aligned(size):
+    return (size + 7) // 8 * 8
+
+
+class MappedRegistryIndex(RegistryIndex):
+    """A RegistryIndex backed by a memory-mapped snapshot file
+
+    The snapshot holds the contracts in flat arrays sorted by grid cell,
+    along with a directory of the cells and a list of the contracts sorted
+    by address, so opening it only maps the file. Queries binary search the
+    mapped arrays directly and the contracts are never loaded into Python
+    objects.
+
+    Changes made after the snapshot was written are kept in the in-memory
+    index of the parent class and appended to a log at the end of the file,
+    which is replayed on open. Once the log grows past a fraction of the
+    snapshot the two are merged into a new snapshot file which atomically
+    replaces the old one. New snapshots are written in the threadpool of the
+    hub, queries keep being answered from the old one in the meantime.
+    """
+
+    def __init__(self, path, coordinate_scale=10 ** 6, cell_degrees=0.05, source=b''):
+        super(MappedRegistryIndex, self).__init__(coordinate_scale, cell_degrees)
+        self.path = path
+        # What the contracts were read from, usually the registry address.
+        # A snapshot of something else is discarded.
+        self.source = source
+        self._mmap = None
+        self._log = None
+        self._release_base()
+        self.log_records = 0
+        # Addresses of snapshot contracts that were removed or moved since
+        self._shadowed = set()
+
+        if os.path.exists(path) and self._map():
+            self._replay_log()
+        else:
+            self._write_snapshot([], None)
+            self._map()
+        self._log = open(self.path, 'ab')
+
+    def _release_base(self):
+        for view in ('_lats', '_lons', '_addresses', '_cell_keys', '_cell_starts', '_order'):
+            current = getattr(self, view, None)
+            if current is not None:
+                current.release()
+            setattr(self, view, None)
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self.base_count = 0
+        self.log_offset = HEADER_SIZE
+
+    def _map(self):
+        """Maps the snapshot file. Returns False if it is not usable."""
+        with open(self.path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER_SIZE:
+                return False
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = HEADER.unpack_from(mapped, 0)
+        magic, byteorder, scale, cell_degrees, count, cells, block, block_hash, source = header
+        if (magic != MAGIC or byteorder != BYTEORDER or
+                scale != self.coordinate_scale or cell_degrees != self.cell_degrees or
+                source != self.source.ljust(20, b'\x00')):
+            # Written by another version, machine or configuration
+            mapped.close()
+            return False
+
+        view = memoryview(mapped)
+        offset = HEADER_SIZE
+        sections = []
+        for length, item_format in (
+                (8 * count, 'q'),
+                (8 * count, 'q'),
+                (20 * count, None),
+                (8 * cells, 'q'),
+                (8 * (cells + 1), 'q'),
+                (4 * count, 'I')):
+            section = view[offset:offset + length]
+            sections.append(section.cast(item_format) if item_format else section)
+            offset += _aligned(length)
+        view.release()
+
+        self._mmap = mapped
+        (self._lats, self._lons, self._addresses,
+         self._cell_keys, self._cell_starts, self._order) = sections
+        self.base_count = count
+        self.log_offset = offset
+        self.synced = (block, '0x' + block_hash.hex()) if block >= 0 else None
+        return True
+
+    def _replay_log(self):
+        log_size = len(self._mmap) - self.log_offset
+        complete = log_size - log_size % LOG_RECORD.size
+        for offset in range(self.log_offset, self.log_offset + complete, LOG_RECORD.size):
+            op, address, lat, lon, block, block_hash = LOG_RECORD.unpack_from(
+                self._mmap, offset
+            )
+            if op == LOG_ADD:
+                self._add(address, lat, lon)
+            elif op == LOG_REMOVE:
+                self._remove(address)
+            elif op == LOG_SYNC:
+                self.synced = (block, '0x' + block_hash.hex())
+            self.log_records += 1
+
+        if complete != log_size:
+            # Drop a record that was only partially written before a crash
+            with open(self.path, 'r+b') as f:
+                f.truncate(self.log_offset + complete)
+
+    def _append_log(self, op, address=b'', lat=0, lon=0, block=0, block_hash=b''):
+        self._log.write(LOG_RECORD.pack(op, address, lat, lon, block, block_hash))
+        self.log_records += 1
+
+    def _base_position(self, address):
+        """Returns the index of an address in the snapshot arrays or None"""
+        low, high = 0, self.base_count
+        while low < high:
+            middle = (low + high) // 2
+            position = self._order[middle]
+            current = self._addresses[20 * position:20 * position + 20]
+            if current == address:
+                return position
+            if current.tobytes() < address:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def _base_get(self, address):
+        if address in self._shadowed:
+            return None
+        position = self._base_position(address)
+        if position is None:
+            return None
+        return self._lats[position], self._lons[position]
+
+    def __len__(self):
+        return self.base_count - len(self._shadowed) + len(self.contracts)
+
+    def __contains__(self, address):
+        return self.get(address) is not None
+
+    def get(self, address):
+        coordinates = self.contracts.get(address)
+        if coordinates is not None:
+            return coordinates
+        return self._base_get(address)
+
+    def _add(self, address, latitude, longitude):
+        if self._base_position(address) is not None:
+            self._shadowed.add(address)
+        super(MappedRegistryIndex, self).add(address, latitude, longitude)
+
+    def _remove(self, address):
+        coordinates = self._discard(address)
+        if coordinates is None:
+            coordinates = self._base_get(address)
+            if coordinates is not None:
+                self._shadowed.add(address)
+        return coordinates
+
+    def add(self, address, latitude, longitude):
+        self._add(address, latitude, longitude)
+        self._append_log(LOG_ADD, address, latitude, longitude)
+
+    def remove(self, address):
+        coordinates = self._remove(address)
+        if coordinates is not None:
+            self._append_log(LOG_REMOVE, address)
+        return coordinates
+
+    def clear(self):
+        self._rewrite([], None)
+
+    def load(self, contracts):
+        """Replaces all contracts with the given (address, lat, lon) ones by
+        writing them as a new snapshot, instead of logging every one of them"""
+        latest = {address: (lat, lon) for address, lat, lon in contracts}
+        self._rewrite([(address, lat, lon) for address, (lat, lon) in latest.items()], None)
+
+    def mark_synced(self, block_number, block_hash):
+        super(MappedRegistryIndex, self).mark_synced(block_number, block_hash)
+        self._append_log(
+            LOG_SYNC,
+            block=block_number,
+            block_hash=bytes.fromhex(block_hash[2:]) if block_hash else b'',
+        )
+        self._log.flush()
+        if self.log_records > max(1000, self.base_count // 10):
+            self.compact()
+
+    def _base_candidate_ranges(self, latitude, longitude, radius):
+        """Yields the (start, end) positions of the snapshot contracts in
+        every cell overlapping the bounding box of the search circle"""
+        lat_cells, lon_cells = self._cell_box(latitude, longitude, radius)
+        if len(lat_cells) * len(lon_cells) > len(self._cell_keys):
+            # Cheaper to go through every occupied cell
+            if self.base_count:
+                yield 0, self.base_count
+            return
+
+        for lat_cell in lat_cells:
+            for lon_cell in lon_cells:
+                key = lat_cell * self.lon_cells + lon_cell
+                cell = bisect_left(self._cell_keys, key)
+                if cell < len(self._cell_keys) and self._cell_keys[cell] == key:
+                    yield self._cell_starts[cell], self._cell_starts[cell + 1]
+
+    def within(self, latitude, longitude, radius):
+        result = super(MappedRegistryIndex, self).within(latitude, longitude, radius)
+        for start, end in self._base_candidate_ranges(latitude, longitude, radius):
+            for position in range(start, end):
+                contract_lat = self._lats[position]
+                contract_lon = self._lons[position]
+                distance = haversine(
+                    latitude,
+                    longitude,
+                    *self.to_degrees(contract_lat, contract_lon)
+                )
+                if distance > radius:
+                    continue
+                address = self._addresses[20 * position:20 * position + 20].tobytes()
+                if address not in self._shadowed:
+                    result.append((distance, address, contract_lat, contract_lon))
+        result.sort()
+        return result
+
+    def _live_contracts(self):
+        for position in range(self.base_count):
+            address = self._addresses[20 * position:20 * position + 20].tobytes()
+            if address not in self._shadowed:
+                yield address, self._lats[position], self._lons[position]
+        for address, (lat, lon) in self.contracts.items():
+            yield address, lat, lon
+
+    def _write_snapshot(self, contracts, synced):
+        """Writes the given (address, lat, lon) contracts as a new snapshot
+        and atomically replaces the current file with it"""
+        entries = []
+        for address, lat, lon in contracts:
+            lat_cell, lon_cell = self._cell(*self.to_degrees(lat, lon))
+            entries.append((lat_cell * self.lon_cells + lon_cell, address, lat, lon))
+        entries.sort()
+
+        cell_keys = []
+        cell_starts = []
+        for position, entry in enumerate(entries):
+            if not cell_keys or cell_keys[-1] != entry[0]:
+                cell_keys.append(entry[0])
+                cell_starts.append(position)
+        cell_starts.append(len(entries))
+        order = sorted(range(len(entries)), key=lambda position: entries[position][1])
+
+        block, block_hash = synced if synced else (-1, '0x')
+        sections = [
+            struct.pack('={}q'.format(len(entries)), *(entry[2] for entry in entries)),
+            struct.pack('={}q'.format(len(entries)), *(entry[3] for entry in entries)),
+            b''.join(entry[1] for entry in entries),
+            struct.pack('={}q'.format(len(cell_keys)), *cell_keys),
+            struct.pack('={}q'.format(len(cell_starts)), *cell_starts),
+            struct.pack('={}I'.format(len(order)), *order),
+        ]
+
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'wb') as f:
+            f.write(HEADER.pack(
+                MAGIC,
+                BYTEORDER,
+                self.coordinate_scale,
+                self.cell_degrees,
+                len(entries),
+                len(cell_keys),
+                block,
+                bytes.fromhex(block_hash[2:]),
+                self.source,
+            ).ljust(HEADER_SIZE, b'\x00'))
+            for section in sections:
+                f.write(section.ljust(_aligned(len(section)), b'\x00'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+
+    def _rewrite(self, contracts, synced):
+        """Writes the contracts as a new snapshot and switches over to it
+
+        The snapshot is written in a thread so that the hub keeps serving
+        while it is. The old file stays mapped until the new one replaced
+        it, so queries can still be answered from it, and the index must
+        not be changed before this returns.
+        """
+        gevent.get_hub().threadpool.apply(self._write_snapshot, (contracts, synced))
+        self._log.close()
+        self._release_base()
+        super(MappedRegistryIndex, self).clear()
+        self._shadowed.clear()
+        self.log_records = 0
+        self._map()
+        self._log = open(self.path, 'ab')
+
+    def compact(self):
+        """Merges the logged changes into a new snapshot"""
+        self._rewrite(self._live_contracts(), self.synced)
+
+    def close(self):
+        self._log.close()
+        self._release_base()
@@ -1,6 +1,8 @@
-import time
+from time import time as now
 from web3 import Web3, HTTPProvider, IPCProvider
-from sikorka.utils import address_encoder
+from sikorka import tracing
+from sikorka.registry import RegistryIndex, RegistryFollower
+from sikorka.registry_snapshot import MappedRegistryIndex
 
 
 class Sikorka(object):
@@ -11,18 +13,63 @@ class Sikorka(object):
                 self.web3 = Web3(HTTPProvider(eth_rpc_endpoint))
             except:
                 self.web3 = Web3(IPCProvider())
+            if tracing.enabled():
+                tracing.trace_web3(self.web3)
 
         self.account = unlocked_acc
+        self.registry = None
 
     def address(self):
         return self.account.address()
 
-    def sign_message_as_detector(self, user_address_bin, time=int(time.time())):
+    def sign_message_as_detector(self, user_address_bin, time=None):
         """Returns the required signed message as bytes"""
-        user_address = address_encoder(user_address_bin)
-        signed_bytes = self.account.create_signed_message(
-            user_address,
-            time
+        signed_bytes, = self.sign_messages_as_detector([user_address_bin], time)
+        return bytearray(signed_bytes)
+
+    def sign_messages_as_detector(self, user_addresses_bin, time=None):
+        """Returns a list with the signed message of each user as memoryviews
+
+        All messages are signed for the same timestamp so that a batch of
+        users detected together get proofs of presence for the same moment.
+        """
+        if time is None:
+            time = int(now())
+        with tracing.span('sign_messages_as_detector', count=len(user_addresses_bin)):
+            return self.account.create_signed_messages(
+                user_addresses_bin,
+                time,
+                prefix=b'\x01',
+            )
+
+    def follow_registry(
+            self,
+            registry_address,
+            coordinate_scale=10 ** 6,
+            confirmations=12,
+            snapshot_path=None):
+        """Loads the contracts of a SikorkaRegistry into a local spatial index
+
+        If a snapshot path is given the index is kept in that file and the
+        registry is only read in full when there is no usable snapshot yet.
+        Otherwise following resumes from the block the snapshot was synced at.
+
+        Returns the RegistryFollower that keeps the index up to date
+        """
+        if snapshot_path:
+            self.registry = MappedRegistryIndex(
+                snapshot_path,
+                coordinate_scale,
+                source=registry_address,
+            )
+        else:
+            self.registry = RegistryIndex(coordinate_scale)
+        follower = RegistryFollower(
+            self.web3,
+            registry_address,
+            self.registry,
+            confirmations,
         )
-        signed_bytes = bytearray.fromhex('01') + signed_bytes
-        return signed_bytes
+        if self.registry.synced is None:
+            follower.bootstrap()
+        return follower
@@ -0,0 +1,63 @@
+from gevent.threadpool import ThreadPool
+
+
+class SignerBusy(Exception):
+    """Raised when too many signatures are already waiting to be made"""
+
+
+class Signer(object):
+    """Makes the signatures of an Account on a bounded pool of native threads
+
+    Attached to an account as `account.signer`, every signature that is not
+    in the account's signature cache is computed in one of the threads while
+    only the greenlet that asked for it waits. The REST API, the detector
+    server and the QR code generator all sign with the same account and so
+    share the pool.
+
+    At most `max_pending` signatures may be waiting or in progress. Asking
+    for more raises SignerBusy right away instead of queueing up latency for
+    everyone else. A single request for more than `max_pending` signatures is
+    still accepted when nothing else is pending, so that big batches are not
+    rejected forever.
+    """
+
+    def __init__(self, threads=2, max_pending=256):
+        if threads < 1:
+            raise ValueError('The signer needs at least one thread')
+        self.threads = threads
+        self.max_pending = max_pending
+        self.pool = ThreadPool(threads)
+        self.pending = 0
+        self.signed = 0
+        self.rejected = 0
+
+    def run(self, func, count, *args):
+        """Runs func(*args) in the pool and waits for its result
+
+        :param int count: How many signatures func makes
+        """
+        if self.pending and self.pending + count > self.max_pending:
+            self.rejected += count
+            raise SignerBusy(
+                'Signer is busy with {} pending signatures'.format(self.pending)
+            )
+
+        self.pending += count
+        try:
+            result = self.pool.spawn(func, *args).get()
+        finally:
+            self.pending -= count
+        self.signed += count
+        return result
+
+    def stats(self):
+        return dict(
+            threads=self.threads,
+            max_pending=self.max_pending,
+            pending=self.pending,
+            signed=self.signed,
+            rejected=self.rejected,
+        )
+
+    def close(self):
+        self.pool.kill()
@@ -0,0 +1,242 @@
+"""Sampled per-request tracing written as Chrome trace events
+
+A trace follows one REST request or detector protocol frame through the
+code, with a span for every step worth measuring. Only `sample_rate` of
+them are recorded. Finished traces are appended to a local file in the
+JSON array variant of the Chrome trace event format, which chrome://tracing
+and https://ui.perfetto.dev open directly, closing bracket or not.
+
+Spans nest by time. Every trace gets its own row in the viewer, named
+after the trace and its id.
+
+    with tracing.trace('detector_sign'):
+        with tracing.span('sign'):
+            ...
+
+The current trace is kept per greenlet. Code running in native threads
+gets the trace handed over and records finished spans with `Trace.add()`.
+"""
+import itertools
+import json
+import os
+import random
+import time
+from gevent.local import local
+
+# Size of a trace file after which it is rotated, and the number of rotated
+# files that are kept
+DEFAULT_MAX_BYTES = 10 * 1024 * 1024
+DEFAULT_BACKUP_COUNT = 3
+
+_tracer = None
+_local = local()
+
+
+class TraceFileWriter(object):
+    """Appends trace events to a file, keeping `backup_count` rotated ones
+    as path.1, path.2 and so on"""
+
+    def __init__(self, path, max_bytes=DEFAULT_MAX_BYTES, backup_count=DEFAULT_BACKUP_COUNT):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self._file = None
+        self._size = 0
+
+    def _open(self):
+        self._file = open(self.path, 'a')
+        self._size = self._file.tell()
+        if self._size == 0:
+            self._file.write('[\n')
+            self._size = 2
+
+    def _rotate(self):
+        self._file.close()
+        self._file = None
+        if self.backup_count > 0:
+            for idx in range(self.backup_count - 1, 0, -1):
+                older = '{}.{}'.format(self.path, idx)
+                if os.path.exists(older):
+                    os.replace(older, '{}.{}'.format(self.path, idx + 1))
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self._open()
+
+    def write(self, events):
+        data = ''.join(
+            json.dumps(event, separators=(',', ':')) + ',\n' for event in events
+        )
+        if self._file is None:
+            self._open()
+        elif self._size + len(data) > self.max_bytes:
+            self._rotate()
+        self._file.write(data)
+        self._file.flush()
+        self._size += len(data)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class Trace(object):
+    """The spans recorded for one request"""
+
+    __slots__ = ('tracer', 'trace_id', 'tid', 'events')
+
+    def __init__(self, tracer, name):
+        self.tracer = tracer
+        self.trace_id = '{:016x}'.format(random.getrandbits(64))
+        self.tid = next(tracer.sequence)
+        self.events = [dict(
+            name='thread_name',
+            ph='M',
+            pid=tracer.pid,
+            tid=self.tid,
+            args=dict(name='{} {}'.format(name, self.trace_id)),
+        )]
+
+    def add(self, name, start, end, args=None):
+        """Records a span between two time.perf_counter() readings"""
+        event = dict(
+            name=name,
+            ph='X',
+            ts=round((self.tracer.epoch + start) * 10 ** 6, 1),
+            dur=round((end - start) * 10 ** 6, 1),
+            pid=self.tracer.pid,
+            tid=self.tid,
+        )
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+
+class Tracer(object):
+
+    def __init__(self, writer, sample_rate):
+        self.writer = writer
+        self.sample_rate = sample_rate
+        self.pid = os.getpid()
+        # Turns time.perf_counter() readings into wall clock time, so that the
+        # traces of several processes line up
+        self.epoch = time.time() - time.perf_counter()
+        self.sequence = itertools.count(1)
+
+
+class _NullSpan(object):
+    """What span() and trace() return when nothing is recorded"""
+
+    __slots__ = ()
+    trace = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span(object):
+
+    __slots__ = ('trace', 'name', 'args', 'start')
+
+    def __init__(self, trace, name, args):
+        self.trace = trace
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.trace.add(self.name, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class _RootSpan(_Span):
+    """The outermost span of a trace, which writes it when it ends"""
+
+    __slots__ = ()
+
+    def __enter__(self):
+        _local.trace = self.trace
+        return super(_RootSpan, self).__enter__()
+
+    def __exit__(self, *exc_info):
+        super(_RootSpan, self).__exit__(*exc_info)
+        _local.trace = None
+        self.trace.tracer.writer.write(self.trace.events)
+        return False
+
+
+def configure(
+        path,
+        sample_rate=0.01,
+        max_bytes=DEFAULT_MAX_BYTES,
+        backup_count=DEFAULT_BACKUP_COUNT):
+    """Starts recording `sample_rate` of all traces to the file at `path`"""
+    global _tracer
+    disable()
+    _tracer = Tracer(TraceFileWriter(path, max_bytes, backup_count), sample_rate)
+
+
+def disable():
+    global _tracer
+    if _tracer is not None:
+        _tracer.writer.close()
+    _tracer = None
+
+
+def enabled():
+    return _tracer is not None
+
+
+def current():
+    """The trace of the running greenlet or None"""
+    if _tracer is None:
+        return None
+    return getattr(_local, 'trace', None)
+
+
+def trace(name, **args):
+    """Starts a trace if this one is sampled, or a span if already in one"""
+    if _tracer is None:
+        return _NULL_SPAN
+    current_trace = getattr(_local, 'trace', None)
+    if current_trace is not None:
+        return _Span(current_trace, name, args)
+    if random.random() >= _tracer.sample_rate:
+        return _NULL_SPAN
+    return _RootSpan(Trace(_tracer, name), name, args)
+
+
+def span(name, **args):
+    """A span of the current trace, does nothing outside of a trace"""
+    if _tracer is None:
+        return _NULL_SPAN
+    current_trace = getattr(_local, 'trace', None)
+    if current_trace is None:
+        return _NULL_SPAN
+    return _Span(current_trace, name, args)
+
+
+def web3_middleware(make_request, web3):
+    """Records a span for every JSON RPC request made through web3"""
+    def middleware(method, params):
+        with span('rpc ' + method):
+            return make_request(method, params)
+    return middleware
+
+
+def trace_web3(web3):
+    """Adds the web3_middleware to a Web3 instance"""
+    if hasattr(web3, 'middleware_stack'):
+        web3.middleware_stack.add(web3_middleware)
+    else:
+        web3.add_middleware(web3_middleware)
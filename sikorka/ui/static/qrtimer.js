@@ -1,11 +1,16 @@
 var time = 10;
 var initialOffset = '440';
 var i = 1;
+var interval = null;
 
-/* Need initial run as interval hasn't yet occured... */
-$('.circle_animation').css('stroke-dashoffset', initialOffset-(1*(initialOffset/time)));
+function startTimer() {
+    i = 1;
+    clearInterval(interval);
+    $('h2').text(0);
+    /* Need initial run as interval hasn't yet occured... */
+    $('.circle_animation').css('stroke-dashoffset', initialOffset-(1*(initialOffset/time)));
 
-var interval = setInterval(function() {
+    interval = setInterval(function() {
 		$('h2').text(i);
 		if (i == time) {
       clearInterval(interval);
@@ -14,3 +19,19 @@ var interval = setInterval(function() {
     $('.circle_animation').css('stroke-dashoffset', initialOffset-((i+1)*(initialOffset/time)));
     i++;
 }, 1000);
+}
+
+startTimer();
+
+/* New codes are pushed the moment they rotate, browsers without
+   server-sent events reload the page instead */
+if (window.EventSource) {
+    var stream = new EventSource('/api/1/qrcode/stream?image=1');
+    stream.addEventListener('qrcode', function(event) {
+        var code = JSON.parse(event.data);
+        $('.imgitem img').attr('src', 'data:' + code.mimetype + ';base64,' + code.image);
+        startTimer();
+    });
+} else {
+    setTimeout(function() { window.location.reload(); }, time * 1000);
+}
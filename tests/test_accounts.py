@@ -0,0 +1,190 @@
+import os
+import struct
+import pytest
+
+import sikorka.accounts
+from sikorka.accounts import (
+    AccountManager,
+    PARALLEL_PARSE_THRESHOLD,
+    SignatureCache,
+    unlock_accounts,
+)
+
+
+class FakeClock(object):
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+def test_signature_cache_hits_and_misses(sikorka_ctx):
+    clock = FakeClock(1508000000)
+    account = sikorka_ctx.account
+    account.signature_cache = SignatureCache(size=2, seconds_allowed=60, clock=clock)
+    user = '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+
+    first = account.create_signed_message(user, clock.now)
+    assert account.create_signed_message(user, clock.now) == first
+    assert account.signature_cache.hits == 1
+    assert account.signature_cache.misses == 1
+
+    # The QR path shares the cache but signs different message bytes
+    account.create_qr_sign(clock.now)
+    assert account.signature_cache.misses == 2
+    assert len(account.signature_cache) == 2
+
+
+def test_signature_cache_evictions():
+    clock = FakeClock(1508000000)
+    cache = SignatureCache(size=2, seconds_allowed=10, clock=clock)
+
+    def message(timestamp):
+        return bytearray(struct.pack('>Q', timestamp))
+
+    cache.put(message(clock.now), b'a')
+    cache.put(message(clock.now + 1), b'b')
+    # Touch the first entry so that the second one is least recently used
+    assert cache.get(message(clock.now)) == b'a'
+    cache.put(message(clock.now + 2), b'c')
+    assert cache.get(message(clock.now + 1)) is None
+    assert len(cache) == 2
+
+    # Once outside the allowed window entries are gone
+    clock.now += 11
+    assert cache.get(message(clock.now - 11)) is None
+    assert cache.get(message(clock.now - 9)) == b'c'
+    assert len(cache) == 1
+
+    # Messages already outside the window are never cached
+    cache.put(message(clock.now - 20), b'd')
+    assert len(cache) == 1
+
+
+KEY_ADDRESS = 'a29c5ee469114cd55dae974eaf0a246f8985f5e1'
+
+
+@pytest.fixture(autouse=True)
+def cachedir(tmpdir_factory, monkeypatch):
+    cachedir = tmpdir_factory.mktemp('cache')
+    monkeypatch.setenv('XDG_CACHE_HOME', str(cachedir))
+    return cachedir.join('sikorka')
+
+
+@pytest.fixture()
+def keystore(tmpdir):
+    key = open(os.path.join(os.path.dirname(__file__), 'test_key.json')).read()
+    named = 'UTC--2017-10-16T12-00-00.000000000Z--' + 'ab' * 20
+    tmpdir.join(named).write('{"address": "' + 'cd' * 20 + '"}')
+    tmpdir.join('mykey.json').write(key)
+    tmpdir.join('notes.txt').write('not a keystore file')
+    return tmpdir
+
+
+def test_account_manager_scans_keystore(keystore, cachedir, monkeypatch):
+    manager = AccountManager(str(keystore))
+    # The address in the file name wins, the file itself is not opened
+    assert manager.accounts == {
+        'ab' * 20: str(keystore.join('UTC--2017-10-16T12-00-00.000000000Z--' + 'ab' * 20)),
+        KEY_ADDRESS: str(keystore.join('mykey.json')),
+    }
+    # The manifest is kept out of the keystore
+    assert sorted(os.listdir(str(keystore))) == [
+        'UTC--2017-10-16T12-00-00.000000000Z--' + 'ab' * 20,
+        'mykey.json',
+        'notes.txt',
+    ]
+    assert cachedir.join(os.path.basename(manager.manifest_path)).check()
+
+    parsed = []
+    original = sikorka.accounts.read_keystore_address
+    monkeypatch.setattr(
+        sikorka.accounts,
+        'read_keystore_address',
+        lambda path: parsed.append(path) or original(path),
+    )
+    assert AccountManager(str(keystore)).accounts == manager.accounts
+    assert parsed == []
+
+    keystore.join('notes.txt').write('changed, still not a keystore file')
+    keystore.join('mykey.json').remove()
+    assert AccountManager(str(keystore)).accounts == {
+        'ab' * 20: manager.accounts['ab' * 20],
+    }
+    assert parsed == [str(keystore.join('notes.txt'))]
+
+
+def test_account_manager_checks_misnamed_files(keystore):
+    key = open(os.path.join(os.path.dirname(__file__), 'test_key.json')).read()
+    misnamed = 'UTC--2017-10-17T12-00-00.000000000Z--' + 'ef' * 20
+    keystore.join('mykey.json').remove()
+    keystore.join(misnamed).write(key)
+    manager = AccountManager(str(keystore))
+    assert KEY_ADDRESS not in manager.accounts
+
+    # Not found by name, so every file is opened to look for it
+    assert manager.get_privkey(KEY_ADDRESS, '123').address() == KEY_ADDRESS
+    assert manager.accounts[KEY_ADDRESS] == str(keystore.join(misnamed))
+    # The file named after ab... holds cd...
+    assert manager.accounts['cd' * 20] == str(
+        keystore.join('UTC--2017-10-16T12-00-00.000000000Z--' + 'ab' * 20)
+    )
+    with pytest.raises(ValueError):
+        manager.get_privkey('ab' * 20, '123')
+    with pytest.raises(ValueError):
+        AccountManager(str(keystore)).get_privkey('ef' * 20, '123')
+
+
+def test_account_manager_parses_many_files_in_parallel(tmpdir):
+    for i in range(PARALLEL_PARSE_THRESHOLD + 10):
+        tmpdir.join('key{}'.format(i)).write('{"address": "%040x"}' % i)
+    manager = AccountManager(str(tmpdir))
+    assert len(manager.accounts) == PARALLEL_PARSE_THRESHOLD + 10
+    assert manager.accounts['%040x' % 3] == str(tmpdir.join('key3'))
+
+
+def test_unlock_accounts_in_parallel():
+    keyfile = os.path.join(os.path.dirname(__file__), 'test_key.json')
+    results = unlock_accounts([(keyfile, '123'), (keyfile, 'wrong'), (keyfile, '123')])
+    assert [result.keyfile for result in results] == [keyfile] * 3
+    assert results[0].account.address() == KEY_ADDRESS
+    assert results[2].account.address() == KEY_ADDRESS
+    assert results[1].account is None
+    assert isinstance(results[1].error, ValueError)
+    assert all(result.seconds > 0 for result in results)
+
+
+def test_account_manager_get_privkey(tmpdir):
+    key = open(os.path.join(os.path.dirname(__file__), 'test_key.json')).read()
+    tmpdir.join('mykey.json').write(key)
+    manager = AccountManager(str(tmpdir))
+    assert manager.get_privkey('0x' + KEY_ADDRESS, '123').address() == KEY_ADDRESS
+    with pytest.raises(ValueError):
+        manager.get_privkey(KEY_ADDRESS, 'wrong')
+    result, = manager.get_privkeys({KEY_ADDRESS: '123'})
+    assert result.account.address() == KEY_ADDRESS
+
+
+def test_sign_many_matches_sign(sikorka_ctx):
+    account = sikorka_ctx.account
+    messages = [struct.pack('>Q', 1508000000 + i) for i in range(5)]
+    signatures = account.sign_many(messages)
+    assert [bytes(signature) for signature in signatures] == [
+        account.sign(message) for message in messages
+    ]
+
+
+def test_create_signed_messages_matches_single(sikorka_ctx):
+    account = sikorka_ctx.account
+    users = [bytes([i]) * 20 for i in range(1, 4)]
+    messages = account.create_signed_messages(users, 1508000000, prefix=b'\x01')
+    assert [bytes(message) for message in messages] == [
+        b'\x01' + account.create_signed_message('0x' + user.hex(), 1508000000)
+        for user in users
+    ]
+    # All of them are views into the same buffer
+    assert all(message.obj is messages[0].obj for message in messages)
+    with pytest.raises(ValueError):
+        account.create_signed_messages([b'\x01' * 19], 1508000000)
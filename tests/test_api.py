@@ -0,0 +1,359 @@
+import json
+import struct
+import time
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+import sikorka.api.api
+from sikorka.api.api import MAX_BATCH_SIZE, RestAPI
+from sikorka.api.rest import APIServer
+from sikorka.qrcodes import QRCodeStore
+from sikorka.ratelimit import RateLimiter
+from sikorka.signer import Signer
+
+
+@pytest.fixture()
+def qrcode_store():
+    return QRCodeStore(period=10)
+
+
+@pytest.fixture()
+def api_client(sikorka_ctx, qrcode_store):
+    api_server = APIServer(RestAPI(sikorka_ctx, qrcode_store))
+    return api_server.flask_app.test_client()
+
+
+def test_detector_sign_batch(api_client, sikorka_ctx):
+    users = [
+        '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c',
+        '0xnotanaddress',
+        '0xacb35c909b156feeace5c58e9b6b7162a4fa2beb',
+    ]
+    timestamp = 1508000000
+    response = api_client.post(
+        '/api/1/detector_sign/batch',
+        data=json.dumps(dict(addresses=users, timestamp=timestamp)),
+        content_type='application/json',
+    )
+    assert response.status_code == 200
+    result = json.loads(response.data.decode('utf-8'))
+    assert result['timestamp'] == timestamp
+
+    messages = result['messages']
+    assert len(messages) == len(users)
+    assert 'error' in messages[1]
+    for user, entry in zip((users[0], users[2]), (messages[0], messages[2])):
+        message = bytes.fromhex(entry['message'])
+        assert message[0] == 1
+        assert message[1:21] == bytes.fromhex(user[2:])
+        assert struct.unpack('>Q', message[21:29])[0] == timestamp
+        assert message == sikorka_ctx.sign_message_as_detector(
+            bytes.fromhex(user[2:]),
+            time=timestamp,
+        )
+
+
+def test_detector_sign_batch_invalid_request(api_client):
+    response = api_client.post(
+        '/api/1/detector_sign/batch',
+        data=json.dumps(dict(addresses='0x8bed7fd11ef2efa1899f751a8d422c1fd028610c')),
+        content_type='application/json',
+    )
+    assert response.status_code == 400
+
+
+def test_detector_sign_batch_too_large(api_client, monkeypatch):
+    def decode_hex_address(address):
+        raise AssertionError('Decoded an address of an oversized batch')
+    monkeypatch.setattr(sikorka.api.api, 'decode_hex_address', decode_hex_address)
+    addresses = ['0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'] * (MAX_BATCH_SIZE + 1)
+
+    response = api_client.post(
+        '/api/1/detector_sign/batch',
+        data=json.dumps(dict(addresses=addresses)),
+        content_type='application/json',
+    )
+    assert response.status_code == 400
+
+    response = api_client.post(
+        '/api/1/detector_sign/batch',
+        data=bytes(8 + 20 * (MAX_BATCH_SIZE + 1)),
+        content_type='application/octet-stream',
+    )
+    assert response.status_code == 400
+
+
+@pytest.mark.parametrize('body', ['[]', '"x"', '1', 'null', 'not json'])
+def test_detector_sign_batch_body_not_an_object(api_client, body):
+    response = api_client.post(
+        '/api/1/detector_sign/batch',
+        data=body,
+        content_type='application/json',
+    )
+    assert response.status_code == 400
+    assert 'errors' in json.loads(response.data.decode('utf-8'))
+
+
+def test_detector_sign_binary(api_client, sikorka_ctx):
+    user = '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+    response = api_client.get(
+        '/api/1/detector_sign/' + user,
+        headers={'Accept': 'application/octet-stream'},
+    )
+    assert response.status_code == 200
+    assert response.mimetype == 'application/octet-stream'
+    message = response.data
+    assert len(message) == 94
+    timestamp = struct.unpack('>Q', message[21:29])[0]
+    assert message == sikorka_ctx.sign_message_as_detector(bytes.fromhex(user[2:]), timestamp)
+
+    # JSON stays the default for clients accepting anything
+    response = api_client.get('/api/1/detector_sign/' + user, headers={'Accept': '*/*'})
+    assert response.mimetype == 'application/json'
+
+
+@pytest.mark.parametrize('packed_request', [False, True])
+def test_detector_sign_batch_compact(api_client, sikorka_ctx, packed_request):
+    users = [
+        '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c',
+        '0xacb35c909b156feeace5c58e9b6b7162a4fa2beb',
+    ]
+    timestamp = 1508000000
+    if packed_request:
+        data = struct.pack('>Q', timestamp) + b''.join(bytes.fromhex(u[2:]) for u in users)
+        content_type = 'application/octet-stream'
+    else:
+        users.insert(1, '0xnotanaddress')
+        data = json.dumps(dict(addresses=users, timestamp=timestamp))
+        content_type = 'application/json'
+    response = api_client.post(
+        '/api/1/detector_sign/batch',
+        data=data,
+        content_type=content_type,
+        headers={'Accept': 'application/octet-stream'},
+    )
+    assert response.status_code == 200
+    assert response.mimetype == 'application/octet-stream'
+    assert struct.unpack('>QH', response.data[:10]) == (timestamp, len(users))
+    signatures = response.data[10:]
+    assert len(signatures) == 65 * len(users)
+    for idx, user in enumerate(users):
+        signature = signatures[idx * 65:(idx + 1) * 65]
+        if user == '0xnotanaddress':
+            assert signature == bytes(65)
+            continue
+        expected = sikorka_ctx.sign_message_as_detector(bytes.fromhex(user[2:]), timestamp)
+        assert signature == expected[29:]
+
+
+def test_detector_sign_batch_packed_invalid_request(api_client):
+    response = api_client.post(
+        '/api/1/detector_sign/batch',
+        data=bytes(8 + 19),
+        content_type='application/octet-stream',
+    )
+    assert response.status_code == 400
+
+
+def test_detector_sign_when_signer_busy(api_client, sikorka_ctx):
+    sikorka_ctx.account.signer = Signer(threads=1, max_pending=1)
+    sikorka_ctx.account.signer.pending = 1
+    response = api_client.get(
+        '/api/1/detector_sign/0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+    )
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    sikorka_ctx.account.signer.close()
+
+
+def test_fast_path_signer_busy_admits_once(sikorka_ctx, qrcode_store):
+    limiter = RateLimiter(user_rate=1, user_burst=2, peer_rate=1, peer_burst=2)
+    api_server = APIServer(RestAPI(sikorka_ctx, qrcode_store, limiter))
+    fast = Client(api_server.wsgi_app, Response)
+    sikorka_ctx.account.signer = Signer(threads=1, max_pending=1)
+    sikorka_ctx.account.signer.pending = 1
+    user = '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+    peer = {'REMOTE_ADDR': '10.0.0.1'}
+
+    # Answered like the Flask resource does, without admitting the request
+    # a second time on the way there
+    expected = api_server.flask_app.test_client().get('/api/1/detector_sign/' + user)
+    limiter.admitted = 0
+    response = fast.get('/api/1/detector_sign/' + user, environ_base=peer)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert response.data == expected.data
+    assert limiter.admitted == 1
+    sikorka_ctx.account.signer.close()
+
+
+@pytest.mark.parametrize('fast', [False, True])
+def test_detector_sign_rate_limited(sikorka_ctx, qrcode_store, fast):
+    limiter = RateLimiter(user_rate=1, user_burst=1, peer_rate=1, peer_burst=3)
+    api_server = APIServer(RestAPI(sikorka_ctx, qrcode_store, limiter))
+    if fast:
+        client = Client(api_server.wsgi_app, Response)
+    else:
+        client = api_server.flask_app.test_client()
+    peer = {'REMOTE_ADDR': '10.0.0.1'}
+    user = '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+    assert client.get('/api/1/detector_sign/' + user, environ_base=peer).status_code == 200
+    response = client.get('/api/1/detector_sign/' + user, environ_base=peer)
+    assert response.status_code == 429
+    assert response.headers['Retry-After'] == '1'
+    assert json.loads(response.data.decode('utf-8')) == dict(errors='Rate limit exceeded')
+
+    # Users over their limit fail on their own within a batch
+    response = client.post(
+        '/api/1/detector_sign/batch',
+        data=json.dumps(dict(addresses=[user, '0xacb35c909b156feeace5c58e9b6b7162a4fa2beb'])),
+        content_type='application/json',
+        environ_base=peer,
+    )
+    assert response.status_code == 200
+    messages = json.loads(response.data.decode('utf-8'))['messages']
+    assert messages[0] == dict(error='Rate limit exceeded')
+    assert 'message' in messages[1]
+
+    # and the peer has used up its burst
+    response = client.post(
+        '/api/1/detector_sign/batch',
+        data=json.dumps(dict(addresses=['0xacb35c909b156feeace5c58e9b6b7162a4fa2beb'])),
+        content_type='application/json',
+        environ_base=peer,
+    )
+    assert response.status_code == 429
+
+
+def test_qrcode_conditional_get(api_client, qrcode_store):
+    assert api_client.get('/api/1/qrcode').status_code == 404
+
+    qrcode_store.update(b'first image', 'image/png', int(time.time()))
+    response = api_client.get('/api/1/qrcode')
+    assert response.status_code == 200
+    assert response.data == b'first image'
+    assert response.mimetype == 'image/png'
+    assert 0 <= response.cache_control.max_age <= 10
+    etag = response.headers['ETag']
+
+    response = api_client.get('/api/1/qrcode', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+
+    # Once the code rotates pollers get the new image
+    qrcode_store.update(b'second image', 'image/png', int(time.time()) + 1)
+    response = api_client.get('/api/1/qrcode', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.data == b'second image'
+
+
+def test_qrcode_stream(api_client, qrcode_store):
+    qrcode_store.update(b'image', 'image/png', 1508000000, b'\x03' * 94)
+    response = api_client.get('/api/1/qrcode/stream', buffered=False)
+    assert response.status_code == 200
+    assert response.mimetype == 'text/event-stream'
+    assert response.cache_control.no_cache
+    event = next(response.response)
+    assert event.startswith(b'id: 1508000000\nevent: qrcode\ndata: ')
+    assert json.loads(event.split(b'data: ', 1)[1].decode('utf-8')) == dict(
+        timestamp=1508000000,
+        message='0x' + '03' * 94,
+    )
+    response.close()
+
+
+def test_qrcode_streams_are_capped(sikorka_ctx, qrcode_store):
+    qrcode_store.update(b'image', 'image/png', 1508000000, b'\x03' * 94)
+    api_server = APIServer(RestAPI(sikorka_ctx, qrcode_store, max_qrcode_streams=2))
+    client = api_server.flask_app.test_client()
+    streams = [client.get('/api/1/qrcode/stream', buffered=False) for _ in range(2)]
+    assert [stream.status_code for stream in streams] == [200, 200]
+
+    response = client.get('/api/1/qrcode/stream', buffered=False)
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '10'
+    # Signing is still served
+    assert client.get('/api/1/address').status_code == 200
+
+    streams.pop().close()
+    response = client.get('/api/1/qrcode/stream', buffered=False)
+    assert response.status_code == 200
+    response.close()
+    for stream in streams:
+        stream.close()
+
+
+def test_metrics(fast_client):
+    fast, _ = fast_client
+    user = '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+    for _ in range(2):
+        assert fast.get('/api/1/detector_sign/' + user).status_code == 200
+    assert fast.get('/api/1/detector_sign/' + user, headers={'Origin': 'x'}).status_code == 200
+    assert fast.get('/api/1/nothing').status_code == 404
+
+    response = fast.get('/api/1/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'].startswith('text/plain; version=0.0.4')
+    samples = dict(
+        line.rsplit(' ', 1) for line in response.data.decode('utf-8').splitlines()
+        if not line.startswith('#')
+    )
+    route = 'route="/api/1/detector_sign/<hexaddress:user_address>"'
+    # Requests answered by the fast path and by flask count the same
+    assert int(samples[
+        'sikorka_api_requests_total{method="GET",' + route + ',status="200"}'
+    ]) >= 3
+    assert int(samples[
+        'sikorka_api_requests_total{method="GET",route="unmatched",status="404"}'
+    ]) >= 1
+    assert 'sikorka_api_request_seconds_count{method="GET",' + route + '}' in samples
+    assert int(samples['sikorka_signatures_total']) >= 3
+
+
+@pytest.fixture()
+def fast_client(sikorka_ctx, qrcode_store):
+    api_server = APIServer(RestAPI(sikorka_ctx, qrcode_store))
+    return Client(api_server.wsgi_app, Response), api_server.flask_app.test_client()
+
+
+def test_fast_path_replies_like_flask(fast_client, sikorka_ctx):
+    fast, flask_client = fast_client
+    response = fast.get('/api/1/address')
+    expected = flask_client.get('/api/1/address')
+    assert response.status_code == 200
+    assert response.data == expected.data
+    assert response.headers['Content-Type'] == 'application/json'
+
+    user = '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+    before = int(time.time())
+    response = fast.get('/api/1/detector_sign/' + user)
+    assert response.status_code == 200
+    message = bytes.fromhex(json.loads(response.data.decode('utf-8'))['message'])
+    timestamp = struct.unpack('>Q', message[21:29])[0]
+    assert before <= timestamp <= time.time()
+    assert message == sikorka_ctx.sign_message_as_detector(bytes.fromhex(user[2:]), timestamp)
+
+
+def test_fast_path_negotiates_binary(fast_client, sikorka_ctx):
+    fast, _ = fast_client
+    user = '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+    for accept in ('application/octet-stream', 'application/json;q=0.5, application/octet-stream'):
+        response = fast.get('/api/1/detector_sign/' + user, headers={'Accept': accept})
+        assert response.status_code == 200
+        assert response.headers['Content-Type'] == 'application/octet-stream'
+        timestamp = struct.unpack('>Q', response.data[21:29])[0]
+        assert response.data == sikorka_ctx.sign_message_as_detector(
+            bytes.fromhex(user[2:]),
+            timestamp,
+        )
+
+
+@pytest.mark.parametrize('address', [
+    '0x8bed7fd11ef2efa1899f751a8d422c1fd028610',
+    '0x8bed7fd11ef2efa1899f751a8d422c1fd028610z',
+    '0x8bed7fd11ef2efa1899f751a8d422c1fd028 10c',
+    '8bed7fd11ef2efa1899f751a8d422c1fd028610c00',
+])
+def test_fast_path_leaves_invalid_addresses_to_flask(fast_client, address):
+    fast, _ = fast_client
+    assert fast.get('/api/1/detector_sign/' + address).status_code == 404
@@ -0,0 +1,77 @@
+import os
+import signal
+import time
+import http.client
+import gevent
+import pytest
+
+from sikorka.api.workers import APIWorkers
+
+
+def pid_app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'text/plain')])
+    return [str(os.getpid()).encode('utf-8')]
+
+
+def get_pid(address):
+    connection = http.client.HTTPConnection(*address, timeout=5)
+    connection.request('GET', '/')
+    pid = int(connection.getresponse().read())
+    connection.close()
+    return pid
+
+
+def wait_for_pids(address, count, timeout=10):
+    pids = set()
+    deadline = time.time() + timeout
+    while len(pids) < count and time.time() < deadline:
+        try:
+            pids.add(get_pid(address))
+        except (ConnectionError, OSError):
+            gevent.sleep(0.05)
+    return pids
+
+
+@pytest.fixture()
+def workers():
+    workers = APIWorkers(pid_app, 2, '127.0.0.1', 0, pool_size=4)
+    workers.start()
+    yield workers
+    workers.stop()
+
+
+def test_workers_share_the_socket(workers):
+    pids = wait_for_pids(workers.address, 2)
+    assert len(pids) == 2
+    assert os.getpid() not in pids
+
+
+def test_dead_workers_are_restarted(workers):
+    pids = wait_for_pids(workers.address, 2)
+    dead = pids.pop()
+    os.kill(dead, signal.SIGKILL)
+    gevent.sleep(0.5)
+    new_pids = wait_for_pids(workers.address, 2)
+    assert dead not in new_pids
+    assert len(new_pids) == 2
+
+
+def test_stop_shuts_down_all_workers(workers):
+    pids = wait_for_pids(workers.address, 2)
+    workers.stop()
+    for pid in pids:
+        with pytest.raises(OSError):
+            os.kill(pid, 0)
+
+
+def test_keep_alive_responses_are_not_delayed(workers):
+    wait_for_pids(workers.address, 2)
+    connection = http.client.HTTPConnection(*workers.address, timeout=5)
+    start = time.perf_counter()
+    for _ in range(10):
+        connection.request('GET', '/')
+        connection.getresponse().read()
+    connection.close()
+    # With Nagle's algorithm every response after the first waits for a
+    # delayed ACK of around 40ms
+    assert time.perf_counter() - start < 0.2
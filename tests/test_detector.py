@@ -0,0 +1,147 @@
+import socket
+import struct
+import time
+
+import gevent
+import gevent.select
+import pytest
+from gevent.event import Event
+
+from sikorka import detector
+from sikorka.detector import (
+    MAX_FRAME_SIZE,
+    binary_error_reply,
+    detector_process,
+    detector_process_binary,
+    error_reply,
+    parse_tcp_address,
+    serve_detector_client,
+)
+from sikorka.framing import length_prefixed
+from sikorka.ratelimit import RateLimiter
+
+
+def test_detector_process_eth_address(sikorka_ctx):
+    reply = detector_process(b'ETH_ADDRESS', sikorka_ctx.account)
+    assert reply == 'ETH_ADDRESS::0x{}\r\nEND\r\n'.format(
+        sikorka_ctx.address()
+    ).encode('utf-8')
+
+
+def test_detector_process_signed_message(sikorka_ctx):
+    user = b'0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+    before = int(time.time())
+    reply = detector_process(b'SIGNED_MESSAGE::' + user, sikorka_ctx.account)
+    assert len(reply) == 93
+    assert reply[:20] == bytes.fromhex(user[2:].decode('utf-8'))
+    assert struct.unpack('>Q', reply[20:28])[0] >= before
+
+
+def test_detector_process_errors(sikorka_ctx):
+    reply = detector_process(b'SIGNED_MESSAGE::0xnotanaddress', sikorka_ctx.account)
+    assert reply.startswith(b'ERROR::')
+    reply = detector_process(b'GIVE_ME_EVERYTHING', sikorka_ctx.account)
+    assert reply.startswith(b'ERROR::')
+
+
+def test_detector_process_rate_limited(sikorka_ctx):
+    limiter = RateLimiter(user_rate=1, user_burst=1)
+    user = b'0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+    request = b'SIGNED_MESSAGE::' + user
+    assert len(detector_process(request, sikorka_ctx.account, limiter, 'peer')) == 93
+    reply = detector_process(request, sikorka_ctx.account, limiter, 'peer')
+    assert reply == b'ERROR::Rate limited\r\nEND\r\n'
+
+    frame = memoryview(b'\x02' + bytes.fromhex(user[2:].decode('utf-8')))
+    reply = detector_process_binary(frame, sikorka_ctx.account, limiter, 'peer')
+    assert reply == length_prefixed(b'\xffRate limited')
+
+
+def test_parse_tcp_address():
+    assert parse_tcp_address('0.0.0.0:5012') == ('0.0.0.0', 5012)
+    assert parse_tcp_address(':5012') == ('127.0.0.1', 5012)
+    for address in ('localhost', 'localhost:', 'localhost:http', '127.0.0.1:70000'):
+        with pytest.raises(ValueError):
+            parse_tcp_address(address)
+
+
+class CountingServerSocket(object):
+    """A listening socket that counts the clients accepted from it"""
+
+    def __init__(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.accepted = []
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def accept(self):
+        client = self.sock.accept()
+        self.accepted.append(client[0])
+        return client
+
+    def close(self):
+        for client_sock in self.accepted:
+            client_sock.close()
+        self.sock.close()
+
+
+def test_serve_detector_accepts_at_most_max_clients(monkeypatch):
+    monkeypatch.setattr(detector, 'POLL_INTERVAL', 0.05)
+    # Cooperative like under the monkey patching of the cli
+    monkeypatch.setattr(detector, 'select', gevent.select)
+    release = Event()
+    monkeypatch.setattr(detector, 'serve_detector_client', lambda *args: release.wait())
+    server_sock = CountingServerSocket()
+    connections = [
+        socket.create_connection(server_sock.sock.getsockname()) for _ in range(2)
+    ]
+    end_event = Event()
+    server = gevent.spawn(
+        detector.serve_detector, end_event, server_sock, None, max_clients=1,
+    )
+    gevent.sleep(0.3)
+    # The second client waits in the listen backlog until the first is done
+    assert len(server_sock.accepted) == 1
+
+    release.set()
+    gevent.sleep(0.3)
+    assert len(server_sock.accepted) == 2
+    end_event.set()
+    server.join()
+    for connection in connections:
+        connection.close()
+
+
+def _serve_one_client(account, request):
+    """Serves `request` sent over a socket pair and returns all replies"""
+    client_sock, server_side = socket.socketpair()
+    client_sock.sendall(request)
+    # Unread data would reset the connection when the server closes it
+    client_sock.shutdown(socket.SHUT_WR)
+    serve_detector_client(Event(), server_side, ('peer', 0), account, idle_timeout=1)
+    replies = b''
+    while True:
+        data = client_sock.recv(4096)
+        if not data:
+            break
+        replies += data
+    client_sock.close()
+    return replies
+
+
+def test_serve_detector_client_frame_too_large(sikorka_ctx):
+    account = sikorka_ctx.account
+    address_reply = detector_process_binary(memoryview(b'\x01'), account)
+
+    # Replies to the frames before the oversized one are still sent
+    replies = _serve_one_client(account, length_prefixed(b'\x01') + b'\xff\xff')
+    assert replies == address_reply + binary_error_reply(
+        'Frame of 65535 bytes is too large'
+    )
+
+    # A line that fills the buffer is found when receiving more
+    replies = _serve_one_client(account, b'x' * MAX_FRAME_SIZE)
+    assert replies == error_reply('Frame exceeds {} bytes'.format(MAX_FRAME_SIZE))
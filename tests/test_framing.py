@@ -0,0 +1,51 @@
+import pytest
+
+from sikorka.framing import (
+    FrameTooLarge,
+    LineFrameBuffer,
+    LengthPrefixedFrameBuffer,
+    length_prefixed,
+)
+
+
+def test_line_frames_split_across_reads():
+    frames = LineFrameBuffer(max_frame_size=64)
+    frames.feed(b'ETH_ADDRESS\r\nSIGNED_MESS')
+    assert [bytes(f) for f in frames.frames()] == [b'ETH_ADDRESS']
+    frames.feed(b'AGE::0x12\nAUTH')
+    frames.feed(b'ORIZE_USER::0x34\n\n')
+    assert [bytes(f) for f in frames.frames()] == [
+        b'SIGNED_MESSAGE::0x12',
+        b'AUTHORIZE_USER::0x34',
+        b'',
+    ]
+    assert len(frames) == 0
+
+
+def test_line_frames_reuse_the_buffer():
+    frames = LineFrameBuffer(max_frame_size=16)
+    # Many more bytes than the buffer size go through as long as each
+    # line fits and frames are consumed between reads
+    for i in range(100):
+        frames.feed(b'LINE%03d' % i)
+        frames.feed(b'\n')
+        assert [bytes(f) for f in frames.frames()] == [b'LINE%03d' % i]
+
+
+def test_line_frame_too_large():
+    frames = LineFrameBuffer(max_frame_size=8)
+    with pytest.raises(FrameTooLarge):
+        frames.feed(b'0123456789\n')
+
+
+def test_length_prefixed_frames():
+    frames = LengthPrefixedFrameBuffer(max_frame_size=32)
+    stream = length_prefixed(b'\x01') + length_prefixed(b'\x02' + b'\xaa' * 20)
+    frames.feed(stream[:5])
+    assert [bytes(f) for f in frames.frames()] == [b'\x01']
+    frames.feed(stream[5:])
+    assert [bytes(f) for f in frames.frames()] == [b'\x02' + b'\xaa' * 20]
+
+    frames.feed(length_prefixed(b'\x00' * 33)[:10])
+    with pytest.raises(FrameTooLarge):
+        list(frames.frames())
@@ -0,0 +1,176 @@
+import os
+import signal
+import time
+
+import gevent
+import gevent.monkey
+import pytest
+from gevent import socket
+from gevent.event import Event
+
+from sikorka.api.api import RestAPI
+from sikorka.api.rest import APIServer
+from sikorka.api.workers import APIWorkers
+from sikorka.detector import create_tcp_server_socket, serve_detector
+from sikorka.loadtest import (
+    DetectorClient,
+    LatencyStats,
+    _drive,
+    percentile,
+    run_loadtest,
+)
+
+
+def test_percentile():
+    values = [i / 100 for i in range(1, 101)]
+    assert percentile(values, 50) == 0.5
+    assert percentile(values, 95) == 0.95
+    assert percentile(values, 99) == 0.99
+    assert percentile(values, 100) == 1.0
+    assert percentile([0.3], 99) == 0.3
+    assert percentile([], 50) is None
+
+
+def test_latency_stats_summary():
+    stats = LatencyStats()
+    for seconds in (0.001, 0.002, 0.003, 0.004):
+        stats.record(seconds)
+    stats.record(0.5, 'HTTP 429')
+    stats.record(0.5, 'HTTP 429')
+    stats.record(0.5, 'timeout')
+
+    summary = stats.summary(2)
+    assert summary['requests'] == 7
+    assert summary['errors'] == 3
+    assert summary['throughput'] == 2
+    assert summary['p50_ms'] == pytest.approx(2)
+    assert summary['max_ms'] == pytest.approx(4)
+    assert summary['error_reasons'] == {'HTTP 429': 2, 'timeout': 1}
+
+    empty = LatencyStats().summary(1)
+    assert empty['requests'] == 0
+    assert empty['p99_ms'] is None
+
+
+@pytest.fixture()
+def api_url(sikorka_ctx):
+    api_server = APIServer(RestAPI(sikorka_ctx))
+    workers = APIWorkers(api_server.wsgi_app, 1, '127.0.0.1', 0)
+    workers.start()
+    yield 'http://{}:{}'.format(*workers.address)
+    workers.stop()
+
+
+@pytest.fixture()
+def detector_address(sikorka_ctx):
+    server_sock = create_tcp_server_socket('127.0.0.1:0', 8)
+    address = '{}:{}'.format(*server_sock.getsockname())
+    pid = os.fork()
+    if pid == 0:
+        try:
+            gevent.reinit()
+            gevent.monkey.patch_select()
+            serve_detector(Event(), server_sock, sikorka_ctx.account)
+        finally:
+            os._exit(0)
+    server_sock.close()
+    yield address
+    os.kill(pid, signal.SIGKILL)
+    os.waitpid(pid, 0)
+
+
+def test_loadtest_api(api_url):
+    report = run_loadtest(api_url=api_url, api_clients=2, rate=50, duration=1)
+
+    assert set(report['targets']) == {'api address', 'api detector_sign'}
+    total = report['total']
+    assert total['requests'] > 10
+    assert total['errors'] == 0
+    assert total['throughput'] > 0
+    assert 0 < total['p50_ms'] <= total['p95_ms'] <= total['p99_ms'] <= total['max_ms']
+    assert report['config']['rate'] == 50
+
+
+@pytest.mark.parametrize('framing', ['binary', 'text'])
+def test_loadtest_detector(detector_address, framing):
+    report = run_loadtest(
+        api_clients=0,
+        detector_address=detector_address,
+        detector_clients=1,
+        detector_framing=framing,
+        rate=50,
+        duration=0.5,
+    )
+
+    stats = report['targets']['detector ' + framing]
+    assert stats['requests'] > 5
+    assert stats['errors'] == 0
+
+
+def test_loadtest_counts_connection_errors():
+    report = run_loadtest(
+        api_url='http://127.0.0.1:1',
+        api_clients=1,
+        api_routes=['address'],
+        rate=20,
+        duration=0.3,
+    )
+
+    stats = report['targets']['api address']
+    assert stats['requests'] > 0
+    assert stats['errors'] == stats['requests']
+    assert list(stats['error_reasons']) == ['ConnectionRefusedError']
+
+
+def test_loadtest_rejects_detector_address_without_port():
+    with pytest.raises(ValueError):
+        DetectorClient('tcp', 'localhost', 'binary', ['00' * 20], 1)
+
+
+class FailingClient(object):
+    targets = ['failing']
+
+    def __init__(self):
+        self.closed = 0
+
+    def request(self, target):
+        b'\xff'.decode('utf-8')
+
+    def close(self):
+        self.closed += 1
+
+
+def test_loadtest_counts_unexpected_errors():
+    client = FailingClient()
+    stats = {'failing': LatencyStats()}
+    start = time.perf_counter()
+    _drive(client, stats, start, 0, 0.01, start + 0.1)
+
+    assert stats['failing'].latencies == []
+    assert list(stats['failing'].errors) == ['UnicodeDecodeError']
+    # Reconnects after every failed request
+    assert client.closed == sum(stats['failing'].errors.values()) + 1
+
+
+def test_loadtest_detector_text_error_reply(tmpdir):
+    path = str(tmpdir.join('detector.sock'))
+    server_sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server_sock.bind(path)
+    server_sock.listen(1)
+
+    def answer_busy():
+        client_sock, _ = server_sock.accept()
+        while client_sock.recv(1024):
+            client_sock.sendall(b'ERROR::Busy\r\nEND\r\n')
+        client_sock.close()
+
+    server = gevent.spawn(answer_busy)
+    client = DetectorClient('unix', path, 'text', ['00' * 20], timeout=5)
+    # Shorter than a signed message, so has to be recognized without
+    # waiting for more
+    with gevent.Timeout(1):
+        assert client.request('detector text') == 'detector Busy'
+        assert client.request('detector text') == 'detector Busy'
+    client.close()
+    server.join()
+    server_sock.close()
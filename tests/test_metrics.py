@@ -0,0 +1,81 @@
+import pytest
+
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from sikorka import metrics
+from sikorka.api.metrics import metrics_app
+from sikorka.metrics import MetricsRegistry
+
+
+def test_render_prometheus_text():
+    registry = MetricsRegistry()
+    requests = registry.counter('requests', 'Requests answered', ['route', 'status'])
+    clients = registry.gauge('clients', 'Connected clients')
+    seconds = registry.histogram('seconds', 'Time taken', buckets=(0.1, 1))
+
+    requests.labels('/a"b', '200').inc()
+    requests.labels('/a"b', '200').inc(2)
+    clients.inc()
+    clients.inc()
+    clients.dec()
+    for value in (0.05, 0.5, 5):
+        seconds.observe(value)
+
+    assert registry.render().decode('utf-8').splitlines() == [
+        '# HELP clients Connected clients',
+        '# TYPE clients gauge',
+        'clients 1',
+        '# HELP requests_total Requests answered',
+        '# TYPE requests_total counter',
+        'requests_total{route="/a\\"b",status="200"} 3',
+        '# HELP seconds Time taken',
+        '# TYPE seconds histogram',
+        'seconds_bucket{le="0.1"} 1',
+        'seconds_bucket{le="1"} 2',
+        'seconds_bucket{le="+Inf"} 3',
+        'seconds_sum 5.55',
+        'seconds_count 3',
+    ]
+
+
+def test_histogram_labels_and_timer():
+    registry = MetricsRegistry()
+    seconds = registry.histogram('seconds', 'Time taken', ['format'], buckets=(1,))
+    with seconds.labels('png').time():
+        pass
+    lines = registry.render().decode('utf-8').splitlines()
+    assert 'seconds_bucket{format="png",le="1"} 1' in lines
+    assert 'seconds_count{format="png"} 1' in lines
+
+
+def test_register_errors():
+    registry = MetricsRegistry()
+    counter = registry.counter('requests', 'Requests', ['route'])
+    with pytest.raises(ValueError):
+        registry.counter('requests', 'Requests again')
+    with pytest.raises(ValueError):
+        counter.labels('/a', '200')
+
+
+def test_const_labels():
+    registry = MetricsRegistry()
+    requests = registry.counter('requests', 'Requests', ['route'])
+    seconds = registry.histogram('seconds', 'Time taken', buckets=(1,))
+    requests.labels('/a').inc()
+    seconds.observe(0.5)
+    registry.set_const_labels(pid=42)
+
+    lines = registry.render().decode('utf-8').splitlines()
+    assert 'requests_total{pid="42",route="/a"} 1' in lines
+    assert 'seconds_bucket{pid="42",le="1"} 1' in lines
+    assert 'seconds_count{pid="42"} 1' in lines
+
+
+def test_metrics_app():
+    client = Client(metrics_app, Response)
+    response = client.get('/metrics')
+    assert response.status_code == 200
+    assert response.headers['Content-Type'] == metrics.CONTENT_TYPE
+    assert response.data == metrics.REGISTRY.render()
+    assert client.get('/').status_code == 404
@@ -0,0 +1,39 @@
+import time
+import gevent
+
+from sikorka.profiler import Profiler
+
+
+def hog_the_hub():
+    start = time.time()
+    while time.time() - start < 0.15:
+        pass
+    gevent.sleep(0)
+
+
+def test_profiler_samples_and_reports_blocking(tmp_path):
+    profiler = Profiler(str(tmp_path / 'profile'), interval=0.001, block_threshold=0.1)
+    profiler.start()
+    gevent.spawn(hog_the_hub).join()
+    gevent.sleep(0.05)
+    collapsed_path, report_path = profiler.stop()
+    assert not profiler.running
+
+    stacks = {}
+    for line in open(collapsed_path):
+        stack, count = line.rsplit(' ', 1)
+        stacks[stack] = int(count)
+    assert any(
+        stack.startswith('Greenlet:hog_the_hub;') and 'hog_the_hub (test_profiler.py' in stack
+        for stack in stacks
+    )
+    assert any(stack.startswith('Hub;') for stack in stacks)
+
+    report = open(report_path).read()
+    assert 'Greenlet:hog_the_hub: blocked 1 times' in report
+    assert 'in hog_the_hub' in report
+
+    # Can be started again after it was stopped
+    profiler.start()
+    assert profiler.running
+    profiler.stop()
@@ -0,0 +1,120 @@
+import json
+import struct
+import zlib
+import gevent
+import pytest
+from gevent.event import Event
+
+from sikorka.qrcodes import (
+    BOX_SIZE,
+    QRCodeStore,
+    generate_qr_codes,
+    encode_payload,
+    make_qr_code,
+    render_matrix_bytes,
+    render_matrix_json,
+    render_png,
+    stream_qrcodes,
+)
+
+
+@pytest.fixture()
+def signed_bytes():
+    return bytearray.fromhex('03') + bytearray(range(73))
+
+
+def test_compact_encodings_give_smaller_codes(signed_bytes):
+    versions = [
+        make_qr_code(encode_payload(signed_bytes, encoding)).version
+        for encoding in ('hex', 'alphanumeric', 'bytes')
+    ]
+    assert versions[0] > versions[1] > versions[2]
+
+
+def test_matrix_renderers_agree(signed_bytes):
+    qr = make_qr_code(encode_payload(signed_bytes, 'bytes'))
+    matrix = qr.get_matrix()
+    rows = json.loads(render_matrix_json(qr).decode('utf-8'))['rows']
+    assert rows == [''.join('1' if m else '0' for m in row) for row in matrix]
+
+    packed = render_matrix_bytes(qr)
+    size, = struct.unpack('>H', packed[:2])
+    assert size == len(matrix)
+    bits = bin(int.from_bytes(packed[2:], 'big'))[2:].zfill((len(packed) - 2) * 8)
+    assert bits[:size * size] == ''.join(rows)
+
+
+def test_png_renderer(signed_bytes):
+    qr = make_qr_code(encode_payload(signed_bytes, 'hex'))
+    png = render_png(qr)
+    assert png[:8] == b'\x89PNG\r\n\x1a\n'
+    width, height = struct.unpack('>II', png[16:24])
+    assert width == height == len(qr.get_matrix()) * BOX_SIZE
+
+    # one filter byte plus the packed bits for every pixel row
+    idat_length, = struct.unpack('>I', png[33:37])
+    raw = zlib.decompress(png[41:41 + idat_length])
+    assert len(raw) == height * (1 + (width + 7) // 8)
+
+
+def test_qrcode_schedule(sikorka_ctx):
+    store = QRCodeStore(period=1)
+    end_event = Event()
+    greenlet = gevent.spawn(
+        generate_qr_codes,
+        end_event,
+        sikorka_ctx.account,
+        store,
+        'matrix-bytes',
+        'bytes',
+        2,
+    )
+    gevent.sleep(2.5)
+    end_event.set()
+    greenlet.join(timeout=2)
+    assert greenlet.dead
+
+    stats = store.schedule_stats
+    assert stats['swaps'] >= 1
+    assert stats['ready'] <= 2
+    assert stats['max_jitter_ms'] < 500
+    # Rotations happen on period boundaries and are signed for them
+    assert store.current.timestamp % store.period == 0
+
+
+def _read_event(event):
+    lines = event.decode('utf-8').rstrip('\n').split('\n')
+    fields = dict(line.split(': ', 1) for line in lines)
+    return int(fields['id']), json.loads(fields['data'])
+
+
+def test_qrcode_stream_fans_out(signed_bytes):
+    store = QRCodeStore(period=1)
+    store.update(b'first', 'image/png', 10, bytes(signed_bytes))
+    streams = [stream_qrcodes(store, with_image=True) for _ in range(3)]
+    first = [next(stream) for stream in streams]
+    # Encoded once for all subscribers
+    assert all(event is first[0] for event in first)
+    event_id, data = _read_event(first[0])
+    assert event_id == data['timestamp'] == 10
+    assert data['message'] == '0x' + signed_bytes.hex()
+    assert data['mimetype'] == 'image/png'
+    assert data['image'] == 'Zmlyc3Q='
+
+    waiters = [gevent.spawn(next, stream) for stream in streams]
+    gevent.sleep(0)
+    assert not any(waiter.ready() for waiter in waiters)
+    store.update(b'second', 'image/png', 11, bytes(signed_bytes))
+    gevent.joinall(waiters, timeout=1)
+    assert [_read_event(w.value)[0] for w in waiters] == [11, 11, 11]
+
+
+def test_qrcode_stream_resumes_and_keeps_alive():
+    store = QRCodeStore(period=1)
+    store.update(b'first', 'image/png', 10)
+    stream = stream_qrcodes(store, last_event_id=10, keepalive=0.01)
+    assert next(stream) == b': keep-alive\n\n'
+    store.update(b'second', 'image/png', 11)
+    event_id, data = _read_event(next(stream))
+    assert event_id == 11
+    assert 'image' not in data
@@ -0,0 +1,81 @@
+import pytest
+
+from sikorka.ratelimit import RateLimited, RateLimiter, TokenBuckets
+
+USER = bytes.fromhex('8bed7fd11ef2efa1899f751a8d422c1fd028610c')
+OTHER_USER = bytes.fromhex('acb35c909b156feeace5c58e9b6b7162a4fa2beb')
+
+
+class FakeClock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture()
+def clock():
+    return FakeClock()
+
+
+def test_token_buckets_refill(clock):
+    buckets = TokenBuckets(rate=2, burst=4, clock=clock)
+    assert buckets.tokens('a') == 4
+    buckets.take('a', 4)
+    assert buckets.tokens('a') == 0
+    assert buckets.wait_time('a', 1) == 0.5
+    clock.now += 1
+    assert buckets.tokens('a') == 2
+    clock.now += 100
+    assert buckets.tokens('a') == 4
+
+
+def test_token_buckets_evict_least_recently_used(clock):
+    buckets = TokenBuckets(rate=1, burst=1, size=2, clock=clock)
+    buckets.take('a')
+    buckets.take('b')
+    buckets.take('a')
+    buckets.take('c')
+    assert len(buckets) == 2
+    # b was evicted and comes back with a full bucket
+    assert buckets.tokens('b') == 1
+    assert buckets.tokens('a') < 1
+
+
+def test_rate_limiter_limits_users_and_peers(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=2, peer_rate=1, peer_burst=3, clock=clock)
+    limiter.admit(USER, 'peer')
+    limiter.admit(USER, 'peer')
+    with pytest.raises(RateLimited) as e:
+        limiter.admit(USER, 'peer')
+    assert e.value.retry_after == 1
+
+    limiter.admit(OTHER_USER, 'peer')
+    with pytest.raises(RateLimited):
+        limiter.admit(OTHER_USER, 'peer')
+    # The peer is out of tokens, but the rejection took none from the user
+    limiter.admit(OTHER_USER, 'other peer')
+    assert limiter.stats() == dict(admitted=4, rejected=2, users=2, peers=2)
+
+
+def test_rate_limiter_batches(clock):
+    limiter = RateLimiter(user_rate=1, user_burst=1, peer_rate=1, peer_burst=3, clock=clock)
+    assert limiter.admit_batch([USER, OTHER_USER, USER], 'peer') == [True, True, False]
+    with pytest.raises(RateLimited) as e:
+        limiter.admit_batch([USER], 'peer')
+    assert e.value.retry_after == 1
+
+    # A batch bigger than the burst goes through once the bucket is full
+    clock.now += 3
+    assert limiter.admit_batch([bytes([i]) * 20 for i in range(5)], 'peer') == [True] * 5
+    with pytest.raises(RateLimited):
+        limiter.admit_batch([USER], 'peer')
+
+
+def test_rate_limiter_disabled_limits(clock):
+    limiter = RateLimiter(user_rate=0, peer_rate=0, clock=clock)
+    for _ in range(100):
+        limiter.admit(USER, 'peer')
+    assert limiter.admit_batch([USER] * 3, 'peer') == [True] * 3
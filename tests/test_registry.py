@@ -2,6 +2,9 @@ import pytest
 from ethereum.tester import TransactionFailed
 from conftest import sikorka_contract
 
+from sikorka.registry import RegistryIndex, load_registry, registry_contract
+from sikorka.utils import address_decoder
+
 
 def test_registry_add_contract(chain):
     """Test adding contracts to the registry and querying them"""
@@ -52,3 +55,28 @@ def test_registry_get_contract_coordinates(chain, web3, create_contract, detecto
     for i in range(0, len(queried_latlong_pairs) // 2):
         assert queried_latlong_pairs[2 * i] == entries[i][1]
         assert queried_latlong_pairs[2 * i + 1] == entries[i][2]
+
+
+def test_registry_load_index(chain, web3):
+    """Test indexing the registry contracts locally and searching them"""
+    c1, _ = chain.provider.deploy_contract('SikorkaRegistry')
+    c2, _ = chain.provider.deploy_contract('SikorkaRegistry')
+    c3, _ = chain.provider.deploy_contract('SikorkaRegistry')
+
+    cc, _ = chain.provider.deploy_contract('SikorkaRegistry')
+    cc.transact().addContract(c1.address, 1, 2)
+    cc.transact().addContract(c2.address, 3, 4)
+    cc.transact().addContract(c3.address, 50, 50)
+    cc.transact().removeContract(c2.address)
+
+    index = load_registry(
+        registry_contract(web3, address_decoder(cc.address)),
+        RegistryIndex(coordinate_scale=1),
+    )
+    assert len(index) == 2
+    assert index.contracts[address_decoder(c1.address)] == (1, 2)
+    assert address_decoder(c2.address) not in index
+
+    nearest = index.nearest(0, 0, 1)
+    assert nearest[0][1] == address_decoder(c1.address)
+    assert len(index.within(0, 0, 500000)) == 1
@@ -0,0 +1,150 @@
+import pytest
+
+from sikorka.registry import (
+    CONTRACT_ADDED_TOPIC,
+    CONTRACT_REMOVED_TOPIC,
+    RegistryFollower,
+    RegistryIndex,
+)
+from sikorka.utils import address_encoder
+
+REGISTRY = b'\xee' * 20
+
+
+def word(value):
+    return value.to_bytes(32, 'big', signed=True).hex()
+
+
+class FakeChain(object):
+    """Just enough of web3 for the registry follower. Every block is a list
+    of ('add', address, lat, lon) or ('remove', address) events."""
+
+    def __init__(self):
+        self.blocks = [[]]
+        self.forks = [0]
+        self.eth = self
+        self.manager = self
+
+    @property
+    def blockNumber(self):
+        return len(self.blocks) - 1
+
+    def mine(self, *events):
+        self.blocks.append(list(events))
+        self.forks.append(self.forks[-1])
+
+    def reorg(self, depth):
+        del self.blocks[-depth:]
+        del self.forks[-depth:]
+        self.forks[-1] += 1000
+
+    def getBlock(self, number):
+        if number >= len(self.blocks):
+            return None
+        return {'hash': '0x{:064x}'.format(number + self.forks[number] * 10 ** 6)}
+
+    def contract(self, abi, address):
+        return self
+
+    def call(self):
+        return self
+
+    def _state(self):
+        state = {}
+        for block in self.blocks:
+            for event in block:
+                if event[0] == 'add':
+                    state[event[1]] = (event[2], event[3])
+                else:
+                    state.pop(event[1], None)
+        return state
+
+    def getContractAddresses(self):
+        return [address_encoder(address) for address in self._state()]
+
+    def getContractCoordinates(self):
+        return [c for coordinates in self._state().values() for c in coordinates]
+
+    def request_blocking(self, method, params):
+        assert method == 'eth_getLogs'
+        logs = []
+        for number in range(int(params[0]['fromBlock'], 16), int(params[0]['toBlock'], 16) + 1):
+            for log_index, event in enumerate(self.blocks[number]):
+                if event[0] == 'add':
+                    topic = CONTRACT_ADDED_TOPIC
+                    data = (
+                        '0x' +
+                        word(int.from_bytes(event[1], 'big')) +
+                        word(event[2]) +
+                        word(event[3])
+                    )
+                else:
+                    topic = CONTRACT_REMOVED_TOPIC
+                    data = '0x' + word(int.from_bytes(event[1], 'big'))
+                logs.append(dict(
+                    blockNumber=hex(number),
+                    logIndex=hex(log_index),
+                    topics=[topic],
+                    data=data,
+                ))
+        return logs
+
+
+A, B, C = b'\x0a' * 20, b'\x0b' * 20, b'\x0c' * 20
+
+
+@pytest.fixture()
+def chain():
+    chain = FakeChain()
+    chain.mine(('add', A, 1, 2))
+    return chain
+
+
+@pytest.fixture()
+def follower(chain):
+    follower = RegistryFollower(chain, REGISTRY, RegistryIndex(1), confirmations=3)
+    follower.bootstrap()
+    return follower
+
+
+def test_follower_applies_new_events(chain, follower):
+    assert follower.index.contracts == {A: (1, 2)}
+    chain.mine(('add', B, 3, 4), ('add', C, 5, 6))
+    chain.mine()
+    chain.mine(('remove', A), ('add', B, 7, 8))
+    assert follower.sync() == 4
+    assert follower.index.contracts == {B: (7, 8), C: (5, 6)}
+    assert follower.last_block == chain.blockNumber
+    assert follower.sync() == 0
+
+
+def test_follower_rolls_back_reorgs(chain, follower):
+    for _ in range(5):
+        chain.mine()
+        follower.sync()
+    chain.mine(('add', B, 3, 4))
+    follower.sync()
+    chain.mine(('remove', A), ('add', C, 5, 6))
+    follower.sync()
+    assert follower.index.contracts == {C: (5, 6), B: (3, 4)}
+
+    # The last two blocks are replaced by a fork with different events
+    chain.reorg(2)
+    chain.mine(('add', C, 9, 9))
+    chain.mine()
+    follower.sync()
+    assert follower.index.contracts == {A: (1, 2), C: (9, 9)}
+    assert follower.index.contracts == chain._state()
+
+
+def test_follower_bootstraps_after_deep_reorg(chain, follower):
+    for _ in range(10):
+        chain.mine()
+        follower.sync()
+    chain.mine(('add', B, 3, 4))
+    follower.sync()
+
+    chain.reorg(8)
+    chain.mine(('add', C, 5, 6))
+    follower.sync()
+    assert follower.index.contracts == chain._state() == {A: (1, 2), C: (5, 6)}
@@ -0,0 +1,70 @@
+import random
+import pytest
+
+from sikorka.registry import RegistryIndex, haversine
+
+
+@pytest.fixture()
+def contracts():
+    rng = random.Random(42)
+    result = []
+    for i in range(2000):
+        # Cluster most contracts around a city and spread the rest globally,
+        # including around the poles and the antimeridian
+        if i % 4:
+            lat, lon = rng.gauss(48.14, 0.2), rng.gauss(11.58, 0.2)
+        else:
+            lat, lon = rng.uniform(-90, 90), rng.uniform(-180, 180)
+        result.append((i.to_bytes(20, 'big'), int(lat * 10 ** 6), int(lon * 10 ** 6)))
+    return result
+
+
+@pytest.fixture()
+def index(contracts):
+    index = RegistryIndex(coordinate_scale=10 ** 6)
+    for entry in contracts:
+        index.add(*entry)
+    return index
+
+
+def brute_force(contracts, lat, lon):
+    return sorted(
+        (haversine(lat, lon, c_lat / 10 ** 6, c_lon / 10 ** 6), address)
+        for address, c_lat, c_lon in contracts
+    )
+
+
+@pytest.mark.parametrize('lat,lon,radius', [
+    (48.14, 11.58, 5000),
+    (48.14, 11.58, 50000),
+    (0, 179.99, 500000),
+    (89.9, 0, 300000),
+    (-45, -60, 2000000),
+])
+def test_within_matches_brute_force(index, contracts, lat, lon, radius):
+    expected = [
+        address for distance, address in brute_force(contracts, lat, lon)
+        if distance <= radius
+    ]
+    assert [entry[1] for entry in index.within(lat, lon, radius)] == expected
+
+
+@pytest.mark.parametrize('lat,lon,k', [
+    (48.14, 11.58, 10),
+    (10, -170, 5),
+    (-89, 90, 3),
+])
+def test_nearest_matches_brute_force(index, contracts, lat, lon, k):
+    expected = [address for _, address in brute_force(contracts, lat, lon)[:k]]
+    assert [entry[1] for entry in index.nearest(lat, lon, k)] == expected
+
+
+def test_add_move_and_remove(index, contracts):
+    address, lat, lon = contracts[0]
+    assert address in index
+    index.add(address, -lat, -lon)
+    assert index.contracts[address] == (-lat, -lon)
+    assert len(index) == len(contracts)
+    assert index.remove(address) == (-lat, -lon)
+    assert address not in index
+    assert index.remove(address) is None
@@ -0,0 +1,133 @@
+import os
+import random
+import pytest
+
+from sikorka.registry import RegistryFollower, RegistryIndex
+from sikorka.registry_snapshot import MappedRegistryIndex, LOG_RECORD
+from test_registry_follower import FakeChain, REGISTRY, A, B, C
+
+
+@pytest.fixture()
+def path(tmpdir):
+    return str(tmpdir.join('registry.snapshot'))
+
+
+def assert_same(index, reference):
+    assert len(index) == len(reference)
+    for address in reference.contracts:
+        assert index.get(address) == reference.get(address)
+    for lat, lon, radius in ((0, 0, 20000000), (48.1, 11.5, 50000), (-30, 170, 3000000)):
+        assert index.within(lat, lon, radius) == reference.within(lat, lon, radius)
+        assert index.nearest(lat, lon, 5) == reference.nearest(lat, lon, 5)
+
+
+def random_changes(index, reference, rng, addresses, count):
+    for _ in range(count):
+        address = rng.choice(addresses)
+        if rng.random() < 0.7:
+            lat = int(rng.uniform(-80, 80) * 10 ** 6)
+            lon = int(rng.uniform(-180, 180) * 10 ** 6)
+            index.add(address, lat, lon)
+            reference.add(address, lat, lon)
+        else:
+            assert index.remove(address) == reference.remove(address)
+
+
+def test_snapshot_matches_in_memory_index(path):
+    rng = random.Random(7)
+    addresses = [i.to_bytes(20, 'big') for i in range(500)]
+    index = MappedRegistryIndex(path)
+    reference = RegistryIndex()
+
+    for block in range(5):
+        random_changes(index, reference, rng, addresses, 400)
+        index.mark_synced(block, '0x{:064x}'.format(block))
+        assert_same(index, reference)
+    # Enough changes were logged to be merged into the snapshot at least once
+    assert index.base_count > 0
+    index.close()
+
+    reopened = MappedRegistryIndex(path)
+    assert reopened.synced == (4, '0x{:064x}'.format(4))
+    assert_same(reopened, reference)
+
+    reopened.compact()
+    assert reopened.log_records == 0
+    assert reopened.contracts == {}
+    assert_same(reopened, reference)
+    reopened.close()
+
+
+def test_load_writes_a_snapshot_without_logging(path):
+    rng = random.Random(3)
+    contracts = [(
+        i.to_bytes(20, 'big'),
+        int(rng.uniform(-80, 80) * 10 ** 6),
+        int(rng.uniform(-180, 180) * 10 ** 6),
+    ) for i in range(2000)]
+    reference = RegistryIndex()
+    reference.load(contracts)
+
+    index = MappedRegistryIndex(path)
+    index.add(A, 1, 2)
+    index.load(contracts)
+    assert index.log_records == 0
+    assert index.base_count == len(contracts)
+    assert index.get(A) is None
+    assert_same(index, reference)
+    index.close()
+
+    reopened = MappedRegistryIndex(path)
+    assert_same(reopened, reference)
+    reopened.close()
+
+
+def test_snapshot_drops_torn_log_record(path):
+    index = MappedRegistryIndex(path)
+    index.add(A, 1, 2)
+    index.mark_synced(1, '0x' + '01' * 32)
+    index.add(B, 3, 4)
+    index.close()
+    size = os.path.getsize(path)
+    with open(path, 'ab') as f:
+        f.write(LOG_RECORD.pack(1, C, 5, 6, 0, b'')[:10])
+
+    index = MappedRegistryIndex(path)
+    assert index.get(A) == (1, 2)
+    assert index.get(B) == (3, 4)
+    assert index.get(C) is None
+    assert os.path.getsize(path) == size
+    index.close()
+
+
+def test_snapshot_of_other_registry_is_discarded(path):
+    index = MappedRegistryIndex(path, source=b'\x01' * 20)
+    index.add(A, 1, 2)
+    index.mark_synced(1, '0x' + '01' * 32)
+    index.close()
+
+    assert len(MappedRegistryIndex(path, source=b'\x01' * 20)) == 1
+    index = MappedRegistryIndex(path, source=b'\x02' * 20)
+    assert len(index) == 0
+    assert index.synced is None
+
+
+def test_follower_resumes_from_snapshot(path):
+    chain = FakeChain()
+    chain.mine(('add', A, 1, 2))
+    follower = RegistryFollower(chain, REGISTRY, MappedRegistryIndex(path), confirmations=3)
+    follower.bootstrap()
+    chain.mine(('add', B, 3, 4))
+    follower.sync()
+    follower.index.close()
+
+    chain.mine(('remove', A), ('add', C, 5, 6))
+    index = MappedRegistryIndex(path)
+    follower = RegistryFollower(chain, REGISTRY, index, confirmations=3)
+    assert follower.last_block == 2
+    follower.sync()
+    assert len(index) == 2
+    assert index.get(B) == (3, 4)
+    assert index.get(C) == (5, 6)
+    assert index.get(A) is None
+    index.close()
@@ -0,0 +1,79 @@
+import time
+import gevent
+import pytest
+
+from sikorka.accounts import SignatureCache
+from sikorka.detector import detector_process
+from sikorka.signer import Signer, SignerBusy
+
+USER = '0x8bed7fd11ef2efa1899f751a8d422c1fd028610c'
+
+
+@pytest.fixture()
+def account(sikorka_ctx):
+    account = sikorka_ctx.account
+    yield account
+    if account.signer is not None:
+        account.signer.close()
+    account.signer = None
+    account.signature_cache = None
+
+
+def test_signer_makes_the_same_signatures(account):
+    expected = account.create_signed_message(USER, 1508000000)
+    users = [bytes([i]) * 20 for i in range(1, 6)]
+    expected_batch = [bytes(m) for m in account.create_signed_messages(users, 1508000000)]
+
+    account.signer = Signer(threads=2)
+    assert account.create_signed_message(USER, 1508000000) == expected
+    assert [
+        bytes(m) for m in account.create_signed_messages(users, 1508000000)
+    ] == expected_batch
+    assert account.signer.stats()['signed'] == 6
+    assert account.signer.pending == 0
+
+
+def test_signer_does_not_sign_cached_messages(account):
+    account.signature_cache = SignatureCache(seconds_allowed=10 ** 10)
+    account.signer = Signer(threads=1)
+    first = account.create_signed_message(USER, 1508000000)
+    assert account.create_signed_message(USER, 1508000000) == first
+    assert account.signer.signed == 1
+    assert account.signature_cache.hits == 1
+
+
+def test_signer_rejects_when_busy():
+    signer = Signer(threads=1, max_pending=2)
+    greenlets = [gevent.spawn(signer.run, time.sleep, 1, 0.2) for _ in range(4)]
+    gevent.joinall(greenlets)
+    busy = [g for g in greenlets if isinstance(g.exception, SignerBusy)]
+    assert len(busy) == 2
+    assert signer.stats()['rejected'] == 2
+    assert signer.signed == 2
+
+    # A batch bigger than the limit still goes through when nothing is pending
+    signer.run(time.sleep, 5, 0)
+    signer.close()
+
+
+def test_signer_keeps_the_hub_running():
+    signer = Signer(threads=1)
+    ticks = []
+
+    def tick():
+        for _ in range(5):
+            ticks.append(time.time())
+            gevent.sleep(0.01)
+
+    ticker = gevent.spawn(tick)
+    signer.run(time.sleep, 1, 0.2)
+    assert len(ticks) == 5
+    ticker.join()
+    signer.close()
+
+
+def test_detector_replies_busy(account):
+    account.signer = Signer(threads=1, max_pending=1)
+    account.signer.pending = 1
+    reply = detector_process(b'SIGNED_MESSAGE::' + USER.encode('utf-8'), account)
+    assert reply == b'ERROR::Busy\r\nEND\r\n'
@@ -0,0 +1,85 @@
+import json
+import os
+import pytest
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from sikorka import tracing
+from sikorka.api.api import RestAPI
+from sikorka.api.rest import APIServer
+
+
+def read_events(path):
+    # Written without the closing bracket, which trace viewers do not need
+    data = open(path).read()
+    assert data.startswith('[\n')
+    return json.loads(data.rstrip().rstrip(',') + ']')
+
+
+@pytest.fixture()
+def trace_path(tmp_path):
+    path = str(tmp_path / 'sikorka.trace')
+    tracing.configure(path, sample_rate=1)
+    yield path
+    tracing.disable()
+
+
+def test_spans_nest_in_their_trace(trace_path):
+    with tracing.trace('request', route='/a'):
+        with tracing.span('step'):
+            assert tracing.current() is not None
+            with tracing.trace('nested'):
+                pass
+    assert tracing.current() is None
+    with tracing.span('outside of a trace'):
+        pass
+
+    events = read_events(trace_path)
+    assert [event['name'] for event in events] == ['thread_name', 'nested', 'step', 'request']
+    assert events[0]['args']['name'].startswith('request ')
+    assert len({event['tid'] for event in events}) == 1
+    request, step = events[3], events[2]
+    assert request['args'] == dict(route='/a')
+    assert request['ts'] <= step['ts']
+    assert step['ts'] + step['dur'] <= request['ts'] + request['dur']
+
+
+def test_sample_rate(tmp_path):
+    path = str(tmp_path / 'sikorka.trace')
+    tracing.configure(path, sample_rate=0)
+    try:
+        with tracing.trace('request') as span:
+            assert span.trace is None
+    finally:
+        tracing.disable()
+    assert not os.path.exists(path)
+
+
+def test_trace_file_rotates(tmp_path):
+    path = str(tmp_path / 'sikorka.trace')
+    tracing.configure(path, sample_rate=1, max_bytes=1000, backup_count=2)
+    try:
+        for _ in range(30):
+            with tracing.trace('request'):
+                pass
+    finally:
+        tracing.disable()
+    assert sorted(os.listdir(str(tmp_path))) == [
+        'sikorka.trace', 'sikorka.trace.1', 'sikorka.trace.2',
+    ]
+    for name in os.listdir(str(tmp_path)):
+        events = read_events(str(tmp_path / name))
+        assert events and os.path.getsize(str(tmp_path / name)) <= 1000
+
+
+def test_api_request_trace(trace_path, sikorka_ctx):
+    client = Client(APIServer(RestAPI(sikorka_ctx)).wsgi_app, Response)
+    user = '0x' + '11' * 20
+    response = client.get('/api/1/detector_sign/' + user)
+    trace_id = response.headers['X-Trace-Id']
+
+    events = read_events(trace_path)
+    assert trace_id in events[0]['args']['name']
+    names = [event['name'] for event in events]
+    for name in ('keccak', 'secp256k1', 'sign', 'sign_messages_as_detector', 'json encode'):
+        assert name in names